@@ -20,21 +20,48 @@ cowcatcher worker
 """
 
 
+import ast
+import gzip
+import hashlib
 import json
 import logging
-from collections import defaultdict
-from time import strftime
+import os
+import re
+import struct
+import sys
+import zlib
+from array import array
+from calendar import monthrange, timegm
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from itertools import chain
+from math import exp
+from operator import itemgetter
+from io import BytesIO
+from random import uniform
+from threading import RLock, local
+from time import gmtime, localtime, mktime, sleep, strftime, strptime, time
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, UnknownServiceError
-import parsedatetime as pdt
 
 Logger = logging.getLogger()
 Logger.setLevel(logging.INFO)
 
-S3_C = boto3.client('s3')
-SNS_C = boto3.client('sns')
-CLDTRL_C = boto3.client('cloudtrail')
+# Clients are created on first use through get_client, and parsedatetime,
+# multiprocessing and cgi/html are imported only when needed, to keep
+# cold starts short.
+# boto3 sessions are not thread safe while creating clients
+CLIENT_LOCK = RLock()
+# boto3 sessions per assumed role (None for the Lambda's own credentials)
+# and clients per (service, region, role, pool size); both are kept
+# across warm invocations
+SESSIONS = {}
+CLIENTS = {}
+# assumed role sessions are renewed this many seconds before they expire
+SESSION_REFRESH_MARGIN = 5 * 60
 
 # services cowcatcher has permission to search/delete
 SERVICE_LIST = ['ec2', 'rds', 'autoscaling']
@@ -42,73 +69,986 @@ SERVICE_LIST = ['ec2', 'rds', 'autoscaling']
 DEFS_PATH = 'cowdefs/'
 TEAM_FILEPATH = DEFS_PATH + 'team.json'
 MAX_SNS_MESSAGE = 1024 * 256
+# bytes left free in each SNS message part, for the part header
+SNS_PART_MARGIN = 1024
+# report parts published before a report is offloaded to S3 instead
+DEFAULT_MAX_REPORT_PARTS = 3
+REPORT_FORMATS = ('text', 'json', 'html')
+REPORT_CONTENT_TYPES = {'text': 'text/plain; charset=utf-8',
+                        'json': 'application/json',
+                        'html': 'text/html; charset=utf-8'}
+REPORT_EXTENSIONS = {'text': '.txt', 'json': '.json', 'html': '.html'}
+# A run stops this many seconds before the Lambda timeout, leaving time
+# to save its roundups and checkpoint (team.json DeadlineMargin)
+DEADLINE_MARGIN = 60
+# checkpoints of unfinished runs, per team, in the team Bucket
+CHECKPOINT_PREFIX = 'checkpoints/'
+# response keys of pagination tokens, for checkpointing a paginator
+PAGE_TOKEN_KEYS = ('NextToken', 'Marker', 'PaginationToken')
+# warm Lambda containers keep the last roundup read or written here,
+# for conditional GETs
+ROUNDUP_CACHE_DIR = '/tmp/cowcatcher'
+# roundup fields that change every run, left out of its content hash
+VOLATILE_ROUNDUP_KEYS = ('last_run', 'last_run_epoch', 'owner_stats')
+# ETag and content hash of each roundup as last read or written, by
+# (bucket, key)
+ROUNDUP_STATE = {}
+# Per-run history files (see encode_history) are kept under this prefix
+# of the team Bucket when team.json sets KeepHistory
+HISTORY_PREFIX = 'history/'
+HISTORY_MAGIC = b'COWHIST1'
+# bytes read first from a history file: its header, and all of it when small
+HISTORY_HEAD_BYTES = 64 * 1024
+# columns of a history file, and how each is stored: 'text' as NUL
+# separated strings, 'enum' as codes into a list of values, 'int' as int64
+HISTORY_COLUMNS = (('id', 'text'), ('state', 'enum'), ('type', 'enum'),
+                   ('username', 'enum'), ('initial_discovery', 'int'),
+                   ('last_action', 'enum'), ('action', 'enum'), ('failure', 'enum'),
+                   ('gone', 'int'), ('reason', 'enum'))
+CowRecord = namedtuple('CowRecord', [name for name, _ in HISTORY_COLUMNS])
+HISTORY_INT_TYPE = 'l' if array('l').itemsize == 8 else 'q'
+# action_history entries the roundup keeps per cow with KeepHistory,
+# unless ActionHistoryLimit is set
+DEFAULT_ACTION_HISTORY_LIMIT = 10
+# why a cow left the herd, in the history's reason column: its resource
+# is still discovered and meets the rules, is still discovered but in an
+# exempt state, or is no longer discovered (deleted, or filtered out)
+LEAVE_REASONS = ('tagged', 'exempt', 'removed')
+WEEK_SECONDS = 60 * 60 * 24 * 7
+# the first Monday after the epoch, where history weeks start
+WEEK_ORIGIN = 60 * 60 * 24 * 4
+# seconds an empty (no username found) owner lookup is trusted before
+# CloudTrail is searched again; CloudTrail delivery can lag a new resource.
+OWNER_NEGATIVE_TTL = 60 * 60 * 24
+# CloudTrail events creating each service's instances, for bulk attribution
+CREATE_EVENTS = {'ec2': 'RunInstances',
+                 'rds': 'CreateDBInstance',
+                 'autoscaling': 'CreateAutoScalingGroup'}
+# eventSource of the EventBridge CloudTrail events of each service
+EVENT_SOURCES = {'ec2.amazonaws.com': 'ec2',
+                 'rds.amazonaws.com': 'rds',
+                 'autoscaling.amazonaws.com': 'autoscaling'}
+# parameter of DiscoverInstance restricting it to given ids, and whether
+# it takes a list of them; EC2's is a filter, which skips missing ids
+EVENT_DESCRIBE_PARAMS = {'ec2': ('instance-id', True),
+                         'rds': ('DBInstanceIdentifier', False),
+                         'autoscaling': ('AutoScalingGroupNames', True)}
+# cowdef keys shaping discovery; teams whose cowdefs agree on these
+# (and scan the same account and region) share one scan in main_teams
+DISCOVERY_FIELDS = ('Service', 'DiscoverInstance', 'InstanceIterator1', 'InstanceIterator2',
+                    'InstanceId', 'TagsKey', 'InstType', 'InstStateParent',
+                    'InstStateChild', 'DiscoverTags', 'DiscoverTagsInstParm', 'TagEngine',
+                    'TaggingResourceType')
+# InstanceFilters names evaluated on discovered instances, besides tag:<key>
+LOCAL_FILTERS = ('tag-key', 'instance-state-name', 'instance-type')
+# seconds searched by bulk attribution when there is no previous run, and
+# overlap with the previous run to cover CloudTrail delivery delay
+BULK_ATTRIBUTION_WINDOW = 60 * 60 * 24
+BULK_ATTRIBUTION_OVERLAP = 60 * 60
+# Resource Groups Tagging API resource types, for the 'tagging' TagEngine
+TAGGING_RESOURCE_TYPES = {'ec2': 'ec2:instance',
+                          'rds': 'rds:db'}
+
+# botocore's default HTTP connection pool size per client
+DEFAULT_POOL_CONNECTIONS = 10
+# Read timeout of synchronous shard invocations: Lambda's longest run
+SHARD_READ_TIMEOUT = 15 * 60
+# Instances a shard worker tags between checks of its deadline
+SHARD_CHUNK = 100
+# error codes returned when AWS is rate limiting the caller
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequestsException', 'RequestThrottled', 'SlowDown')
+MAX_API_ATTEMPTS = 6
+# '+N unit' action time_deltas, computed without parsedatetime
+TIME_DELTA_RE = re.compile(r'^\s*\+?\s*(\d+)\s*(second|minute|hour|day|week|month|year)s?\s*$',
+                           re.IGNORECASE)
+TIME_DELTA_SECONDS = {'second': 1, 'minute': 60, 'hour': 60 * 60,
+                      'day': 60 * 60 * 24, 'week': 60 * 60 * 24 * 7}
+# ids per call for actions taking a list of ids, unless batch_size is set
+DEFAULT_ACTION_BATCH = 100
+# stands in for the cow id when parsing api_pre/api_post actions
+ACTION_ID_PLACEHOLDER = '__cow_id__'
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 20
+# Phase timings and API call counts of the service each thread is
+# processing (see start_metrics), emitted as CloudWatch Embedded Metric
+# Format lines
+METRICS = local()
+METRICS_LOCK = RLock()
+METRICS_NAMESPACE = 'CowCatcher'
+METRIC_PHASES = ('DefinitionLoad', 'Pagination', 'TagDiscovery', 'Attribution',
+                 'Actions', 'RoundupIO', 'Publish', 'RateWait')
+# Rate governor every client's calls pass through (see governor_hooks):
+# a token bucket per (service, region, role ARN, operation), kept across
+# warm invocations. A bucket's rate starts at its team.json ApiRates
+# ceiling, or unlimited; a throttle halves it (at most once per
+# GOVERNOR_CUT_INTERVAL) and each successful call adds GOVERNOR_INCREASE.
+# The run's ApiBudget and counters are reset by start_governor.
+GOVERNOR = {'buckets': {}, 'rates': {}, 'budget': None, 'used': 0, 'waited': 0.0,
+            'throttles': 0, 'start': time()}
+GOVERNOR_LOCK = RLock()
+GOVERNOR_DECREASE = 0.5
+GOVERNOR_INCREASE = 0.05
+GOVERNOR_CUT_INTERVAL = 1.0
+MIN_API_RATE = 0.2
+# Seconds over which an unlimited operation's call rate is smoothed, to
+# start from on its first throttle
+GOVERNOR_RATE_WINDOW = 2.0
+# Definition files parsed by this container, by path: their (mtime, size)
+# stamp, content digest and definition; kept across warm invocations
+DEFINITIONS = {}
+TEXT_TYPES = (str, type(u''))
+# cowdef key -> (required, allowed types); None stands for JSON null
+COWDEF_SCHEMA = {'Service': (True, TEXT_TYPES),
+                 'S3Suffix': (True, TEXT_TYPES),
+                 'DiscoverInstance': (True, TEXT_TYPES),
+                 'InstanceFilters': (True, (list, None)),
+                 'InstanceIterator1': (True, TEXT_TYPES + (None,)),
+                 'InstanceIterator2': (True, TEXT_TYPES + (None,)),
+                 'InstanceId': (True, TEXT_TYPES),
+                 'TagsKey': (True, TEXT_TYPES),
+                 'InstType': (True, TEXT_TYPES + (None,)),
+                 'InstStateParent': (True, TEXT_TYPES),
+                 'InstStateChild': (True, TEXT_TYPES + (None,)),
+                 'DiscoverTags': (True, TEXT_TYPES + (None,)),
+                 'DiscoverTagsInstParm': (True, TEXT_TYPES + (None,)),
+                 'CowKeyChecklist': (True, (list,)),
+                 'CowActions': (True, (list,)),
+                 'CreateServiceReport': (True, (bool,)),
+                 'CowReportARN': (True, TEXT_TYPES + (None,)),
+                 'CowRules': (False, (list,)),
+                 'CowExemptStates': (False, (list, None)),
+                 'TagEngine': (False, TEXT_TYPES),
+                 'TaggingResourceType': (False, TEXT_TYPES),
+                 'DiscoverTagsConcurrency': (False, (int,)),
+                 'BulkAttribution': (False, (bool,)),
+                 'ShardCount': (False, (int,)),
+                 'CreateEventName': (False, TEXT_TYPES)}
+TAG_ENGINES = ('describe', 'tagging')
+# cowdef keys compiled into an instance extractor, and the extractors
+# compiled so far, by the values of those keys
+EXTRACTOR_FIELDS = ('InstanceId', 'InstType', 'InstStateParent', 'InstStateChild',
+                    'TagsKey', 'DiscoverTags', 'DiscoverTagsInstParm')
+EXTRACTORS = {}
+
+def validate_cowdef(svc_info):
+    """
+    Return the list of ways svc_info breaks COWDEF_SCHEMA, empty if none
+    """
+    errors = []
+    for key, (required, types) in sorted(COWDEF_SCHEMA.items()):
+        if key not in svc_info:
+            if required:
+                errors.append('missing ' + key)
+            continue
+        value = svc_info[key]
+        if value is None:
+            if None not in types:
+                errors.append(key + ' may not be null')
+        # bool is an int, but not a valid count
+        elif not isinstance(value, tuple(kind for kind in types if kind is not None)) or \
+                (isinstance(value, bool) and bool not in types):
+            errors.append('%s has the wrong type: %r' % (key, value))
+    shards = svc_info.get('ShardCount')
+    if isinstance(shards, int) and shards > 1 and \
+       (not svc_info.get('DiscoverTags') or svc_info.get('TagEngine', 'describe') != 'describe'):
+        errors.append('ShardCount needs tags from per-instance DiscoverTags calls')
+    if svc_info.get('TagEngine', 'describe') not in TAG_ENGINES:
+        errors.append('TagEngine must be one of ' + ', '.join(TAG_ENGINES))
+    elif svc_info.get('TagEngine') == 'tagging' and not svc_info.get('TaggingResourceType') \
+            and svc_info.get('Service') not in TAGGING_RESOURCE_TYPES:
+        errors.append('TagEngine tagging needs a TaggingResourceType for ' +
+                      str(svc_info.get('Service')))
+    for act in svc_info.get('CowActions') or []:
+        if not isinstance(act, dict) or 'action' not in act or 'time_delta' not in act:
+            errors.append('CowActions need an action and a time_delta: %r' % (act,))
+    return errors
+
+
+def parse_definition(body):
+    """
+    Parse a JSON definition; a cowdef (one with a Service) is validated
+    against COWDEF_SCHEMA and its instance extractor compiled
+    """
+    definition = json.loads(body.decode('utf-8'))
+    if isinstance(definition, dict) and 'Service' in definition:
+        errors = validate_cowdef(definition)
+        if errors:
+            raise ValueError('Invalid cowdef: ' + '; '.join(errors))
+        instance_extractor(definition)
+    return definition
+
 
 def load_definition_file(file_name):
     """
-    Load JSON definition
+    Load JSON definition.
+    A file is parsed (and validated) again only when its mtime or size
+    changed and its content too; otherwise the definition parsed by an
+    earlier (warm) invocation is returned. A file that fails to parse or
+    validate returns "", and callers skip it.
     """
     try:
-        with open(file_name, 'r') as deffile:
-            mydict = json.load(deffile)
+        info = os.stat(file_name)
+        stamp = (info.st_mtime, info.st_size)
+        cached = DEFINITIONS.get(file_name)
+        if cached is None or cached['stamp'] != stamp:
+            with open(file_name, 'rb') as deffile:
+                body = deffile.read()
+            digest = hashlib.sha1(body).hexdigest()
+            if cached is None or cached['digest'] != digest:
+                cached = {'digest': digest, 'definition': parse_definition(body)}
+            DEFINITIONS[file_name] = dict(cached, stamp=stamp)
+        mydict = cached['definition']
     except ValueError as error:
         mydict = ""
         Logger.warning('Failed to load file: %s', file_name)
         Logger.critical('Critical Error: %s', str(error))
-    return mydict
+    # callers may adjust their copy
+    return dict(mydict) if isinstance(mydict, dict) else mydict
+
+
+def encode_roundup(roundup):
+    """
+    Return roundup as gzipped JSON
+    """
+    out = BytesIO()
+    # A fixed mtime keeps the bytes of equal roundups equal
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gzfile:
+        gzfile.write(json.dumps(roundup, ensure_ascii=False).encode('utf-8'))
+    return out.getvalue()
+
+
+def decode_roundup(body):
+    """
+    Return the roundup in body, gzipped or (as written by earlier
+    versions) plain JSON
+    """
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.GzipFile(fileobj=BytesIO(body), mode='rb').read()
+    return json.loads(body.decode('utf-8'))
+
+
+def roundup_digest(roundup):
+    """
+    Return a hash of roundup's content, ignoring fields that change
+    every run
+    """
+    content = {key:roundup[key] for key in roundup if key not in VOLATILE_ROUNDUP_KEYS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def roundup_cache_path(bucket, filename):
+    """
+    Return the local cache file of a roundup
+    """
+    name = hashlib.md5((bucket + '/' + filename).encode('utf-8')).hexdigest()
+    return os.path.join(ROUNDUP_CACHE_DIR, name)
+
+
+def read_roundup_cache(bucket, filename):
+    """
+    Return the (state, body) of a locally cached roundup, or None
+    """
+    path = roundup_cache_path(bucket, filename)
+    try:
+        with open(path + '.meta', 'r') as metafile:
+            state = json.load(metafile)
+        with open(path, 'rb') as cachefile:
+            return state, cachefile.read()
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_roundup_cache(bucket, filename, state, body):
+    """
+    Keep a roundup and its state in the local cache
+    """
+    path = roundup_cache_path(bucket, filename)
+    try:
+        if not os.path.isdir(ROUNDUP_CACHE_DIR):
+            os.makedirs(ROUNDUP_CACHE_DIR)
+        with open(path, 'wb') as cachefile:
+            cachefile.write(body)
+        with open(path + '.meta', 'w') as metafile:
+            json.dump(state, metafile)
+    except (IOError, OSError) as err:
+        Logger.warning('Unable to cache roundup %s: %s', filename, err)
 
 
-def load_roundup(bucket, filename):
+def load_roundup(bucket, filename, use_cache=True):
     """
-    Load JSON cows from S3 file
+    Load JSON cows from S3 file.
+    A copy cached by this container is revalidated with its ETag, so an
+    unchanged roundup is not downloaded again.
     """
+    cached = read_roundup_cache(bucket, filename) if use_cache else None
+    kwargs = {}
+    if cached:
+        kwargs['IfNoneMatch'] = cached[0]['etag']
     try:
-        obj = S3_C.get_object(Bucket=bucket, Key=filename)
-        last_str = obj['Body'].read().decode('utf-8')
-        cows = json.loads(last_str)
+        obj = get_client('s3').get_object(Bucket=bucket, Key=filename, **kwargs)
+        body = obj['Body'].read()
+        state = {'etag': obj['ETag'],
+                 'hash': obj.get('Metadata', {}).get('content-sha256')}
+        write_roundup_cache(bucket, filename, state, body)
     except ClientError as err:
-        if err.response['Error']['Code'] == "NoSuchKey":
+        if err.response['Error']['Code'] in ('304', 'NotModified') and cached:
+            state, body = cached
+        elif err.response['Error']['Code'] == "NoSuchKey":
             Logger.warning('No file found: %s', filename)
-            cows = []
+            ROUNDUP_STATE[(bucket, filename)] = {'etag': None, 'hash': None}
+            return []
         else:
             raise
 
-    return cows
+    ROUNDUP_STATE[(bucket, filename)] = state
+    return migrate_roundup(decode_roundup(body))
+
+
+def merge_roundups(ours, theirs):
+    """
+    Merge the action history and owners of a roundup written by an
+    overlapping invocation (theirs) into ours
+    """
+    if not theirs:
+        return ours
+    tcows = {cow['id']:cow for cow in theirs['cows']}
+    for cow in ours['cows']:
+        if cow['id'] in tcows:
+            known = set(cow['action_history'])
+            cow['action_history'].extend(act for act in tcows[cow['id']]['action_history']
+                                         if act not in known)
+    owners = dict(theirs.get('owners', {}))
+    owners.update(ours.get('owners', {}))
+    ours['owners'] = owners
+    return ours
+
+
+def parse_run_time(time_str):
+    """
+    Return the epoch of a '%c' time string written by an earlier run
+    """
+    try:
+        return int(mktime(strptime(time_str, '%c')))
+    except ValueError:
+        # Written under another locale; fall back to natural language parsing
+        return int(mktime(new_calendar().parse(time_str)[0]))
+
+
+def migrate_roundup(roundup):
+    """
+    Convert a roundup written before discovery times were stored as
+    epochs: '%c' strings move to initial_discovery_str for display, and
+    initial_discovery/last_run_epoch become epoch integers.
+    """
+    if not roundup:
+        return roundup
+    for cow in roundup['cows']:
+        if not isinstance(cow['initial_discovery'], (int, float)):
+            cow['initial_discovery_str'] = cow['initial_discovery']
+            cow['initial_discovery'] = parse_run_time(cow['initial_discovery'])
+    if 'last_run_epoch' not in roundup and 'last_run' in roundup:
+        roundup['last_run_epoch'] = parse_run_time(roundup['last_run'])
+    return roundup
 
 
 def save_roundup(roundup, bucket, filename):
     """
-    Save roundup to S3 json
+    Save roundup to S3 as gzipped json, unless its content is unchanged
+    since it was loaded. If another invocation wrote the roundup since
+    then, its action history is merged in before writing.
     """
+    digest = roundup_digest(roundup)
+    state = ROUNDUP_STATE.get((bucket, filename))
+    if state and state['hash'] == digest:
+        Logger.info('Roundup unchanged, not rewritten: %s', filename)
+        return 200
+
+    if state:
+        try:
+            current = get_client('s3').head_object(Bucket=bucket, Key=filename)['ETag']
+        except ClientError:
+            current = None
+        if current and current != state['etag']:
+            Logger.warning('Roundup changed by another run, merging: %s', filename)
+            roundup = merge_roundups(roundup, load_roundup(bucket, filename,
+                                                           use_cache=False))
+            digest = roundup_digest(roundup)
+
+    body = encode_roundup(roundup)
     try:
-        out = S3_C.put_object(Bucket=bucket, Key=filename,
-                              Body=json.dumps(roundup, ensure_ascii=False))
+        out = get_client('s3').put_object(Bucket=bucket, Key=filename, Body=body,
+                              ContentType='application/json', ContentEncoding='gzip',
+                              Metadata={'content-sha256': digest})
     except ClientError as err:
-        Logger.error('Issue writing file:' + filename + ':' + err)
+        Logger.error('Issue writing file: %s: %s', filename, err)
+        return err.response['ResponseMetadata']['HTTPStatusCode']
 
+    state = {'etag': out['ETag'], 'hash': digest}
+    ROUNDUP_STATE[(bucket, filename)] = state
+    write_roundup_cache(bucket, filename, state, body)
     return out['ResponseMetadata']['HTTPStatusCode']
 
 
-def send_report(report_text, svc_info, now_str):
+def trim_action_history(roundup, limit):
+    """
+    Keep only the last limit entries of each cow's action_history
+    """
+    for cow in roundup['cows']:
+        if len(cow['action_history']) > limit:
+            del cow['action_history'][:-limit]
+    return roundup
+
+
+def run_action(cow, now_str):
+    """
+    Return the (action, failure) handle_cows recorded for cow in the run
+    of now_str, or (None, None)
+    """
+    if not cow['action_history']:
+        return None, None
+    action, _, entry = cow['action_history'][-1].partition(' ')
+    if entry == 'at ' + now_str:
+        return action, None
+    failed = 'failed at ' + now_str + ': '
+    if entry.startswith(failed):
+        return action, entry[len(failed):]
+    return None, None
+
+
+def leave_reason(state, rules=None):
+    """
+    Return the LEAVE_REASONS entry of a cow that left the herd, given the
+    state its resource was discovered in this run (None if it was not)
+    and the cowdef's compiled rules
+    """
+    if state is None:
+        return 'removed'
+    if rules and (state in rules['exempt_states'] or
+                  any(state in rule['exempt_states'] for rule in rules['rules'])):
+        return 'exempt'
+    return 'tagged'
+
+
+def watch_states(instances, found):
+    """
+    Yield instances, setting the state of those whose id is a key of
+    found
+    """
+    for inst in instances:
+        if inst['id'] in found:
+            found[inst['id']] = inst['state']
+        yield inst
+
+
+def history_rows(roundup, old_roundup, now_str, found=None, rules=None):
+    """
+    Return the CowRecords of a run: one per cow of roundup, with the
+    action it triggered in the run, and one per cow of old_roundup gone
+    since, with the reason it left (see leave_reason): found maps their
+    ids to the state they were discovered in, if any
+    """
+    rows = []
+    for cow in roundup['cows']:
+        action, failure = run_action(cow, now_str)
+        rows.append(CowRecord(cow['id'], cow['state'], cow.get('type'), cow.get('username'),
+                              cow['initial_discovery'], cow['last_action'], action,
+                              failure, 0, None))
+    herd = set(cow['id'] for cow in roundup['cows'])
+    found = found or {}
+    for cow in (old_roundup['cows'] if old_roundup else []):
+        if cow['id'] not in herd:
+            rows.append(CowRecord(cow['id'], cow['state'], cow.get('type'),
+                                  cow.get('username'), cow['initial_discovery'],
+                                  cow.get('last_action'), None, None, 1,
+                                  leave_reason(found.get(cow['id']), rules)))
+    return rows
+
+
+def pack_array(typecode, values):
+    """
+    Return values as the little endian bytes of an array of typecode
+    """
+    arr = array(typecode, values)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tostring()
+
+
+def unpack_array(typecode, data):
+    """
+    Return the array of typecode packed in data by pack_array
+    """
+    arr = array(typecode)
+    arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def encode_history(rows, service, run_epoch):
+    """
+    Return the CowRecords of a run as a history file: HISTORY_MAGIC, the
+    length and JSON of a header locating each column, then the columns,
+    each compressed on its own so it can be read alone (see read_history)
+    """
+    columns = zip(*rows) if rows else [()] * len(HISTORY_COLUMNS)
+    header = {'service': service, 'run_epoch': run_epoch, 'rows': len(rows),
+              'columns': []}
+    blobs = []
+    offset = 0
+    for (name, kind), values in zip(HISTORY_COLUMNS, columns):
+        column = {'name': name, 'kind': kind}
+        if kind == 'text':
+            data = u'\0'.join(values).encode('utf-8')
+        elif kind == 'enum':
+            codes = {}
+            data = pack_array('i', [codes.setdefault(value, len(codes)) for value in values])
+            column['values'] = sorted(codes, key=codes.get)
+        else:
+            data = pack_array(HISTORY_INT_TYPE, values)
+        data = zlib.compress(data)
+        column['offset'], column['length'] = offset, len(data)
+        offset += len(data)
+        header['columns'].append(column)
+        blobs.append(data)
+    head = json.dumps(header).encode('utf-8')
+    return b''.join([HISTORY_MAGIC, struct.pack('<I', len(head)), head] + blobs)
+
+
+def decode_history_column(column, data, rows):
+    """
+    Return the values of a history file column from its compressed data
+    """
+    data = zlib.decompress(data)
+    if column['kind'] == 'text':
+        return data.decode('utf-8').split(u'\0') if rows else []
+    if column['kind'] == 'enum':
+        values = column['values']
+        return [values[code] for code in unpack_array('i', data)]
+    return unpack_array(HISTORY_INT_TYPE, data).tolist()
+
+
+def history_key(cowfile, run_epoch):
+    """
+    Return the S3 key of the history file of a roundup's run
+    """
+    return HISTORY_PREFIX + cowfile[:-len('.json')] + '/%010d.cows' % run_epoch
+
+
+def write_history(rows, bucket, cowfile, service, run_epoch):
+    """
+    Save the CowRecords of a run of roundup cowfile to its history file
+    """
+    key = history_key(cowfile, run_epoch)
+    try:
+        get_client('s3').put_object(Bucket=bucket, Key=key,
+                                    Body=encode_history(rows, service, run_epoch),
+                                    ContentType='application/octet-stream')
+    except ClientError as err:
+        Logger.error('Issue writing history: %s: %s', key, err)
+
+
+def read_history(bucket, key, columns=None):
+    """
+    Return the header and the {name: values} of the given columns (all
+    by default) of a history file. Only the header and the bytes of those
+    columns are downloaded, with ranged GETs.
+    """
+    s3_client = get_client('s3')
+
+    def read_range(first, last):
+        """ bytes first to last (inclusive) of the file """
+        return s3_client.get_object(Bucket=bucket, Key=key,
+                                    Range='bytes=%d-%d' % (first, last))['Body'].read()
+
+    head = read_range(0, HISTORY_HEAD_BYTES - 1)
+    start = len(HISTORY_MAGIC) + 4
+    if head[:len(HISTORY_MAGIC)] != HISTORY_MAGIC:
+        raise ValueError('Not a history file: ' + key)
+    end = start + struct.unpack('<I', head[len(HISTORY_MAGIC):start])[0]
+    if len(head) < end:
+        head += read_range(len(head), end - 1)
+    header = json.loads(head[start:end].decode('utf-8'))
+
+    wanted = [column for column in header['columns']
+              if columns is None or column['name'] in columns]
+    values = {}
+    if not wanted:
+        return header, values
+    first = end + min(column['offset'] for column in wanted)
+    last = end + max(column['offset'] + column['length'] for column in wanted)
+    if last <= len(head):
+        data = head[first:last]
+    else:
+        data = read_range(first, last - 1)
+    for column in wanted:
+        blob_at = end + column['offset'] - first
+        values[column['name']] = decode_history_column(
+            column, data[blob_at:blob_at + column['length']], header['rows'])
+    return header, values
+
+
+def iter_history(bucket, cowfile, columns=None, since=None, until=None):
+    """
+    Yield the header and CowRecords of each run of roundup cowfile
+    from epoch since until (before) epoch until, oldest first. Fields
+    outside columns are None.
+    """
+    prefix = HISTORY_PREFIX + cowfile[:-len('.json')] + '/'
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if since is not None:
+        # keys sort by run epoch; this one sorts just before since's
+        kwargs['StartAfter'] = prefix + '%010d' % since
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            if until is not None and int(obj['Key'][len(prefix):].split('.')[0]) >= until:
+                return
+            header, values = read_history(bucket, obj['Key'], columns)
+            missing = [None] * header['rows']
+            yield header, [CowRecord._make(row) for row in
+                           zip(*[values.get(name, missing) for name in CowRecord._fields])]
+
+
+def cows_per_week(bucket, cowfiles, since=None, until=None):
+    """
+    Return {service: {week: cows}}, the number of distinct cows in the
+    herd of each service each week (starting Monday, UTC), from the
+    history of the roundups cowfiles
+    """
+    weeks = defaultdict(lambda: defaultdict(set))
+    for cowfile in cowfiles:
+        for header, records in iter_history(bucket, cowfile, ('id', 'gone'), since, until):
+            week = (header['run_epoch'] - WEEK_ORIGIN) // WEEK_SECONDS * WEEK_SECONDS + \
+                WEEK_ORIGIN
+            weeks[header['service']][strftime('%Y-%m-%d', gmtime(week))].update(
+                record.id for record in records if not record.gone)
+    return {service: {week: len(ids) for week, ids in counts.items()}
+            for service, counts in weeks.items()}
+
+
+def time_to_tag(bucket, cowfile, since=None, until=None):
+    """
+    Return {id: seconds} from discovery to leaving the herd, for the cows
+    of roundup cowfile that left it tagged: still discovered, meeting the
+    rules outside any exempt state. Runs written before the reason column
+    count no cow.
+    """
+    tagged = {}
+    for header, records in iter_history(bucket, cowfile,
+                                        ('id', 'initial_discovery', 'reason'),
+                                        since, until):
+        for record in records:
+            if record.reason == 'tagged':
+                tagged[record.id] = header['run_epoch'] - record.initial_discovery
+    return tagged
+
+
+def run_deadline(context, margin=DEADLINE_MARGIN):
+    """
+    Return the epoch by which a run should checkpoint and stop, margin
+    seconds before the Lambda times out; None without a Lambda context
+    """
+    remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if remaining is None:
+        return None
+    return time() + remaining() / 1000.0 - margin
+
+
+def out_of_time(deadline):
+    """
+    Return True once deadline (see run_deadline) has passed, or the
+    run's ApiBudget is spent
+    """
+    return deadline is not None and (time() >= deadline or budget_spent())
+
+
+def task_key(svc, role_arn=None, region=None):
+    """
+    Return the checkpoint key of a (CowDefs file, role ARN, region) task
+    """
+    return '|'.join([svc, role_arn or '', region or ''])
+
+
+def checkpoint_key(team_info):
+    """
+    Return the S3 key of the team's run checkpoint
+    """
+    return CHECKPOINT_PREFIX + team_info['Team'] + '.json'
+
+
+def load_checkpoint(bucket, key):
+    """
+    Return the checkpoint left by an unfinished run, or None
+    """
+    try:
+        obj = get_client('s3').get_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    return json.loads(obj['Body'].read().decode('utf-8'))
+
+
+def save_checkpoint(run):
+    """
+    Write the checkpoint of run to its team Bucket
+    """
+    with run['lock']:
+        body = json.dumps(run['checkpoint']).encode('utf-8')
+        get_client('s3').put_object(Bucket=run['bucket'], Key=run['key'], Body=body,
+                                    ContentType='application/json')
+        run['saved'] = True
+
+
+def clear_checkpoint(run):
+    """
+    Delete the checkpoint of a finished run, if one was written or resumed
+    """
+    if run['saved']:
+        get_client('s3').delete_object(Bucket=run['bucket'], Key=run['key'])
+        run['saved'] = False
+
+
+def record_pending_actions(roundup, pending):
+    """
+    Record actions written ahead by a run that stopped before saving its
+    roundup: they may have been made, so they enter the action history
+    as unconfirmed unless the roundup already holds them
+    """
+    if not roundup or not pending:
+        return roundup
+    actions = {}
+    for action, ids in pending['actions'].items():
+        for cow_id in ids:
+            actions[cow_id] = action
+    for cow in roundup['cows']:
+        action = actions.get(cow['id'])
+        if action is None:
+            continue
+        made = action + ' at ' + pending['at']
+        if not any(act.startswith(made) for act in cow['action_history']):
+            cow['action_history'].append(made + ' (unconfirmed)')
+        cow['last_action'] = action
+    return roundup
+
+
+def page_token(page_iter, response):
+    """
+    Return the starting token resuming page_iter after response, or None
+    when it has no further pages or the token cannot be encoded
+    """
+    token = dict((key, response[key]) for key in PAGE_TOKEN_KEYS if response.get(key))
+    if not token:
+        return None
+    try:
+        page_iter.resume_token = token
+    except ValueError:
+        return None
+    return page_iter.resume_token
+
+
+def split_report(chunks, max_bytes):
+    """
+    Group report chunks (e.g. one per cow) into parts of at most
+    max_bytes of UTF-8. Parts break between chunks; a chunk too large
+    for a part of its own is split between characters.
+    """
+    parts = []
+    current = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        if current and size + len(data) > max_bytes:
+            parts.append(current)
+            current = []
+            size = 0
+        while len(data) > max_bytes:
+            piece = data[:max_bytes].decode('utf-8', 'ignore').encode('utf-8')
+            parts.append([piece])
+            data = data[len(piece):]
+        if data:
+            current.append(data)
+            size += len(data)
+    if current:
+        parts.append(current)
+
+    return [b''.join(part).decode('utf-8') for part in parts]
+
+
+def send_report(report_text, svc_info, now_str, bucket=None, report_key=None,
+                max_parts=DEFAULT_MAX_REPORT_PARTS):
     """
     Publish report to AWS SNS endpoint
-    Note: publish takes a max of 256KB.
-    """
-    overage = len(report_text) - MAX_SNS_MESSAGE
-    if overage > 0:
-        report_text = report_text[:-overage - 20] + '\n<message truncated/>'
-    resp = SNS_C.publish(TopicArn=svc_info['CowReportARN'],
-                         Message=report_text,
-                         Subject='CowCatcher Report for ' + now_str)
+    Note: publish takes a max of 256KB, so reports are published in
+    numbered parts, split between chunks of report_text (a string or
+    list of chunks). Past max_parts, the report is saved to bucket under
+    report_key and only a pointer to it is published.
+    Return the last publish response, or None if the report is empty and
+    nothing was published.
+    """
+    if isinstance(report_text, list):
+        chunks = report_text
+    else:
+        chunks = [report_text]
+    parts = split_report(chunks, MAX_SNS_MESSAGE - SNS_PART_MARGIN)
+    if not parts:
+        Logger.info('Report for %s is empty, not publishing it', now_str)
+        return None
+    if len(parts) > max_parts and bucket and report_key:
+        link = save_report(''.join(chunks), bucket, report_key)
+        parts = ['CowCatcher report is too large to publish (' + str(len(parts)) +
+                 ' parts).\nFull report: ' + link + '\n']
+
+    sns_client = get_client('sns', svc_info['CowReportARN'].split(':')[3])
+    subject = 'CowCatcher Report for ' + now_str
+    for idx, part in enumerate(parts):
+        if len(parts) > 1:
+            subject = 'CowCatcher Report for %s (%d/%d)' % (now_str, idx + 1, len(parts))
+        resp = call_with_backoff(sns_client.publish, TopicArn=svc_info['CowReportARN'],
+                                 Message=part, Subject=subject)
     return resp
 
 
-def handle_cows(new_cows, old_roundup, svc_client, svc_info, pdtcal, now_tm, now_str):
+def compile_action(act):
+    """
+    Return the structured spec (api, id_param, id_list, batch_size,
+    api_args) of a CowActions entry. Entries still written as api_pre/
+    api_post call strings are parsed into the same spec.
+    """
+    spec = {'action': act['action'],
+            'time_delta': act['time_delta'],
+            'api': act.get('api'),
+            'id_param': act.get('id_param'),
+            'id_list': act.get('id_list', False),
+            'batch_size': act.get('batch_size'),
+            'api_args': dict(act.get('api_args') or {})}
+    if not spec['api'] and act.get('api_pre'):
+        call = ast.parse(act['api_pre'] + ACTION_ID_PLACEHOLDER + act['api_post'],
+                         mode='eval').body
+        spec['api'] = call.func.id
+        for kwd in call.keywords:
+            value = ast.literal_eval(kwd.value)
+            if value == ACTION_ID_PLACEHOLDER:
+                spec['id_param'] = kwd.arg
+            elif value == [ACTION_ID_PLACEHOLDER]:
+                spec['id_param'] = kwd.arg
+                spec['id_list'] = True
+            else:
+                spec['api_args'][kwd.arg] = value
+    if not spec['batch_size']:
+        spec['batch_size'] = DEFAULT_ACTION_BATCH if spec['id_list'] else 1
+
+    return spec
+
+
+def run_action_batch(svc_client, spec, ids):
+    """
+    Call the action's API for ids, batch_size ids per call.
+    Return {id: error code} for ids that failed; a failed batch is
+    retried one id at a time so each failure maps to its id.
+    """
+    failures = {}
+    api_call = getattr(svc_client, spec['api'])
+    for start in range(0, len(ids), spec['batch_size']):
+        batch = ids[start:start + spec['batch_size']]
+        kwargs = dict(spec['api_args'])
+        if spec['id_list']:
+            kwargs[spec['id_param']] = batch
+        else:
+            kwargs[spec['id_param']] = batch[0]
+        try:
+            call_with_backoff(api_call, **kwargs)
+        except ClientError as err:
+            if len(batch) == 1:
+                failures[batch[0]] = err.response['Error']['Code']
+            else:
+                failures.update(run_action_batch(svc_client, dict(spec, batch_size=1),
+                                                 batch))
+
+    return failures
+
+
+def add_time_delta(time_delta, now_tm, pdtcal=None):
+    """
+    Return the epoch of time_delta (e.g. '+5 weeks') after now_tm.
+    Plain '+N unit' deltas are computed directly; anything else is
+    parsed with parsedatetime.
+    """
+    match = TIME_DELTA_RE.match(time_delta)
+    if not match:
+        if pdtcal is None:
+            pdtcal = new_calendar()
+        return mktime(pdtcal.parse(time_delta, now_tm)[0])
+    count = int(match.group(1))
+    unit = match.group(2).lower()
+    fields = list(now_tm[:9])
+    if unit in ('year', 'month'):
+        months = fields[0] * 12 + fields[1] - 1 + (count * 12 if unit == 'year' else count)
+        fields[0], fields[1] = months // 12, months % 12 + 1
+        # Jan 31 + 1 month is the end of February, as parsedatetime has it
+        fields[2] = min(fields[2], monthrange(fields[0], fields[1])[1])
+    else:
+        fields[5] += count * TIME_DELTA_SECONDS[unit]
+    # mktime normalizes overflowing seconds
+    fields[8] = -1
+    return mktime(tuple(fields))
+
+
+def action_cutoffs(specs, pdtcal, now_tm):
+    """
+    Return, for each action spec, the latest discovery epoch for which
+    the action triggers this run: now less the action's time_delta.
+    """
+    now_sec = mktime(now_tm[0])
+    return [int(2 * now_sec - add_time_delta(spec['time_delta'], now_tm[0], pdtcal))
+            for spec in specs]
+
+
+def carry_cow_history(ninst, ocow, now_sec, now_str):
+    """
+    Carry a cow's discovery time and action history over from its entry
+    in the previous roundup, ocow, or start them now if it is new
+    """
+    if ocow:
+        ninst['initial_discovery'] = ocow['initial_discovery']
+        ninst['initial_discovery_str'] = ocow.get('initial_discovery_str') or \
+            strftime('%c', localtime(ocow['initial_discovery']))
+        ninst['action_history'] = ocow['action_history']
+        ninst['last_action'] = ocow.get('last_action') or \
+            (ocow['action_history'] and ocow['action_history'][-1].split(' ')[0]) or None
+    else:
+        ninst['initial_discovery'] = now_sec
+        ninst['initial_discovery_str'] = now_str
+        ninst['action_history'] = []
+        ninst['last_action'] = None
+
+
+def handle_cows(new_cows, old_roundup, svc_client, svc_info, pdtcal, now_tm, now_str,
+                on_pending=None, held=None, enforce=False):
     """
     Handle (report/stop/terminate) all the new_cows, given rules and
     historical roundup info.
+    Action time_deltas are converted to epoch cut-offs once, and cows are
+    grouped by triggered action; each action's API is called in batches
+    and failed ids are recorded in their cow's action_history.
+    The roundup's 'delta' lists new cows, cows gone since old_roundup and
+    cows whose action changed or called an API this run.
+    Before any API is called, on_pending (if given) is passed the
+    {action: ids} about to be made, so they can be written ahead.
+    Cows of old_roundup in held (e.g. those of a failed shard) are kept
+    as they were: no action is taken on them and they are not gone.
+    Unless enforce is set (team.json's EnforceActions), no action is
+    taken or recorded: the actions that would be are only logged.
     """
     summary = defaultdict(int)
     roundup = {}
+    now_sec = int(mktime(now_tm[0]))
+    specs = [compile_action(act) for act in svc_info['CowActions']]
+    cutoffs = action_cutoffs(specs, pdtcal, now_tm)
+    triggered = defaultdict(list)
+    actioned = []
 
     if old_roundup:
         ocows = {a['id']:a for a in old_roundup['cows']}
@@ -116,190 +1056,1164 @@ def handle_cows(new_cows, old_roundup, svc_client, svc_info, pdtcal, now_tm, now
         ocows = {}
 
     for ninst in new_cows:
-        s_time = now_tm
-        if ninst['id'] in ocows:
-            ninst['initial_discovery'] = ocows[ninst['id']]['initial_discovery']
-            s_time = pdtcal.parse(ocows[ninst['id']]['initial_discovery'])
-            ninst['action_history'] = ocows[ninst['id']]['action_history']
-        else:
-            ninst['initial_discovery'] = now_str
-            ninst['action_history'] = []
-        for act in svc_info['CowActions']:
-            if s_time > pdtcal.parse(act['time_delta']):
-                #Action triggered
-                summary[act['action']] += 1
-                act_comment = act['action']  + ' at ' + now_str
-                if act['api_pre']:
-                    cmd = 'svc_client.' + act['api_pre'] + ninst['id'] + act['api_post']
-                    eval(cmd)
-                ninst['action_history'].append(act_comment)
+        carry_cow_history(ninst, ocows.get(ninst['id']), now_sec, now_str)
+        # Actions are listed by decreasing time_delta; the first due wins
+        for idx, cutoff in enumerate(cutoffs):
+            if ninst['initial_discovery'] <= cutoff:
+                triggered[idx].append(ninst)
                 break
 
+    if not enforce:
+        for idx, spec in enumerate(specs):
+            if triggered[idx]:
+                Logger.info('EnforceActions is off, not taking %s on %d %s cows',
+                            spec['action'], len(triggered[idx]), svc_info['Service'])
+        triggered.clear()
+
+    pending = dict((spec['action'], [cow['id'] for cow in triggered[idx]])
+                   for idx, spec in enumerate(specs) if spec['api'] and triggered[idx])
+    if pending and on_pending is not None:
+        on_pending(pending)
+
+    for idx, spec in enumerate(specs):
+        if not triggered[idx]:
+            continue
+        failures = {}
+        if spec['api']:
+            with timed_phase('Actions'):
+                failures = run_action_batch(svc_client, spec,
+                                            [cow['id'] for cow in triggered[idx]])
+        for cow in triggered[idx]:
+            # An action counts as a change when it calls an API, or when a
+            # report-only action is first reached
+            if spec['api'] or cow['last_action'] != spec['action']:
+                actioned.append(cow['id'])
+            cow['last_action'] = spec['action']
+            if cow['id'] in failures:
+                summary[spec['action'] + ' failed'] += 1
+                cow['action_history'].append(spec['action'] + ' failed at ' + now_str +
+                                             ': ' + failures[cow['id']])
+            else:
+                summary[spec['action']] += 1
+                cow['action_history'].append(spec['action'] + ' at ' + now_str)
+
+    held = held or []
+    new_ids = set(cow['id'] for cow in chain(new_cows, held))
+    roundup['delta'] = {'new': [cow['id'] for cow in new_cows if cow['id'] not in ocows],
+                        'gone': [{'id': cow['id'], 'username': cow.get('username'),
+                                  'state': cow['state'], 'type': cow.get('type')}
+                                 for cow in (old_roundup['cows'] if old_roundup else [])
+                                 if cow['id'] not in new_ids],
+                        'actioned': actioned}
     roundup['action_summary'] = summary
-    roundup['cows'] = new_cows
+    roundup['cows'] = new_cows + held if held else new_cows
     roundup['last_run'] = now_str
+    roundup['last_run_epoch'] = now_sec
     return roundup
 
 
-def analyze_service_instances(svc_inst, svc_info):
+def compile_rules(svc_info):
+    """
+    Compile a cowdef's CowKeyChecklist (required tag keys) and optional
+    CowRules (per key allowed values, value regex and exempt states) into
+    the sets and patterns used by cow_violations
+    """
+    value_rules = []
+    for rule in svc_info.get('CowRules', []):
+        value_rules.append({'key': rule['key'],
+                            'allowed': frozenset(rule.get('allowed') or []),
+                            'regex': re.compile(rule['regex']) if rule.get('regex') else None,
+                            'exempt_states': frozenset(rule.get('exempt_states') or [])})
+
+    return {'required': list(svc_info['CowKeyChecklist']),
+            'required_set': frozenset(svc_info['CowKeyChecklist']),
+            'rules': value_rules,
+            'exempt_states': frozenset(svc_info.get('CowExemptStates') or [])}
+
+
+def cow_violations(rules, inst):
+    """
+    Return the list of rules inst violates, empty for a conforming instance
+    """
+    tags = inst['tags']
+    if inst['state'] in rules['exempt_states']:
+        return []
+    violations = []
+    if not rules['required_set'].issubset(tags):
+        violations = ['missing ' + key for key in rules['required'] if key not in tags]
+    for rule in rules['rules']:
+        if inst['state'] in rule['exempt_states']:
+            continue
+        value = tags.get(rule['key'])
+        if value is None:
+            if rule['key'] not in rules['required_set']:
+                violations.append('missing ' + rule['key'])
+        elif rule['allowed'] and value not in rule['allowed']:
+            violations.append(rule['key'] + '=' + value + ' not allowed')
+        elif rule['regex'] and not rule['regex'].match(value):
+            violations.append(rule['key'] + '=' + value + ' does not match ' +
+                              rule['regex'].pattern)
+
+    return violations
+
+
+def analyze_service_instances(svc_inst, svc_info, owner_cache=None, cache_stats=None,
+                              since=None, ct_client=None, deadline=None):
     """
-    Parse instances, finding wayward cows
+    Parse instances, finding wayward cows: those violating the cowdef's
+    rules, which are compiled once per call. Each cow records its
+    'violations'.
+    svc_inst may be a generator; only the cows are kept.
+    Owners are resolved through owner_cache, so only ids not already
+    attributed trigger a CloudTrail lookup. With BulkAttribution set, new
+    ids are first resolved from one pass over creation events since the
+    epoch 'since'. Owners not resolved before the deadline (if any) are
+    left empty, for a later run.
     """
     badcows = []
-    badinstid = []
+    badinstid = set()
+    rules = compile_rules(svc_info)
+    if owner_cache is None:
+        owner_cache = {}
+    if cache_stats is None:
+        cache_stats = defaultdict(int)
+    now_sec = int(time())
     for inst in svc_inst:
-        for keyreq in svc_info['CowKeyChecklist']:
-            if keyreq not in inst['tags'] and \
-               inst['id'] not in badinstid:
-                inst['username'] = get_cloudtrail_username(inst['id'])
-                badcows.append(inst)
-                badinstid.append(inst['id'])
+        if inst['id'] in badinstid:
+            continue
+        violations = cow_violations(rules, inst)
+        if violations:
+            inst['violations'] = violations
+            badcows.append(inst)
+            badinstid.add(inst['id'])
+
+    with timed_phase('Attribution'):
+        owner_index = None
+        event_name = svc_info.get('CreateEventName', CREATE_EVENTS.get(svc_info['Service']))
+        if svc_info.get('BulkAttribution') and event_name and not out_of_time(deadline) and \
+           [c for c in badcows if not owner_is_cached(owner_cache.get(c['id']), now_sec)]:
+            if since:
+                start_time = since - BULK_ATTRIBUTION_OVERLAP
+            else:
+                start_time = now_sec - BULK_ATTRIBUTION_WINDOW
+            owner_index = build_cloudtrail_owner_index(event_name, start_time, ct_client)
+
+        for inst in badcows:
+            if out_of_time(deadline):
+                inst.setdefault('username', '')
+                continue
+            inst['username'] = lookup_owner(inst['id'], owner_cache, now_sec,
+                                            cache_stats, owner_index, ct_client)
 
     return badcows
 
 
-def format_report(cow_list, svc_info):
+def discovery_text(cow):
     """
-    Given a service's roundup, return a string representation for email
+    Return the display string of a cow's initial discovery
     """
-    output = 'Service: ' + svc_info['Service']
-    output += '\n  CowCatcher run: ' + cow_list['last_run']
-    if cow_list['cows']:
-        output += '\n  Actions: '
-        if cow_list['action_summary']:
-            for change in cow_list['action_summary']:
-                output += '\n    ' + change + ':   ' + str(cow_list['action_summary'][change])
-        else:
-            output += 'None'
-        output += '\n  Untagged instances: '
+    if cow.get('initial_discovery_str'):
+        return cow['initial_discovery_str']
+    return strftime('%c', localtime(cow['initial_discovery']))
+
+
+def iter_text_report(sections, full_report=None):
+    """
+    Yield the text report of each (roundup, svc_info, scope) section:
+    a header, then one chunk per cow, then a footer.
+    Delta sections also list the cows that left the herd, and the report
+    ends with a link to the full_report, if given.
+    """
+    for cow_list, svc_info, scope in sections:
+        output = ['Service: ', svc_info['Service']]
+        if scope:
+            output.extend([' (', scope, ')'])
+        output.extend(['\n  CowCatcher run: ', cow_list['last_run']])
+        if not cow_list['cows'] and not cow_list.get('gone'):
+            output.append('\n  No untagged instances.\n\n')
+            yield ''.join(output)
+            continue
+        if cow_list['cows']:
+            output.append('\n  Actions: ')
+            if cow_list['action_summary']:
+                for change in cow_list['action_summary']:
+                    output.extend(['\n    ', change, ':   ',
+                                   str(cow_list['action_summary'][change])])
+            else:
+                output.append('None')
+            output.append('\n  Untagged instances: ')
+        yield ''.join(output)
+
         for cow in cow_list['cows']:
-            output += '\n    ID:      ' + cow['id']
+            output = ['\n    ID:      ', cow['id']]
             if 'username' in cow and cow['username']:
-                output += '\n      User:   ' + cow['username']
+                output.extend(['\n      User:   ', cow['username']])
             if cow['state']:
-                output += '\n      State:   ' + cow['state']
+                output.extend(['\n      State:   ', cow['state']])
             if svc_info['InstType']:
                 if cow['type']:
-                    output += '\n      Type:    ' + cow['type']
-            output += '\n      Found:   ' + cow['initial_discovery']
+                    output.extend(['\n      Type:    ', cow['type']])
+            output.extend(['\n      Found:   ', discovery_text(cow)])
             if cow['tags']:
-                output += '\n      Tags:'
+                output.append('\n      Tags:')
                 for tag in cow['tags']:
-                    output += '\n           '
-                    output += tag + ' : ' + cow['tags'][tag]
+                    output.extend(['\n           ', tag, ' : ', cow['tags'][tag]])
+            if cow.get('violations'):
+                output.append('\n      Violations:')
+                for violation in cow['violations']:
+                    output.extend(['\n        ', violation])
             if cow['action_history']:
-                output += '\n      History: '
+                output.append('\n      History: ')
                 for action in cow['action_history']:
-                    output += '\n        ' + action
-    else:
-        output += '\n  No untagged instances.'
-    output += '\n\n'
-
-    return output
+                    output.extend(['\n        ', action])
+            yield ''.join(output)
+        if cow_list.get('gone'):
+            yield '\n  Left the herd: '
+            for cow in cow_list['gone']:
+                output = ['\n    ID:      ', cow['id']]
+                if cow.get('username'):
+                    output.extend(['\n      User:   ', cow['username']])
+                yield ''.join(output)
+        yield '\n\n'
+    if full_report:
+        yield 'Full report: ' + full_report + '\n'
 
 
-def get_tag_keys(key_list):
+def iter_json_report(sections, full_report=None):
     """
-    Return a dict of tags with non-null values
+    Yield a JSON document of each (roundup, svc_info, scope) section,
+    one chunk per cow
     """
-    return {i['Key']:i['Value'] for i in key_list if i['Value']}
+    if full_report:
+        yield '{"full_report": ' + json.dumps(full_report) + ', "services": ['
+    else:
+        yield '{"services": ['
+    for idx, (cow_list, svc_info, scope) in enumerate(sections):
+        header = {'service': svc_info['Service'], 'scope': scope,
+                  'last_run': cow_list['last_run'],
+                  'action_summary': cow_list['action_summary']}
+        if 'gone' in cow_list:
+            header['gone'] = cow_list['gone']
+        # Open the service object, leaving its cows list to be streamed
+        yield (',' if idx else '') + json.dumps(header, sort_keys=True)[:-1] + ', "cows": ['
+        for cidx, cow in enumerate(cow_list['cows']):
+            yield (',' if cidx else '') + json.dumps(cow, ensure_ascii=False, sort_keys=True)
+        yield ']}'
+    yield ']}\n'
 
 
-def discover_instance_tags(instances, svc_client, svc_info):
+def iter_html_report(sections, full_report=None):
     """
-    Retrieve tags from the given instances
+    Yield an HTML page of each (roundup, svc_info, scope) section,
+    one table row per cow
     """
-    discoveries = []
-    for inst in instances:
-        stats = {}
-        stats['id'] = inst[svc_info['InstanceId']]
-        if svc_info['InstType']:
-            stats['type'] = inst[svc_info['InstType']]
-        # If state is in dict of dict
-        if svc_info['InstStateChild']:
-            tmp = inst[svc_info['InstStateParent']]
-            if isinstance(tmp, list):
-                # handle autoscale, etc. by choosing first instance
-                try:
-                    tmp = tmp[0]
-                except IndexError:
-                    tmp = {}
-                    tmp[svc_info['InstStateChild']] = 'NoInstances'
-
-            stats['state'] = tmp[svc_info['InstStateChild']]
-        else:
-            stats['state'] = inst[svc_info['InstStateParent']]
-        # Requires another API call
-        if svc_info['DiscoverTags']:
-            cmd = 'svc_client.' + svc_info['DiscoverTags']
-            if svc_info['DiscoverTagsInstParm']:
-                cmd += 'inst["' + svc_info['DiscoverTagsInstParm'] + '"]'
-            cmd += ')'
-            response = eval(cmd)
-            try:
-                stats['tags'] = get_tag_keys(response[svc_info['TagsKey']])
-            except KeyError:
-                stats['tags'] = {}
-        else:
-            try:
-                stats['tags'] = get_tag_keys(inst[svc_info['TagsKey']])
-            except KeyError:
-                stats['tags'] = {}
+    try:
+        from html import escape
+    except ImportError:
+        from cgi import escape
+    yield '<html><body>\n'
+    for cow_list, svc_info, scope in sections:
+        output = ['<h2>Service: ', escape(svc_info['Service'])]
+        if scope:
+            output.extend([' (', escape(scope), ')'])
+        output.extend(['</h2>\n<p>CowCatcher run: ', escape(cow_list['last_run']), '</p>\n'])
+        if cow_list.get('gone'):
+            output.append('<p>Left the herd: ' +
+                          ', '.join(escape(cow['id']) for cow in cow_list['gone']) + '</p>\n')
+        if not cow_list['cows']:
+            if not cow_list.get('gone'):
+                output.append('<p>No untagged instances.</p>\n')
+            yield ''.join(output)
+            continue
+        output.append('<p>Actions: ')
+        output.append(', '.join(escape(change) + ': ' + str(count) for change, count
+                                in cow_list['action_summary'].items()) or 'None')
+        output.append('</p>\n<table>\n<tr><th>ID</th><th>User</th><th>State</th>'
+                      '<th>Type</th><th>Found</th><th>Tags</th><th>Violations</th>'
+                      '<th>History</th></tr>\n')
+        yield ''.join(output)
+        for cow in cow_list['cows']:
+            cells = [cow['id'], cow.get('username') or '', cow['state'] or '',
+                     cow.get('type') or '', discovery_text(cow)]
+            output = ['<tr>']
+            output.extend('<td>' + escape(cell) + '</td>' for cell in cells)
+            for lines in (sorted(tag + ' : ' + val for tag, val in cow['tags'].items()),
+                          cow.get('violations', []), cow['action_history']):
+                output.append('<td>' + '<br>'.join(escape(line) for line in lines) + '</td>')
+            output.append('</tr>\n')
+            yield ''.join(output)
+        yield '</table>\n'
+    if full_report:
+        yield '<p><a href="' + escape(full_report) + '">Full report</a></p>\n'
+    yield '</body></html>\n'
 
-        discoveries.append(stats)
 
-    return discoveries
+REPORT_RENDERERS = {'text': iter_text_report,
+                    'json': iter_json_report,
+                    'html': iter_html_report}
 
-def parse_service_response(response, inst_iter1, inst_iter2):
+
+def render_report(sections, out, fmt='text', full_report=None):
     """
-    Handle paginated response from service
+    Write the report of (roundup, svc_info, scope) sections in format
+    fmt to out, any object with a write method. Chunks are written as
+    they are rendered, so cost is linear in cows and history lines.
     """
-    inst = []
-    if inst_iter2:
-        # Two levels of lists
-        for tmp in response[inst_iter1]:
-            for tmp2 in tmp[inst_iter2]:
-                inst.append(tmp2)
-    elif inst_iter1:
-        for tmp in response[inst_iter1]:
-            inst.append(tmp)
-    else:
-        inst = response
-
-    return inst
+    for chunk in REPORT_RENDERERS[fmt](sections, full_report):
+        out.write(chunk)
 
 
-def get_service_instance_tags(svc_client, svc_info):
+def report_string(sections, fmt='text', full_report=None):
     """
-    Retrieve instances for the given service,
-    Flattening AWS structure if necessary
+    Return the rendered report of sections as one string
     """
-    instances = []
+    return ''.join(REPORT_RENDERERS[fmt](sections, full_report))
 
-    paginator = svc_client.get_paginator(svc_info['DiscoverInstance'])
-    if svc_info['InstanceFilters']:
-        for response in paginator.paginate(Filters=svc_info['InstanceFilters']):
-            instances.extend(parse_service_response(response, svc_info['InstanceIterator1'],
-                                                    svc_info['InstanceIterator2']))
-    else:
-        for response in paginator.paginate():
-            instances.extend(parse_service_response(response, svc_info['InstanceIterator1'],
-                                                    svc_info['InstanceIterator2']))
 
-    return discover_instance_tags(instances, svc_client, svc_info)
+def delta_sections(sections):
+    """
+    Return sections reduced to what changed since the previous roundup:
+    new cows, cows whose action fired and cows that left the herd.
+    Sections without changes are dropped.
+    """
+    changed = []
+    for cow_list, svc_info, scope in sections:
+        delta = cow_list.get('delta')
+        if not delta or not (delta['new'] or delta['gone'] or delta['actioned']):
+            continue
+        changed_ids = set(delta['new']) | set(delta['actioned'])
+        view = dict(cow_list, gone=delta['gone'],
+                    cows=[cow for cow in cow_list['cows'] if cow['id'] in changed_ids])
+        changed.append((view, svc_info, scope))
+    return changed
 
 
-def get_cloudtrail_username(rsc_name):
+def save_report(report_text, bucket, key):
     """
-    Given resource name, search cloudtrail for oldest record, return username
-    associated with record.
+    Save a rendered report to S3, returning a link to it
     """
+    fmt = 'text'
+    for key_fmt, ext in REPORT_EXTENSIONS.items():
+        if key.endswith(ext):
+            fmt = key_fmt
+    get_client('s3').put_object(Bucket=bucket, Key=key, Body=report_text.encode('utf-8'),
+                                ContentType=REPORT_CONTENT_TYPES[fmt])
+    return 'https://s3.console.aws.amazon.com/s3/object/' + bucket + '?prefix=' + key
+
+
+def publish_report(sections, team_info, svc_info, now_str, report_key):
+    """
+    Publish the report of sections to svc_info's CowReportARN, if it has
+    cows. With ReportMode 'delta', only changes since the previous run
+    are published (nothing if none), and the full report is saved to
+    the team Bucket under report_key and linked.
+    Reports too large for MaxReportParts SNS messages are saved to the
+    Bucket and linked instead; JSON and HTML are never split into parts.
+    """
+    fmt = team_info.get('ReportFormat', 'text')
+    max_parts = team_info.get('MaxReportParts', DEFAULT_MAX_REPORT_PARTS)
+    if fmt != 'text':
+        max_parts = 1
+    link = None
+    if team_info.get('ReportMode', 'full') != 'delta':
+        if not any(section[0]['cows'] for section in sections):
+            return None
+    else:
+        changed = delta_sections(sections)
+        if not changed:
+            return None
+        link = save_report(report_string(sections, fmt), team_info['Bucket'],
+                           report_key + REPORT_EXTENSIONS[fmt])
+        sections = changed
+
+    chunks = list(REPORT_RENDERERS[fmt](sections, link))
+    return send_report(chunks, svc_info, now_str, team_info['Bucket'],
+                       report_key + '-message' + REPORT_EXTENSIONS[fmt], max_parts)
+
+
+def format_report(cow_list, svc_info, scope=''):
+    """
+    Given a service's roundup, return a string representation for email
+    """
+    return report_string([(cow_list, svc_info, scope)])
+
+
+def get_tag_keys(key_list):
+    """
+    Return a dict of tags with non-null values
+    """
+    return {i['Key']:i['Value'] for i in key_list if i['Value']}
+
+
+def start_metrics(service):
+    """
+    Start collecting phase timings and API calls for service on this
+    thread; return the metrics dict
+    """
+    metrics = {'service': service, 'start': time(), 'phases': defaultdict(float),
+               'api': defaultdict(lambda: defaultdict(int))}
+    METRICS.current = metrics
+    return metrics
+
+
+def current_metrics():
+    """
+    Return the metrics being collected on this thread, or None
+    """
+    return getattr(METRICS, 'current', None)
+
+
+def bind_metrics(func):
+    """
+    Return func, recording into the calling thread's metrics when a
+    pool runs it on another thread
+    """
+    metrics = current_metrics()
+
+    def bound(*args):
+        """ func, with the caller's metrics """
+        METRICS.current = metrics
+        try:
+            return func(*args)
+        finally:
+            METRICS.current = None
+    return bound
+
+
+@contextmanager
+def timed_phase(phase):
+    """
+    Add the wall time of the with block to phase of this thread's metrics
+    """
+    start = time()
+    try:
+        yield
+    finally:
+        metrics = current_metrics()
+        if metrics is not None:
+            with METRICS_LOCK:
+                metrics['phases'][phase] += time() - start
+
+
+def record_api_call(parsed, model, **kwargs):
+    """
+    botocore after-call hook: count the call, botocore's own retries
+    and a final throttle against its operation
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        return
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    with METRICS_LOCK:
+        counts = metrics['api'][model.name]
+        counts['Calls'] += 1
+        counts['Retries'] += retries
+        if parsed.get('Error', {}).get('Code') in THROTTLE_CODES:
+            counts['Throttles'] += 1
+
+
+def record_retry(api_call):
+    """
+    Count a call_with_backoff retry of the client method api_call
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        return
+    name = getattr(api_call, '__name__', 'Unknown')
+    client = getattr(api_call, '__self__', None)
+    if client is not None:
+        name = client.meta.method_to_api_mapping.get(name, name)
+    with METRICS_LOCK:
+        metrics['api'][name]['Retries'] += 1
+
+
+def emf_line(metrics, dimensions, properties=None):
+    """
+    Return metrics as one CloudWatch Embedded Metric Format JSON line,
+    with the given {name: value} dimensions: a time per phase, API
+    totals and calls per second, and calls/retries/throttles per
+    operation
+    """
+    values = {}
+    for phase in METRIC_PHASES:
+        values[phase + 'Time'] = (round(metrics['phases'].get(phase, 0.0) * 1000, 3),
+                                  'Milliseconds')
+    elapsed = time() - metrics['start']
+    values['TotalTime'] = (round(elapsed * 1000, 3), 'Milliseconds')
+    for counter in ('Calls', 'Retries', 'Throttles'):
+        values['Api' + counter] = (sum(counts[counter] for counts
+                                       in metrics['api'].values()), 'Count')
+    values['ApiCallRate'] = (round(values['ApiCalls'][0] / max(elapsed, 1e-6), 3),
+                             'Count/Second')
+    for operation, counts in sorted(metrics['api'].items()):
+        for counter in ('Calls', 'Retries', 'Throttles'):
+            values[operation + counter] = (counts[counter], 'Count')
+    for name, value in metrics.get('counts', {}).items():
+        values[name] = (value, 'Count')
+
+    line = dict(properties or {})
+    line.update(dimensions)
+    line['_aws'] = {'Timestamp': int(time() * 1000),
+                    'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE,
+                                           'Dimensions': [sorted(dimensions)],
+                                           'Metrics': [{'Name': name, 'Unit': unit}
+                                                       for name, (_, unit)
+                                                       in sorted(values.items())]}]}
+    for name, (value, _) in values.items():
+        line[name] = value
+    return json.dumps(line, sort_keys=True)
+
+
+def emit_metrics(metrics, dimensions, properties=None):
+    """
+    Write metrics to stdout as an EMF line; CloudWatch Logs extracts
+    the metrics without any API call
+    """
+    sys.stdout.write(emf_line(metrics, dimensions, properties) + '\n')
+    sys.stdout.flush()
+
+
+def start_governor(team_info):
+    """
+    Start a run's API accounting: reset the counters, set team_info's
+    ApiBudget (calls per invocation) and apply its ApiRates, ceilings in
+    calls per second by 'service' or 'service.Operation'
+    """
+    with GOVERNOR_LOCK:
+        GOVERNOR.update(rates=dict(team_info.get('ApiRates') or {}),
+                        budget=team_info.get('ApiBudget'), used=0, waited=0.0,
+                        throttles=0, start=time())
+        for key, bucket in GOVERNOR['buckets'].items():
+            bucket['ceiling'] = api_rate_ceiling(key[0], key[3])
+            if bucket['ceiling'] and (bucket['rate'] is None or
+                                      bucket['rate'] > bucket['ceiling']):
+                bucket['rate'] = bucket['ceiling']
+
+
+def api_rate_ceiling(service, operation):
+    """
+    Return the ApiRates ceiling of an operation, or None
+    """
+    rates = GOVERNOR['rates']
+    rate = rates.get(service + '.' + operation, rates.get(service))
+    return float(rate) if rate else None
+
+
+def rate_bucket(key):
+    """
+    Return the token bucket of key, (service, region, role ARN,
+    operation), creating it full; call with GOVERNOR_LOCK held
+    """
+    bucket = GOVERNOR['buckets'].get(key)
+    if bucket is None:
+        ceiling = api_rate_ceiling(key[0], key[3])
+        bucket = GOVERNOR['buckets'][key] = {
+            'rate': ceiling, 'ceiling': ceiling, 'tokens': max(1.0, ceiling or 0),
+            'stamp': time(), 'cut': 0.0, 'first': None, 'seen': 0.0, 'recent': 0.0}
+    return bucket
+
+
+def observed_rate(bucket, now):
+    """
+    Return the calls per second recently made through bucket: its calls
+    decayed over GOVERNOR_RATE_WINDOW, divided by the decayed time they
+    were made in (at least a second); call with GOVERNOR_LOCK held
+    """
+    if bucket['first'] is None:
+        return 0.0
+    recent = bucket['recent'] * exp(-(now - bucket['seen']) / GOVERNOR_RATE_WINDOW)
+    elapsed = max(1.0, now - bucket['first'])
+    return recent / (GOVERNOR_RATE_WINDOW * (1 - exp(-elapsed / GOVERNOR_RATE_WINDOW)))
+
+
+def acquire_token(key):
+    """
+    Wait until key's bucket allows another call, and count the call
+    against the run's budget; the wait is added to the RateWait phase
+    """
+    with GOVERNOR_LOCK:
+        bucket = rate_bucket(key)
+        now = time()
+        # smoothed count of recent calls, to start from on a first throttle
+        if bucket['first'] is None:
+            bucket['first'] = now
+        bucket['recent'] = bucket['recent'] * exp(-(now - bucket['seen']) /
+                                                  GOVERNOR_RATE_WINDOW) + 1
+        bucket['seen'] = now
+        GOVERNOR['used'] += 1
+        wait = 0.0
+        if bucket['rate']:
+            bucket['tokens'] = min(max(1.0, bucket['rate']),
+                                   bucket['tokens'] + (now - bucket['stamp']) * bucket['rate'])
+            bucket['stamp'] = now
+            bucket['tokens'] -= 1
+            if bucket['tokens'] < 0:
+                wait = -bucket['tokens'] / bucket['rate']
+                GOVERNOR['waited'] += wait
+    if wait:
+        sleep(wait)
+        metrics = current_metrics()
+        if metrics is not None:
+            with METRICS_LOCK:
+                metrics['phases']['RateWait'] += wait
+
+
+def adjust_rate(key, throttled):
+    """
+    Halve key's rate on a throttle, from its smoothed observed rate (see
+    observed_rate) if it was unlimited; otherwise raise it by GOVERNOR_INCREASE, up to its
+    ceiling
+    """
+    with GOVERNOR_LOCK:
+        bucket = rate_bucket(key)
+        if throttled:
+            GOVERNOR['throttles'] += 1
+            now = time()
+            if now - bucket['cut'] < GOVERNOR_CUT_INTERVAL:
+                return
+            rate = bucket['rate'] or observed_rate(bucket, now)
+            bucket['rate'] = max(MIN_API_RATE, rate * GOVERNOR_DECREASE)
+            bucket['tokens'] = min(bucket['tokens'], 1.0)
+            bucket['cut'] = now
+            Logger.info('Throttled: %s %s now limited to %.2f calls/s', key[0], key[3],
+                        bucket['rate'])
+        elif bucket['rate']:
+            bucket['rate'] += GOVERNOR_INCREASE
+            if bucket['ceiling'] and bucket['rate'] > bucket['ceiling']:
+                bucket['rate'] = bucket['ceiling']
+
+
+def budget_spent():
+    """
+    Return True once the run has made its ApiBudget of calls
+    """
+    return bool(GOVERNOR['budget']) and GOVERNOR['used'] >= GOVERNOR['budget']
+
+
+def governor_hooks(service, region=None, role_arn=None):
+    """
+    Return the (event, handler) pairs passing a client's calls through
+    the rate governor: before-call waits for a token, needs-retry reports
+    each throttled attempt botocore makes, and after-call reports the
+    outcome of the call
+    """
+    def before_call(model, **kwargs):
+        """ wait for a token """
+        acquire_token((service, region, role_arn, model.name))
+
+    def needs_retry(response, operation, **kwargs):
+        """ report a throttled attempt """
+        if response and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            adjust_rate((service, region, role_arn, operation.name), True)
+
+    def after_call(parsed, model, **kwargs):
+        """ report the call's outcome """
+        throttled = parsed.get('Error', {}).get('Code') in THROTTLE_CODES
+        # needs-retry saw the throttles of responses botocore received itself
+        if throttled and 'RetryAttempts' in parsed.get('ResponseMetadata', {}):
+            return
+        adjust_rate((service, region, role_arn, model.name), throttled)
+
+    return [('before-call', before_call), ('needs-retry', needs_retry),
+            ('after-call', after_call)]
+
+
+def governor_summary():
+    """
+    Return the run's API calls, calls per second, seconds spent waiting
+    for the rate governor, throttles, budget, and the learned rates
+    """
+    with GOVERNOR_LOCK:
+        elapsed = max(time() - GOVERNOR['start'], 1e-6)
+        rates = {}
+        for (service, _, _, operation), bucket in GOVERNOR['buckets'].items():
+            name = service + '.' + operation
+            if bucket['rate'] and (name not in rates or bucket['rate'] < rates[name]):
+                rates[name] = round(bucket['rate'], 2)
+        return {'calls': GOVERNOR['used'],
+                'calls_per_second': round(GOVERNOR['used'] / elapsed, 2),
+                'rate_wait_seconds': round(GOVERNOR['waited'], 3),
+                'throttles': GOVERNOR['throttles'], 'budget': GOVERNOR['budget'],
+                'rates': rates}
+
+
+def call_with_backoff(api_call, **kwargs):
+    """
+    Call an AWS API, retrying throttled requests with jittered
+    exponential backoff
+    """
+    attempt = 0
+    while True:
+        try:
+            return api_call(**kwargs)
+        except ClientError as err:
+            attempt += 1
+            if err.response['Error']['Code'] not in THROTTLE_CODES or \
+               attempt >= MAX_API_ATTEMPTS:
+                raise
+            record_retry(api_call)
+            sleep(uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+def parse_tag_call(discover_tags):
+    """
+    Split a DiscoverTags call prefix such as
+    'list_tags_for_resource(ResourceName=' into its method and parameter
+    """
+    method, _, param = discover_tags.partition('(')
+    return method.strip(), param.rstrip('= ')
+
+
+def tags_at(container, tags_key):
+    """
+    Return the tags listed under tags_key of container, as a dict
+    """
+    try:
+        return get_tag_keys(container[tags_key])
+    except KeyError:
+        return {}
+
+
+def state_getter(parent, child):
+    """
+    Return a function reading an instance's state from its parent key, or
+    its child key under it. Whether parent holds a list (as for
+    autoscaling, where the first instance's state is used) is decided on
+    the first instance.
+    """
+    if not child:
+        return itemgetter(parent)
+
+    def nested(inst):
+        """ state of a dict under parent """
+        return inst[parent][child]
+
+    def first_of(inst):
+        """ state of the first of a list under parent """
+        items = inst[parent]
+        return items[0][child] if items else 'NoInstances'
+
+    def detect(inst):
+        """ pick nested or first_of for this and later instances """
+        getter[0] = first_of if isinstance(inst[parent], list) else nested
+        return getter[0](inst)
+
+    getter = [detect]
+    return lambda inst: getter[0](inst)
+
+
+def compile_extractor(svc_info):
+    """
+    Compile the EXTRACTOR_FIELDS of a cowdef into a function binding a
+    service client (and optional tag_index) to an extractor: a function
+    returning the id, type, state and tags of an instance
+    """
+    get_id = itemgetter(svc_info['InstanceId'])
+    type_key = svc_info['InstType']
+    tags_key = svc_info['TagsKey']
+    parent, child = svc_info['InstStateParent'], svc_info['InstStateChild']
+    tag_call = parse_tag_call(svc_info['DiscoverTags']) if svc_info['DiscoverTags'] else None
+    arg_key = svc_info['DiscoverTagsInstParm']
+
+    def bind(svc_client=None, tag_index=None):
+        """ extractor of instances described by svc_client """
+        state_of = state_getter(parent, child)
+        if tag_index is not None:
+            tags_of = lambda inst, rsc_id: tag_index.get(rsc_id, {})
+        # Requires another API call
+        elif tag_call:
+            method = getattr(svc_client, tag_call[0])
+            if arg_key:
+                param = tag_call[1]
+                tags_of = lambda inst, rsc_id: tags_at(
+                    call_with_backoff(method, **{param: inst[arg_key]}), tags_key)
+            else:
+                tags_of = lambda inst, rsc_id: tags_at(call_with_backoff(method), tags_key)
+        else:
+            tags_of = lambda inst, rsc_id: tags_at(inst, tags_key)
+
+        if type_key:
+            def extract(inst):
+                """ id/type/state/tags of inst """
+                rsc_id = get_id(inst)
+                return {'id': rsc_id, 'type': inst[type_key], 'state': state_of(inst),
+                        'tags': tags_of(inst, rsc_id)}
+        else:
+            def extract(inst):
+                """ id/state/tags of inst """
+                rsc_id = get_id(inst)
+                return {'id': rsc_id, 'state': state_of(inst), 'tags': tags_of(inst, rsc_id)}
+        return extract
+
+    return bind
+
+
+def instance_extractor(svc_info):
+    """
+    Return the compiled extractor binder of svc_info (see
+    compile_extractor), compiling it on first use
+    """
+    key = tuple(svc_info[field] for field in EXTRACTOR_FIELDS)
+    bind = EXTRACTORS.get(key)
+    if bind is None:
+        bind = EXTRACTORS[key] = compile_extractor(svc_info)
+    return bind
+
+
+def instance_stats(inst, svc_client, svc_info, tag_index=None):
+    """
+    Retrieve id, type, state and tags for a single instance.
+    With a tag_index, tags are joined from it by id.
+    """
+    return instance_extractor(svc_info)(svc_client, tag_index)(inst)
+
+
+def tag_discovery_pool(svc_info, tag_index=None):
+    """
+    Return a thread pool for per-instance tag calls, or None when tags
+    are discovered serially
+    """
+    concurrency = svc_info.get('DiscoverTagsConcurrency', 1)
+    if tag_index is None and svc_info['DiscoverTags'] and concurrency > 1:
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool(concurrency)
+    return None
+
+
+def discover_instance_tags(instances, svc_client, svc_info, tag_index=None, pool=None):
+    """
+    Retrieve tags from the given instances.
+    When tags need a call per instance, DiscoverTagsConcurrency calls are
+    made at once (on pool, if given); results keep the order of instances.
+    """
+    extract = instance_extractor(svc_info)(svc_client, tag_index)
+    if tag_index is not None:
+        return [extract(inst) for inst in instances]
+
+    own_pool = pool is None
+    if own_pool and len(instances) > 1:
+        pool = tag_discovery_pool(svc_info)
+    if pool is not None:
+        try:
+            return pool.map(bind_metrics(extract), instances)
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+
+    return [extract(inst) for inst in instances]
+
+
+def parse_service_response(response, inst_iter1, inst_iter2):
+    """
+    Handle paginated response from service
+    """
+    inst = []
+    if inst_iter2:
+        # Two levels of lists
+        for tmp in response[inst_iter1]:
+            for tmp2 in tmp[inst_iter2]:
+                inst.append(tmp2)
+    elif inst_iter1:
+        for tmp in response[inst_iter1]:
+            inst.append(tmp)
+    else:
+        inst = response
+
+    return inst
+
+
+def arn_resource_id(arn):
+    """
+    Return the trailing resource id of an ARN (or the name itself)
+    """
+    return arn.split('/')[-1].split(':')[-1]
+
+
+def get_tagging_index(tag_client, resource_type):
+    """
+    Return a resource id -> tags index of every resource_type resource,
+    from the Resource Groups Tagging API
+    """
+    index = {}
+    paginator = tag_client.get_paginator('get_resources')
+    for response in paginator.paginate(ResourceTypeFilters=[resource_type]):
+        for rsc in response['ResourceTagMappingList']:
+            index[arn_resource_id(rsc['ResourceARN'])] = get_tag_keys(rsc.get('Tags', []))
+
+    return index
+
+
+def iter_service_instances(svc_client, svc_info, page_state=None):
+    """
+    Yield each page of instances for the given service,
+    Flattening AWS structure if necessary.
+    With a page_state dict, paging starts at its 'token' (if any), keeps
+    there the token of the next page, and sets 'stopped' instead of
+    fetching a page once its 'deadline' has passed.
+    """
+    if page_state is None:
+        page_state = {}
+    paginator = svc_client.get_paginator(svc_info['DiscoverInstance'])
+    kwargs = {}
+    if svc_info['InstanceFilters']:
+        kwargs['Filters'] = svc_info['InstanceFilters']
+    if page_state.get('token'):
+        kwargs['PaginationConfig'] = {'StartingToken': page_state['token']}
+    page_iter = paginator.paginate(**kwargs)
+    pages = iter(page_iter)
+    first = True
+    while True:
+        if out_of_time(page_state.get('deadline')):
+            page_state['stopped'] = True
+            return
+        with timed_phase('Pagination'):
+            try:
+                response = next(pages, None)
+            except (ClientError, ValueError) as err:
+                if not (first and 'PaginationConfig' in kwargs):
+                    raise
+                # The checkpointed token expired; page from the start
+                Logger.warning('Cannot resume %s paging, restarting: %s',
+                               svc_info['Service'], err)
+                del kwargs['PaginationConfig']
+                page_iter = paginator.paginate(**kwargs)
+                pages = iter(page_iter)
+                response = next(pages, None)
+        first = False
+        if response is None:
+            page_state['token'] = None
+            return
+        page_state['token'] = page_token(page_iter, response)
+        yield parse_service_response(response, svc_info['InstanceIterator1'],
+                                     svc_info['InstanceIterator2'])
+
+
+def iter_service_instance_tags(svc_client, svc_info, tag_client=None, page_state=None):
+    """
+    Yield the id/type/state/tags record of each instance of the given
+    service, a page at a time, so raw describe pages are not kept.
+    With TagEngine 'tagging', tags for the whole service come from one
+    Resource Groups Tagging API scan instead of the describe/tag calls.
+    page_state is passed on to iter_service_instances.
+    """
+    tag_index = None
+    if svc_info.get('TagEngine', 'describe') == 'tagging':
+        if tag_client is None:
+            tag_client = get_client('resourcegroupstaggingapi')
+        rsc_type = svc_info.get('TaggingResourceType',
+                                TAGGING_RESOURCE_TYPES.get(svc_info['Service']))
+        with timed_phase('TagDiscovery'):
+            tag_index = get_tagging_index(tag_client, rsc_type)
+
+    pool = tag_discovery_pool(svc_info, tag_index)
+    try:
+        for page in iter_service_instances(svc_client, svc_info, page_state):
+            with timed_phase('TagDiscovery'):
+                page = discover_instance_tags(page, svc_client, svc_info,
+                                              tag_index, pool)
+            for stats in page:
+                yield stats
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def get_service_instance_tags(svc_client, svc_info, tag_client=None):
+    """
+    Retrieve instances for the given service, with their tags
+    """
+    return list(iter_service_instance_tags(svc_client, svc_info, tag_client))
+
+
+def shard_of(rsc_id, count):
+    """
+    Return the shard, out of count, of a resource id: its CRC-32, so
+    every worker and run agrees
+    """
+    return (zlib.crc32(rsc_id.encode('utf-8')) & 0xffffffff) % count
+
+
+def trim_instance(inst, svc_info):
+    """
+    Return the fields of a described instance its extractor reads (id,
+    type, state and the DiscoverTags argument), small enough to send to
+    a shard worker
+    """
+    return dict((svc_info[field], inst[svc_info[field]])
+                for field in ('InstanceId', 'InstType', 'InstStateParent',
+                              'DiscoverTagsInstParm')
+                if svc_info.get(field) and svc_info[field] in inst)
+
+
+def scan_shard(event, context=None):
+    """
+    Shard worker: discover the tags of one shard's instances and return
+    its cows. event holds the CowDefs file, RoleArn, Region, Shard
+    ([index, count]), the shard's Instances (see trim_instance) and the
+    coordinator's Deadline (epoch or None). A shard not tagged in full
+    raises, so the coordinator keeps its old cows.
+    """
+    team_info = load_definition_file(TEAM_FILEPATH)
+    svc_info = load_definition_file(DEFS_PATH + event['CowDefs'])
+    role_arn, region = event.get('RoleArn'), event.get('Region')
+    index, count = event['Shard']
+    deadline = run_deadline(context, team_info.get('DeadlineMargin', DEADLINE_MARGIN))
+    if event.get('Deadline') and (deadline is None or event['Deadline'] < deadline):
+        deadline = event['Deadline']
+    used = GOVERNOR['used']
+    svc_client = get_client(svc_info['Service'], region, role_arn,
+                            max(DEFAULT_POOL_CONNECTIONS,
+                                svc_info.get('DiscoverTagsConcurrency', 1)))
+    rules = compile_rules(svc_info)
+    instances = event['Instances']
+    cows = []
+    pool = tag_discovery_pool(svc_info)
+    try:
+        for start in range(0, len(instances), SHARD_CHUNK):
+            if out_of_time(deadline):
+                raise RuntimeError('Out of time tagging shard %d of %d of %s' %
+                                   (index, count, event['CowDefs']))
+            cows.extend(inst for inst in discover_instance_tags(
+                instances[start:start + SHARD_CHUNK], svc_client, svc_info, None, pool)
+                        if cow_violations(rules, inst))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return {'Shard': index, 'Cows': cows, 'ApiCalls': GOVERNOR['used'] - used}
+
+
+def reset_worker_state():
+    """
+    Local pool initializer: forget the clients and locks a forked worker
+    inherits, as another thread may have held them at the fork
+    """
+    global CLIENT_LOCK, GOVERNOR_LOCK, METRICS_LOCK
+    CLIENT_LOCK, GOVERNOR_LOCK, METRICS_LOCK = RLock(), RLock(), RLock()
+    CLIENTS.clear()
+    SESSIONS.clear()
+    METRICS.current = None
+
+
+def local_shard(event):
+    """
+    scan_shard in a local pool process; a failure is returned as its
+    message, since not every botocore exception can be pickled back
+    """
+    try:
+        return scan_shard(event)
+    except Exception as err:
+        Logger.exception('Shard %d of %s failed', event['Shard'][0], event['CowDefs'])
+        return {'Shard': event['Shard'][0], 'Error': '%s: %s' % (type(err).__name__, err)}
+
+
+def invoke_shard(function, event):
+    """
+    Run scan_shard in an invocation of the Lambda function; a failure is
+    returned as its message
+    """
+    try:
+        response = get_client('lambda', read_timeout=SHARD_READ_TIMEOUT).invoke(
+            FunctionName=function, Payload=json.dumps(event))
+        result = json.loads(response['Payload'].read().decode('utf-8') or 'null')
+    except (ClientError, ValueError) as err:
+        result = {'errorMessage': str(err)}
+        response = {'FunctionError': 'Invoke'}
+    if response.get('FunctionError'):
+        return {'Shard': event['Shard'][0],
+                'Error': (result or {}).get('errorMessage') or response['FunctionError']}
+    return result
+
+
+def merge_shards(results, count):
+    """
+    Merge the results of count shards, in any order, into their cows
+    ordered by id, and the sorted indexes of the shards that failed
+    """
+    done = {}
+    for result in results:
+        if isinstance(result, dict) and 'Cows' in result:
+            done[result['Shard']] = result['Cows']
+    cows = sorted(chain.from_iterable(done.values()), key=itemgetter('id'))
+    return cows, [idx for idx in range(count) if idx not in done]
+
+
+def scan_shards(svc, svc_info, team_info, svc_client, page_state, records=None,
+                role_arn=None, region=None, found=None):
+    """
+    Page through a service's instances once, then discover their tags
+    in ShardCount shards at once, each on a worker running scan_shard:
+    an invocation of the team's ShardFunction (by default this Lambda
+    function) or, outside Lambda, a process of a local pool. records
+    (see trim_instance) left by a checkpointed run are scanned too.
+    Return the cows of the shards scanned, ordered by id, the indexes
+    of the shards that failed, and the records paged but not scanned:
+    when page_state stops paging, none are sent to workers. The state
+    of each record whose id is a key of found is set there.
+    """
+    count = svc_info['ShardCount']
+    records = list(records or [])
+    for page in iter_service_instances(svc_client, svc_info, page_state):
+        records.extend(trim_instance(inst, svc_info) for inst in page)
+    if page_state.get('stopped'):
+        return [], [], records
+
+    if found:
+        state_of = state_getter(svc_info['InstStateParent'], svc_info['InstStateChild'])
+        for rec in records:
+            if rec[svc_info['InstanceId']] in found:
+                found[rec[svc_info['InstanceId']]] = state_of(rec)
+
+    deadline = page_state.get('deadline')
+    if deadline == float('inf'):
+        deadline = None
+    shards = [[] for _ in range(count)]
+    for rec in records:
+        shards[shard_of(rec[svc_info['InstanceId']], count)].append(rec)
+    events = [{'CowDefs': svc, 'RoleArn': role_arn, 'Region': region,
+               'Shard': [idx, count], 'Deadline': deadline, 'Instances': shards[idx]}
+              for idx in range(count)]
+    function = team_info.get('ShardFunction') or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if function:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(count)
+        work = bind_metrics(lambda event: invoke_shard(function, event))
+    else:
+        from multiprocessing import Pool
+        pool = Pool(count, reset_worker_state)
+        work = local_shard
+    try:
+        results = pool.map(work, events)
+    finally:
+        pool.close()
+        pool.join()
+
+    cows, failed = merge_shards(results, count)
+    for result in results:
+        if isinstance(result, dict) and 'Error' in result:
+            Logger.error('Shard %s of %d of %s failed: %s', result['Shard'], count, svc,
+                         result['Error'])
+        elif isinstance(result, dict):
+            with GOVERNOR_LOCK:
+                GOVERNOR['used'] += result.get('ApiCalls', 0)
+    return cows, failed, []
+
+
+def get_cloudtrail_username(rsc_name, ct_client=None):
+    """
+    Given resource name, search cloudtrail for oldest record, return username
+    associated with record.
+    """
+    if ct_client is None:
+        ct_client = get_client('cloudtrail')
     username = ''
     events = []
 
     lookup = [{'AttributeKey':'ResourceName',
                'AttributeValue': rsc_name}]
-    paginator = CLDTRL_C.get_paginator('lookup_events')
+    paginator = ct_client.get_paginator('lookup_events')
     # walk through all records. This should only happen for new instances.
     for response in paginator.paginate(LookupAttributes=lookup):
         events.extend(response['Events'])
@@ -312,57 +2226,890 @@ def get_cloudtrail_username(rsc_name):
     return username
 
 
-def main(event, context):
+def load_owner_cache(roundup, now_sec):
+    """
+    Return the resource id -> owner cache kept with a roundup.
+    Roundups written before the cache existed are seeded from the
+    usernames already recorded on their cows.
+    """
+    owner_cache = {}
+    if roundup:
+        owner_cache.update(roundup.get('owners', {}))
+        for cow in roundup['cows']:
+            if cow.get('username') and cow['id'] not in owner_cache:
+                owner_cache[cow['id']] = {'username': cow['username'],
+                                          'checked': now_sec}
+    return owner_cache
+
+
+def owner_is_cached(entry, now_sec):
+    """
+    Attributed owners never expire; empty results are retried
+    once they are older than OWNER_NEGATIVE_TTL.
+    """
+    return bool(entry) and (bool(entry['username']) or
+                            now_sec - entry['checked'] < OWNER_NEGATIVE_TTL)
+
+
+def lookup_owner(rsc_name, owner_cache, now_sec, cache_stats, owner_index=None,
+                 ct_client=None):
+    """
+    Return the username owning rsc_name, searching CloudTrail only on a
+    cache miss. A bulk owner_index is consulted before falling back to a
+    per-resource lookup.
+    """
+    entry = owner_cache.get(rsc_name)
+    if owner_is_cached(entry, now_sec):
+        cache_stats['hits'] += 1
+        return entry['username']
+
+    cache_stats['misses'] += 1
+    if owner_index and owner_index.get(rsc_name):
+        cache_stats['indexed'] += 1
+        username = owner_index[rsc_name]
+    else:
+        username = get_cloudtrail_username(rsc_name, ct_client)
+    owner_cache[rsc_name] = {'username': username, 'checked': now_sec}
+    return username
+
+
+def build_cloudtrail_owner_index(event_name, start_time, ct_client=None):
     """
-    Main functionality
+    Page once through event_name events since epoch start_time, returning
+    a resource name -> username index of each resource's creator.
     """
-    all_issues = ''
-    herd_exist = False
+    if ct_client is None:
+        ct_client = get_client('cloudtrail')
+    index = {}
+    lookup = [{'AttributeKey':'EventName',
+               'AttributeValue': event_name}]
+    paginator = ct_client.get_paginator('lookup_events')
+    for response in paginator.paginate(LookupAttributes=lookup,
+                                       StartTime=start_time):
+        # Events arrive newest first, so older events overwrite newer ones
+        for event in response['Events']:
+            if 'Username' not in event or not event['Username']:
+                continue
+            for rsc in event.get('Resources', []):
+                index[rsc['ResourceName']] = event['Username']
+                # Index ARNs by their trailing resource id as well
+                index[arn_resource_id(rsc['ResourceName'])] = event['Username']
 
+    return index
+
+
+def roundup_last_run(roundup):
+    """
+    Return the epoch of the run that wrote roundup, or None
+    """
+    if not roundup:
+        return None
+    return roundup.get('last_run_epoch')
+
+
+def new_calendar():
+    """
+    Return a parsedatetime calendar. Calendars keep parse state,
+    so each thread uses its own.
+    """
+    import parsedatetime as pdt
     cons = pdt.Constants()
     cons.YearParseStyle = 0
-    pdtcal = pdt.Calendar(cons)
-    now_tm = pdtcal.parse("now")
-    now_str = strftime('%c', now_tm[0])
+    return pdt.Calendar(cons)
 
-    team_info = load_definition_file(TEAM_FILEPATH)
 
-    for svc in team_info['CowDefs']:
+def get_session(role_arn=None):
+    """
+    Return a boto3 session for role_arn, or for the Lambda's own
+    credentials, cached until shortly before its credentials expire
+    """
+    with CLIENT_LOCK:
+        session, expires = SESSIONS.get(role_arn, (None, 0))
+        if session is None or (expires and expires - time() < SESSION_REFRESH_MARGIN):
+            if role_arn:
+                creds = get_client('sts').assume_role(
+                    RoleArn=role_arn, RoleSessionName='cowcatcher')['Credentials']
+                session = boto3.session.Session(
+                    aws_access_key_id=creds['AccessKeyId'],
+                    aws_secret_access_key=creds['SecretAccessKey'],
+                    aws_session_token=creds['SessionToken'])
+                expires = timegm(creds['Expiration'].utctimetuple())
+            else:
+                session = boto3.session.Session()
+                expires = 0
+            SESSIONS[role_arn] = (session, expires)
+
+    return session
+
+
+def get_client(service, region=None, role_arn=None, pool_size=DEFAULT_POOL_CONNECTIONS,
+               read_timeout=None):
+    """
+    Return a client for service in region (None for the Lambda's region),
+    in the account of role_arn, reused until its session is renewed.
+    read_timeout (seconds) replaces botocore's default of 60.
+    """
+    with CLIENT_LOCK:
+        session = get_session(role_arn)
+        key = (service, region, role_arn, pool_size, read_timeout)
+        if key not in CLIENTS or CLIENTS[key][0] is not session:
+            config = Config(max_pool_connections=pool_size)
+            if read_timeout:
+                config = Config(max_pool_connections=pool_size, read_timeout=read_timeout)
+            client = session.client(service, region_name=region, config=config)
+            client.meta.events.register('after-call', record_api_call)
+            for event, handler in governor_hooks(service, region, role_arn):
+                client.meta.events.register(event, handler)
+            CLIENTS[key] = (session, client)
+
+    return CLIENTS[key][1]
+
+
+def account_label(role_arn):
+    """
+    Return the account id of an assumed role ARN, 'local' for our own
+    """
+    if role_arn:
+        return role_arn.split(':')[4]
+    return 'local'
+
+
+def roundup_key(svc_info, role_arn=None, region=None, scoped=False):
+    """
+    Return the S3 key of a service's roundup. When a team scans several
+    accounts or regions, each is kept under an account/region prefix.
+    """
+    cowfile = svc_info['Service'] + '_' + svc_info['S3Suffix'] + '.json'
+    if scoped:
+        cowfile = account_label(role_arn) + '/' + (region or 'default') + '/' + cowfile
+    return cowfile
+
 
+def task_scope(role_arn=None, region=None, scoped=False):
+    """
+    Return the report scope of a task: its account and region, when the
+    team scans more than one
+    """
+    if not scoped:
+        return ''
+    return account_label(role_arn) + ' ' + (region or 'default')
+
+
+def process_service(svc, team_info, now_tm, now_str, role_arn=None, region=None,
+                    scoped=False, run=None, svc_inst=None, found=None):
+    """
+    Discover, analyze, handle and save the roundup of one CowDefs service,
+    in the account of role_arn and in region (None for the Lambda's own).
+    scoped is set when the team scans more than one account or region.
+    Return its definition and its report section, (roundup, svc_info,
+    scope), or None if the service was not searched.
+    Unless team.json sets EmitMetrics false, the run's phase timings and
+    API calls are written as one EMF line.
+    With a run (see main), the service resumes from the run's checkpoint,
+    pending actions are written ahead to it, and when the run's deadline
+    passes the cows found so far and the paging position are checkpointed
+    instead of being handled; the section is then None.
+    svc_inst, if given, replaces discovery: the instances of a scan shared
+    with other teams (see main_teams), which passes the states it found
+    of the old cows in found.
+    With KeepHistory in team.json, each run's cows are also written to a
+    history file, and cows keep only their last ActionHistoryLimit
+    actions in the roundup.
+    A cowdef with a ShardCount above 1 has its tags discovered in that
+    many shards at once (see scan_shards); the old cows of shards that
+    failed are kept unchanged, untouched by actions.
+    """
+    metrics = start_metrics(svc)
+    with timed_phase('DefinitionLoad'):
         svc_info = load_definition_file(DEFS_PATH + svc)
-        cows_exist = False
+    if not svc_info:
+        Logger.error('Skipping %s: its definition failed to load', svc)
+        METRICS.current = None
+        return None, None
+    metrics['service'] = svc_info['Service']
+    section = None
 
-        #   Ensure API exists for service
-        try:
-            svc_client = boto3.client(svc_info['Service'])
-        except UnknownServiceError:
-            Logger.critical('Service unknown to AWS API: %s', svc_info['Service'])
+    #   Ensure API exists for service
+    pool_size = max(DEFAULT_POOL_CONNECTIONS,
+                    svc_info.get('DiscoverTagsConcurrency', 1))
+    try:
+        svc_client = get_client(svc_info['Service'], region, role_arn, pool_size)
+    except UnknownServiceError:
+        Logger.critical('Service unknown to AWS API: %s', svc_info['Service'])
 
-        if svc_info['Service'] in SERVICE_LIST:
-            inst_tags = get_service_instance_tags(svc_client, svc_info)
-            new_cows = analyze_service_instances(inst_tags, svc_info)
-            cowfile = svc_info['Service'] + '_' + svc_info['S3Suffix'] + '.json'
+    if svc_info['Service'] in SERVICE_LIST:
+        cowfile = roundup_key(svc_info, role_arn, region, scoped)
+        task = task_key(svc, role_arn, region)
+        deadline = run['deadline'] if run else None
+        with timed_phase('RoundupIO'):
             old_roundup = load_roundup(team_info['Bucket'], cowfile)
+        resume = None
+        if run:
+            with run['lock']:
+                resume = run['checkpoint']['tasks'].pop(task, None)
+                pending = run['checkpoint']['pending'].get(task)
+            old_roundup = record_pending_actions(old_roundup, pending)
+        owner_cache = load_owner_cache(old_roundup, int(time()))
+        cache_stats = defaultdict(int)
+        page_state = {'deadline': deadline}
+        carried = []
+        failed = []
+        records = []
+        # states of the old cows discovered in this run, for the history
+        shared = found or {}
+        found = dict((cow['id'], shared.get(cow['id']))
+                     for cow in (old_roundup['cows'] if old_roundup else [])
+                     if team_info.get('KeepHistory'))
+        if resume:
+            Logger.info('Resuming %s with %d cows', cowfile, len(resume['cows']))
+            owner_cache.update(resume['owners'])
+            carried = resume['cows']
+            page_state['token'] = resume['token']
+            failed = resume.get('failed', [])
+            records = resume.get('records', [])
+            found.update(resume.get('found', {}))
+        if resume and resume['paged']:
+            inst_tags = iter([])
+        elif svc_inst is not None:
+            inst_tags = svc_inst
+        elif svc_info.get('ShardCount', 1) > 1:
+            inst_tags, lost, records = scan_shards(svc, svc_info, team_info, svc_client,
+                                                   page_state, records, role_arn, region,
+                                                   found)
+            failed = sorted(set(failed) | set(lost))
+        else:
+            tag_client = get_client('resourcegroupstaggingapi', region, role_arn)
+            inst_tags = iter_service_instance_tags(svc_client, svc_info, tag_client,
+                                                   page_state)
+        new_cows = analyze_service_instances(watch_states(chain(carried, inst_tags), found),
+                                             svc_info,
+                                             owner_cache, cache_stats,
+                                             roundup_last_run(old_roundup),
+                                             get_client('cloudtrail', region, role_arn),
+                                             deadline)
+        Logger.info('Owner cache for %s: %d hits, %d misses (%d from bulk index)',
+                    cowfile, cache_stats['hits'], cache_stats['misses'],
+                    cache_stats['indexed'])
+        metrics['counts'] = {'Cows': len(new_cows),
+                             'OwnerCacheHits': cache_stats['hits'],
+                             'OwnerCacheMisses': cache_stats['misses']}
+        if svc_info.get('ShardCount', 1) > 1:
+            metrics['counts']['FailedShards'] = len(failed)
+        held = None
+        if failed and svc_info.get('ShardCount', 1) > 1:
+            Logger.warning('Keeping the old cows of %d of %d shards of %s',
+                           len(failed), svc_info['ShardCount'], cowfile)
+            held = [cow for cow in (old_roundup['cows'] if old_roundup else [])
+                    if shard_of(cow['id'], svc_info['ShardCount']) in failed]
+
+        if run and (page_state.get('stopped') or out_of_time(deadline)):
+            Logger.warning('Out of %s, checkpointing %s after %d cows',
+                           'API budget' if budget_spent() else 'time', cowfile,
+                           len(new_cows))
+            with run['lock']:
+                run['checkpoint']['tasks'][task] = {
+                    'token': page_state.get('token'),
+                    'paged': not page_state.get('stopped'),
+                    'cows': new_cows, 'failed': failed, 'records': records,
+                    'found': dict((k, v) for k, v in found.items() if v is not None),
+                    'owners': {c['id']:owner_cache[c['id']]
+                               for c in new_cows if c['id'] in owner_cache}}
+            metrics['counts']['Checkpointed'] = 1
+        else:
+            def write_ahead(pending):
+                """ Checkpoint the actions about to be made """
+                with run['lock']:
+                    run['checkpoint']['pending'][task] = {'at': now_str,
+                                                          'actions': pending}
+                save_checkpoint(run)
+
             new_roundup = handle_cows(new_cows, old_roundup, svc_client, svc_info,
-                                      pdtcal, now_tm, now_str)
-            http_status = save_roundup(new_roundup, team_info['Bucket'], cowfile)
+                                      None, now_tm, now_str, run and write_ahead, held,
+                                      team_info.get('EnforceActions', False))
+            # Only keep owners of the current herd, so the cache stays bounded
+            new_roundup['owners'] = {c['id']:owner_cache[c['id']]
+                                     for c in new_roundup['cows'] if c['id'] in owner_cache}
+            new_roundup['owner_stats'] = dict(cache_stats)
+            history_limit = team_info.get('ActionHistoryLimit', team_info.get('KeepHistory')
+                                          and DEFAULT_ACTION_HISTORY_LIMIT)
+            if history_limit:
+                trim_action_history(new_roundup, history_limit)
+            with timed_phase('RoundupIO'):
+                http_status = save_roundup(new_roundup, team_info['Bucket'], cowfile)
+                if team_info.get('KeepHistory'):
+                    write_history(history_rows(new_roundup, old_roundup, now_str, found,
+                                               compile_rules(svc_info)),
+                                  team_info['Bucket'], cowfile, svc_info['Service'],
+                                  new_roundup['last_run_epoch'])
             if http_status <> 200:
                 Logger.error('Unable to write roundup file: %s', cowfile)
+            elif run:
+                with run['lock']:
+                    run['checkpoint']['pending'].pop(task, None)
+
+            section = (new_roundup, svc_info, task_scope(role_arn, region, scoped))
+            if svc_info['CreateServiceReport']:
+                with timed_phase('Publish'):
+                    publish_report([section], team_info, svc_info, now_str,
+                                   report_prefix(team_info, now_tm) + '/' +
+                                   cowfile[:-len('.json')])
+            metrics['counts']['NewCows'] = len(new_roundup['delta']['new'])
+    else:
+        Logger.warning('No permissions for retrieving instances. Service: ')
+        Logger.warning(svc_info['Service'])
+
+    METRICS.current = None
+    if team_info.get('EmitMetrics', True):
+        emit_metrics(metrics, {'Team': team_info['Team'], 'Service': metrics['service']},
+                     {'Account': account_label(role_arn), 'Region': region or 'default',
+                      'CowDefs': svc})
+    return svc_info, section
+
 
-            if new_roundup['cows']:
-                cows_exist = True
-                herd_exist = True
+def resumed_section(svc, team_info, role_arn=None, region=None, scoped=False):
+    """
+    Return the definition and report section of a task finished by an
+    earlier invocation of a resumed run, from its saved roundup
+    """
+    svc_info = load_definition_file(DEFS_PATH + svc)
+    if not svc_info:
+        return None, None
+    if svc_info['Service'] not in SERVICE_LIST:
+        return svc_info, None
+    roundup = load_roundup(team_info['Bucket'],
+                           roundup_key(svc_info, role_arn, region, scoped))
+    if not roundup:
+        return svc_info, None
+    return svc_info, (roundup, svc_info, task_scope(role_arn, region, scoped))
+
+
+def report_prefix(team_info, now_tm):
+    """
+    Return the S3 key prefix of this run's saved reports
+    """
+    return 'reports/' + team_info['Team'] + '/' + strftime('%Y%m%dT%H%M%S', now_tm[0])
 
-            report_text = format_report(new_roundup, svc_info)
-            all_issues += report_text
-            if svc_info['CreateServiceReport'] and cows_exist:
-                send_report(report_text, svc_info, now_str)
+
+def team_tasks(team_info):
+    """
+    Return the (CowDefs file, role ARN, region) tasks of a team run
+    """
+    roles = team_info.get('AssumeRoleArns') or [None]
+    regions = team_info.get('Regions') or [None]
+    return [(svc, role_arn, region)
+            for role_arn in roles
+            for region in regions
+            for svc in team_info['CowDefs']]
+
+
+def event_items(container, key, item_key):
+    """
+    Return item_key of each item of a CloudTrail {key: {'items': [...]}} set
+    """
+    return [item[item_key] for item in (container or {}).get(key, {}).get('items', [])
+            if item.get(item_key)]
+
+
+def event_resource_ids(service, detail):
+    """
+    Return (kind, ids) of a CloudTrail event detail of service: kind is
+    'create', 'change' or 'delete'; ids are those of the instances it
+    affects. Unknown events give (None, []).
+    """
+    name = detail.get('eventName')
+    request = detail.get('requestParameters') or {}
+    response = detail.get('responseElements') or {}
+    if service == 'ec2':
+        if name == 'RunInstances':
+            return 'create', event_items(response, 'instancesSet', 'instanceId')
+        if name in ('CreateTags', 'DeleteTags'):
+            return 'change', [rsc for rsc in event_items(request, 'resourcesSet', 'resourceId')
+                              if rsc.startswith('i-')]
+        if name in ('StartInstances', 'StopInstances'):
+            return 'change', event_items(request, 'instancesSet', 'instanceId')
+        if name == 'TerminateInstances':
+            return 'delete', event_items(request, 'instancesSet', 'instanceId')
+    elif service == 'rds':
+        if name in ('CreateDBInstance', 'DeleteDBInstance'):
+            ids = [request['dBInstanceIdentifier']] if request.get('dBInstanceIdentifier') else []
+            return ('create' if name == 'CreateDBInstance' else 'delete'), ids
+        if name in ('AddTagsToResource', 'RemoveTagsFromResource', 'StartDBInstance',
+                    'StopDBInstance'):
+            rsc = request.get('resourceName') or request.get('dBInstanceIdentifier') or ''
+            if ':db:' in rsc or (rsc and ':' not in rsc):
+                return 'change', [arn_resource_id(rsc)]
+            return 'change', []
+    elif service == 'autoscaling':
+        if name in ('CreateAutoScalingGroup', 'DeleteAutoScalingGroup'):
+            ids = [request['autoScalingGroupName']] if request.get('autoScalingGroupName') else []
+            return ('create' if name == 'CreateAutoScalingGroup' else 'delete'), ids
+        if name in ('CreateOrUpdateTags', 'DeleteTags'):
+            return 'change', sorted(set(tag['resourceId'] for tag in request.get('tags', [])
+                                        if tag.get('resourceId')))
+    return None, []
+
+
+def event_username(identity):
+    """
+    Return the username CloudTrail's LookupEvents would give for an
+    event's userIdentity: the IAM user, or the session of an assumed role
+    """
+    identity = identity or {}
+    if identity.get('userName'):
+        return identity['userName']
+    if identity.get('type') == 'AssumedRole' and identity.get('arn'):
+        return identity['arn'].split('/')[-1]
+    if identity.get('type') == 'Root':
+        return 'root'
+    return identity.get('principalId', '')
+
+
+def event_filters(svc_info):
+    """
+    Split a cowdef's InstanceFilters for describing the ids of an event
+    into those sent with the call and those left to filters_match. EC2
+    takes them all; other services send them only when they cannot be
+    matched locally, as their full scan does.
+    """
+    filters = svc_info['InstanceFilters'] or []
+    if svc_info['Service'] == 'ec2' or local_filters(filters) is None:
+        return filters, []
+    return [], filters
+
+
+def describe_event_instances(svc_client, svc_info, ids, filters=None):
+    """
+    Return the instances of svc_info's service with the given ids, from
+    DiscoverInstance restricted to them and to filters. Ids missing or
+    filtered out are left out. A list of ids failing as not found is
+    described again one id at a time, so only ids confirmed missing are
+    left out.
+    """
+    param, takes_list = EVENT_DESCRIBE_PARAMS[svc_info['Service']]
+    api_call = getattr(svc_client, svc_info['DiscoverInstance'])
+    filters = list(filters or [])
+    if svc_info['Service'] == 'ec2':
+        calls = [{'Filters': [{'Name': param, 'Values': list(ids)}] + filters}]
+    else:
+        extra = {'Filters': filters} if filters else {}
+        if takes_list:
+            calls = [dict(extra, **{param: list(ids)})]
+        else:
+            calls = [dict(extra, **{param: rsc_id}) for rsc_id in ids]
+    instances = []
+    while calls:
+        kwargs = calls.pop(0)
+        try:
+            response = call_with_backoff(api_call, **kwargs)
+        except ClientError as err:
+            if 'NotFound' not in err.response['Error']['Code']:
+                raise
+            batch = kwargs.get(param)
+            if isinstance(batch, list) and len(batch) > 1:
+                calls.extend(dict(kwargs, **{param: [rsc_id]}) for rsc_id in batch)
+            else:
+                Logger.info('Event instance not found: %s', batch)
+            continue
+        instances.extend(parse_service_response(response, svc_info['InstanceIterator1'],
+                                                svc_info['InstanceIterator2']))
+    return instances
+
+
+def apply_event_cows(old_roundup, affected, cows, now_sec, now_str):
+    """
+    Return old_roundup with the cows of the affected ids replaced by
+    cows, those still wayward. Other cows, the last full run and its
+    action summary are kept; the 'delta' lists new and gone cows.
+    """
+    if old_roundup:
+        roundup = dict(old_roundup)
+    else:
+        roundup = {'cows': [], 'action_summary': {}, 'last_run': now_str,
+                   'last_run_epoch': now_sec}
+    affected = set(affected)
+    ocows = {cow['id']:cow for cow in roundup['cows']}
+    cow_ids = set(cow['id'] for cow in cows)
+    for cow in cows:
+        carry_cow_history(cow, ocows.get(cow['id']), now_sec, now_str)
+    roundup['delta'] = {'new': [cow['id'] for cow in cows if cow['id'] not in ocows],
+                        'gone': [{'id': ocow['id'], 'username': ocow.get('username'),
+                                  'state': ocow['state'], 'type': ocow.get('type')}
+                                 for ocow in roundup['cows']
+                                 if ocow['id'] in affected and ocow['id'] not in cow_ids],
+                        'actioned': []}
+    roundup['cows'] = [cow for cow in roundup['cows'] if cow['id'] not in affected] + cows
+    roundup['last_event_epoch'] = now_sec
+    return roundup
+
+
+def event_tasks(team_info, service, account=None, region=None):
+    """
+    Yield (svc_info, role ARN, region) of each team task of service
+    scanning the event's account and region
+    """
+    for svc, role_arn, task_region in team_tasks(team_info):
+        if role_arn and account and account_label(role_arn) != account:
+            continue
+        if task_region and region and task_region != region:
+            continue
+        svc_info = load_definition_file(DEFS_PATH + svc)
+        if svc_info and svc_info['Service'] == service:
+            yield svc_info, role_arn, task_region
+
+
+def process_event(svc_info, team_info, detail, kind, ids, now_tm, now_str,
+                  role_arn=None, region=None, scoped=False):
+    """
+    Update the roundup of one service task for the instances ids of a
+    CloudTrail event, describing only those, within the cowdef's
+    InstanceFilters as a full scan would. Created instances take their
+    owner from the event. New cows are published as a delta report.
+    """
+    bucket = team_info['Bucket']
+    cowfile = roundup_key(svc_info, role_arn, region, scoped)
+    now_sec = int(mktime(now_tm[0]))
+    old_roundup = load_roundup(bucket, cowfile)
+    owner_cache = load_owner_cache(old_roundup, now_sec)
+    if kind == 'create':
+        username = event_username(detail.get('userIdentity'))
+        for rsc_id in ids:
+            owner_cache[rsc_id] = {'username': username, 'checked': now_sec}
+
+    cows = []
+    if kind != 'delete':
+        svc_client = get_client(svc_info['Service'], region, role_arn)
+        remote, local = event_filters(svc_info)
+        instances = describe_event_instances(svc_client, svc_info, ids, remote)
+        records = [inst for inst in discover_instance_tags(instances, svc_client, svc_info)
+                   if filters_match(inst, local)]
+        # A bulk CloudTrail pass is not worth it for a few ids
+        cows = analyze_service_instances(records,
+                                         dict(svc_info, BulkAttribution=False),
+                                         owner_cache, None, None,
+                                         get_client('cloudtrail', region, role_arn))
+    roundup = apply_event_cows(old_roundup, ids, cows, now_sec, now_str)
+    owners = dict(roundup.get('owners', {}))
+    owners.update((cow['id'], owner_cache[cow['id']]) for cow in cows
+                  if cow['id'] in owner_cache)
+    roundup['owners'] = owners
+    if save_roundup(roundup, bucket, cowfile) <> 200:
+        Logger.error('Unable to write roundup file: %s', cowfile)
+
+    Logger.info('%s %s: %d ids, %d new cows, %d gone', detail.get('eventName'), cowfile,
+                len(ids), len(roundup['delta']['new']), len(roundup['delta']['gone']))
+    if roundup['delta']['new'] and (team_info['CreateTeamReport'] or
+                                    svc_info['CreateServiceReport']):
+        publish_report([(roundup, svc_info, task_scope(role_arn, region, scoped))],
+                       dict(team_info, ReportMode='delta'), svc_info, now_str,
+                       report_prefix(team_info, now_tm) + '/event-' +
+                       cowfile[:-len('.json')].replace('/', '-'))
+    return roundup
+
+
+def main(event, context):
+    """
+    Main functionality.
+    Every CowDefs service is run in each account of AssumeRoleArns and
+    each of Regions. With ServiceWorkers above 1 in team.json, these
+    tasks share a pool of that many threads; reports are still joined in
+    account, region and CowDefs order, in the team's ReportFormat.
+    A run that reaches the Lambda's deadline (less DeadlineMargin) saves
+    a checkpoint of its unfinished tasks to the team Bucket instead of
+    reporting; the next invocation resumes that run and reports it.
+
+    A team.json listing Teams runs them all with shared scans (main_teams).
+    Every AWS call goes through the rate governor (see governor_hooks);
+    once the team's ApiBudget of calls is spent, the run checkpoints as at
+    its deadline. The run's API call summary is logged at the end.
+    An event with a Shard is a shard worker's (see scan_shards): its
+    cows are returned.
+    """
+    team_info = load_definition_file(TEAM_FILEPATH)
+    if isinstance(event, dict) and event.get('Shard'):
+        start_governor(team_info)
+        return scan_shard(event, context)
+    if team_info.get('Teams'):
+        return main_teams(team_info, context)
+    start_governor(team_info)
+    run = {'deadline': run_deadline(context, team_info.get('DeadlineMargin',
+                                                           DEADLINE_MARGIN)),
+           'bucket': team_info['Bucket'], 'key': checkpoint_key(team_info),
+           'lock': RLock(), 'saved': False}
+    if run['deadline'] is None and team_info.get('ApiBudget'):
+        # outside Lambda, only the budget ends the run early (see out_of_time)
+        run['deadline'] = float('inf')
+    checkpoint = load_checkpoint(run['bucket'], run['key'])
+    if checkpoint:
+        run['saved'] = True
+        # (struct_time, flag), as parsedatetime returns it
+        now_tm = (localtime(checkpoint['run_epoch']), 2)
+        Logger.info('Resuming run of %s: %d tasks done', strftime('%c', now_tm[0]),
+                    len(checkpoint['done']))
+    else:
+        now_tm = (localtime(), 2)
+        checkpoint = {'run_epoch': int(mktime(now_tm[0])), 'done': [], 'tasks': {},
+                      'pending': {}}
+    run['checkpoint'] = checkpoint
+    now_str = strftime('%c', now_tm[0])
+
+    tasks = team_tasks(team_info)
+    scoped = len(set(task[1:] for task in tasks)) > 1
+
+    def run_task(task):
+        """ Process one service task of this run """
+        svc, role_arn, region = task
+        key = task_key(svc, role_arn, region)
+        if key in checkpoint['done']:
+            return resumed_section(svc, team_info, role_arn, region, scoped)
+        if out_of_time(run['deadline']):
+            return load_definition_file(DEFS_PATH + svc) or None, None
+        result = process_service(svc, team_info, now_tm, now_str, role_arn, region,
+                                 scoped, run)
+        with run['lock']:
+            if key not in checkpoint['tasks']:
+                checkpoint['done'].append(key)
+        return result
+
+    workers = min(team_info.get('ServiceWorkers', 1), len(tasks))
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(run_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_task(task) for task in tasks]
+
+    left = [task for task in tasks if task_key(*task) not in checkpoint['done']]
+    if left:
+        Logger.warning('Out of %s: %d of %d tasks left for the next invocation',
+                       'API budget' if budget_spent() else 'time', len(left), len(tasks))
+        save_checkpoint(run)
+        Logger.info('API calls: %s', json.dumps(governor_summary(), sort_keys=True))
+        return
+
+    sections = [section for _, section in results if section]
+    # the last definition that loaded; invalid cowdefs were skipped
+    svc_info = ([info for info, _ in results if info] or [None])[-1]
+
+    if team_info['CreateTeamReport'] and svc_info:
+        publish_report(sections, team_info, svc_info, now_str,
+                       report_prefix(team_info, now_tm) + '/team')
+    clear_checkpoint(run)
+    Logger.info('API calls: %s', json.dumps(governor_summary(), sort_keys=True))
+
+
+def local_filters(filters):
+    """
+    Return InstanceFilters as a list when each can be evaluated on
+    discovered instances (see filters_match), or None
+    """
+    filters = filters or []
+    for flt in filters:
+        if not (flt['Name'].startswith('tag:') or flt['Name'] in LOCAL_FILTERS):
+            return None
+    return filters
+
+
+def filters_match(inst, filters):
+    """
+    Return True if the id/type/state/tags record inst matches every
+    filter, as EC2 would: any of a filter's Values, with * and ? wildcards
+    """
+    for flt in filters:
+        name = flt['Name']
+        if name.startswith('tag:'):
+            found = [inst['tags'][name[4:]]] if name[4:] in inst['tags'] else []
+        elif name == 'tag-key':
+            found = list(inst['tags'])
+        elif name == 'instance-state-name':
+            found = [inst.get('state')]
+        else:
+            found = [inst.get('type')]
+        if not any(fnmatchcase(value, pattern) for value in found if value is not None
+                   for pattern in flt['Values']):
+            return False
+    return True
+
+
+def discovery_key(svc_info, role_arn=None, region=None):
+    """
+    Return the key of the scan a service task needs: tasks with equal
+    keys can share one. Filters that cannot be evaluated locally are
+    part of the key, and are sent with the scan.
+    """
+    remote = None
+    if local_filters(svc_info['InstanceFilters']) is None:
+        remote = json.dumps(svc_info['InstanceFilters'], sort_keys=True)
+    return (role_arn, region, remote) + tuple(svc_info.get(field)
+                                              for field in DISCOVERY_FIELDS)
+
+
+def fan_out_cows(svc_inst, members, watched=None):
+    """
+    Pass once over svc_inst, returning for each (svc_info) member the
+    copies of the instances matching its local filters and breaking
+    its rules. watched, if given, holds a dict per member: the state of
+    each instance matching the member's filters whose id is a key of it
+    is set there.
+    """
+    checks = [(compile_rules(svc_info), local_filters(svc_info['InstanceFilters']) or [])
+              for svc_info in members]
+    found = [[] for _ in members]
+    watched = watched or [{} for _ in members]
+    for inst in svc_inst:
+        for (rules, filters), cows, states in zip(checks, found, watched):
+            if not filters_match(inst, filters):
+                continue
+            if inst['id'] in states:
+                states[inst['id']] = inst['state']
+            if cow_violations(rules, inst):
+                cows.append(dict(inst))
+    return found
+
+
+def main_teams(config, context):
+    """
+    Run every team listed in config's Teams (team.json files in the
+    CowDefs directory), scanning each account, region and service once
+    for all of them: each team's InstanceFilters and rules are applied
+    to the shared scan, and roundups and reports stay per team.
+    Filters other than tag:<key>, tag-key, instance-state-name and
+    instance-type need a scan of their own. Shared runs are not
+    checkpointed: once config's ApiBudget is spent, the scans not started
+    are skipped until the next run, and teams report the rest.
+    """
+    now_tm = (localtime(), 2)
+    now_str = strftime('%c', now_tm[0])
+    start_governor(config)
+    teams = [load_definition_file(DEFS_PATH + name) for name in config['Teams']]
+
+    # scan key -> [(team index, task index, svc, role ARN, region, svc_info)]
+    groups = OrderedDict()
+    team_scopes = []
+    for team_idx, team_info in enumerate(teams):
+        tasks = team_tasks(team_info)
+        team_scopes.append((tasks, len(set(task[1:] for task in tasks)) > 1))
+        for task_idx, (svc, role_arn, region) in enumerate(tasks):
+            svc_info = load_definition_file(DEFS_PATH + svc)
+            if not svc_info:
+                Logger.error('Skipping %s of %s: its definition failed to load', svc,
+                             team_info['Team'])
+                continue
+            groups.setdefault(discovery_key(svc_info, role_arn, region), []).append(
+                (team_idx, task_idx, svc, role_arn, region, svc_info))
+
+    def run_group(members):
+        """ Scan once for a group of team tasks, then process each """
+        _, _, _, role_arn, region, svc_info = members[0]
+        results = []
+        if budget_spent():
+            Logger.warning('API budget spent, skipping the %s scan of %d team tasks',
+                           svc_info['Service'], len(members))
+            return results
+        if svc_info['Service'] in SERVICE_LIST:
+            metrics = start_metrics(svc_info['Service'])
+            scan_info = dict(svc_info, InstanceFilters=None)
+            if local_filters(svc_info['InstanceFilters']) is None:
+                scan_info['InstanceFilters'] = svc_info['InstanceFilters']
+            inst_tags = iter_service_instance_tags(
+                get_client(svc_info['Service'], region, role_arn,
+                           max(DEFAULT_POOL_CONNECTIONS,
+                               svc_info.get('DiscoverTagsConcurrency', 1))),
+                scan_info, get_client('resourcegroupstaggingapi', region, role_arn))
+            # the old cows of teams keeping history, to record why they left
+            watched = []
+            for team_idx, _, _, _, _, member_info in members:
+                old_roundup = None
+                if teams[team_idx].get('KeepHistory'):
+                    old_roundup = load_roundup(teams[team_idx]['Bucket'], roundup_key(
+                        member_info, role_arn, region, team_scopes[team_idx][1]))
+                watched.append(dict.fromkeys(
+                    cow['id'] for cow in (old_roundup['cows'] if old_roundup else [])))
+            found = fan_out_cows(inst_tags, [member[5] for member in members], watched)
+            METRICS.current = None
+            if config.get('EmitMetrics', True):
+                emit_metrics(metrics, {'Service': svc_info['Service']},
+                             {'Teams': [teams[member[0]]['Team'] for member in members],
+                              'Account': account_label(role_arn),
+                              'Region': region or 'default'})
         else:
-            Logger.warning('No permissions for retrieving instances. Service: ')
-            Logger.warning(svc_info['Service'])
+            found = [None] * len(members)
+            watched = [None] * len(members)
+        for (team_idx, task_idx, svc, _, _, _), cows, states in zip(members, found, watched):
+            team_info = teams[team_idx]
+            results.append((team_idx, task_idx, process_service(
+                svc, team_info, now_tm, now_str, role_arn, region,
+                team_scopes[team_idx][1], None, cows, states)))
+        return results
+
+    workers = min(config.get('ServiceWorkers', 1), len(groups))
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            group_results = pool.map(run_group, list(groups.values()))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        group_results = [run_group(members) for members in groups.values()]
+
+    team_results = [[(None, None)] * len(tasks) for tasks, _ in team_scopes]
+    for results in group_results:
+        for team_idx, task_idx, result in results:
+            team_results[team_idx][task_idx] = result
+    for team_info, results in zip(teams, team_results):
+        infos = [info for info, _ in results if info]
+        if team_info['CreateTeamReport'] and infos:
+            publish_report([section for _, section in results if section], team_info,
+                           infos[-1], now_str,
+                           report_prefix(team_info, now_tm) + '/team')
+    Logger.info('API calls: %s', json.dumps(governor_summary(), sort_keys=True))
+
 
-    if team_info['CreateTeamReport'] and herd_exist:
-        send_report(all_issues, svc_info, now_str)
+def handle_event(event, context):
+    """
+    Event-driven entry point, for EventBridge events of CloudTrail API
+    calls creating, tagging, untagging, starting, stopping or deleting
+    instances, and EC2 state-change notifications.
+    Only the roundups of the affected ids are updated, so new cows are
+    reported within seconds; the scheduled main run still rescans the
+    whole fleet to reconcile anything the events missed.
+    Once the team's ApiBudget is spent, the tasks left are skipped, for
+    the scheduled run to reconcile.
+    """
+    detail = event.get('detail') or {}
+    if event.get('detail-type') == 'EC2 Instance State-change Notification':
+        service = 'ec2'
+        kind = 'delete' if detail.get('state') == 'terminated' else 'change'
+        ids = [detail['instance-id']] if detail.get('instance-id') else []
+    else:
+        service = EVENT_SOURCES.get(detail.get('eventSource'))
+        if service is None or detail.get('errorCode'):
+            Logger.info('Ignoring event: %s', detail.get('eventName'))
+            return
+        kind, ids = event_resource_ids(service, detail)
+    if not ids:
+        Logger.info('No instances in event: %s', detail.get('eventName'))
+        return
+
+    now_tm = (localtime(), 2)
+    now_str = strftime('%c', now_tm[0])
+    team_info = load_definition_file(TEAM_FILEPATH)
+    start_governor(team_info)
+    tasks = team_tasks(team_info)
+    scoped = len(set(task[1:] for task in tasks)) > 1
+    for svc_info, role_arn, region in event_tasks(team_info, service, event.get('account'),
+                                                  event.get('region')):
+        if budget_spent():
+            Logger.warning('API budget spent, skipping %d ids of %s', len(ids),
+                           roundup_key(svc_info, role_arn, region, scoped))
+            continue
+        process_event(svc_info, team_info, detail, kind, ids, now_tm, now_str,
+                      role_arn, region, scoped)
 
 
 #main('foo', 'bar')
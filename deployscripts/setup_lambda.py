@@ -32,7 +32,8 @@ EVENTS_C = boto3.client('events')
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 SVC_ACCESS = ['cloudwatch_access','ec2_access', 'sns_access', 'rds_access',
-              'as_access', 's3_access', 'cloudtrail_access']
+              'as_access', 's3_access', 'cloudtrail_access', 'tagging_access',
+              'sts_access', 'lambda_access']
 
 def setup_iam_role():
     """
@@ -86,10 +87,55 @@ def configure_vpc():
         vpc_config['SecurityGroupIds'] = [security_group_id]
     return vpc_config
 
+def deploy_function(name, handler, rule, target_id, zip_bytes, role, vpc_config):
+    """
+    Create or update the Lambda function name, invoked by the events rule
+    through its target target_id. Keep target ids stable: a new id adds a
+    target next to the old one.
+    """
+    fcn = {}
+    try:
+        LAMBDA_C.get_function(FunctionName=name)
+        fcn = LAMBDA_C.update_function_code(FunctionName=name,
+                                            ZipFile=zip_bytes,
+                                            Publish=True)
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ResourceNotFoundException':
+            sleep(10)
+            fcn = LAMBDA_C.create_function(FunctionName=name,
+                                           Code={'ZipFile': zip_bytes},
+                                           Runtime='python2.7',
+                                           Role=role.arn,
+                                           Handler=handler,
+                                           Timeout=300,
+                                           Description="Report, stop, kill cows (instances)",
+                                           MemorySize=128,
+                                           VpcConfig=vpc_config)
+
+        else:
+            raise err
+
+    try:
+        LAMBDA_C.add_permission(FunctionName=name,
+                                StatementId=rule['Name'] + '-Permission',
+                                Action='lambda:InvokeFunction',
+                                Principal='events.amazonaws.com',
+                                SourceArn=rule['RuleArn'])
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ResourceConflictException':
+            # ignore conflicts if the rule exists
+            raise err
+
+    EVENTS_C.put_targets(Rule=rule['Name'],
+                         Targets=[{'Id': target_id,
+                                   'Arn': fcn['FunctionArn'],}])
+
 def upload_lambda_function():
     """
     main function of deployment.
     Ensure IAM is setup. Upload zip. Create function.
+    With EVENT_DRIVEN set, also create the function updating roundups
+    from CloudTrail events, between scheduled runs.
     """
     vpc_config = configure_vpc()
     role = setup_iam_role()
@@ -98,44 +144,22 @@ def upload_lambda_function():
                              ScheduleExpression=os.environ.get('DISCOVERY_SCHEDULE'),
                              State='ENABLED',
                              Description='Run the instance discovery')
+    rule['Name'] = 'DiscoverCowsSchedule'
 
     with open('{}/../aws_cowcatcher.zip'.format(BASE_DIR), 'rb') as zip_file:
         zip_bytes = zip_file.read()
-        fcn = {}
-        try:
-            LAMBDA_C.get_function(FunctionName='DiscoverCows')
-            fcn = LAMBDA_C.update_function_code(FunctionName='DiscoverCows',
-                                                ZipFile=zip_bytes,
-                                                Publish=True)
-        except ClientError as err:
-            if err.response['Error']['Code'] == 'ResourceNotFoundException':
-                sleep(10)
-                fcn = LAMBDA_C.create_function(FunctionName='DiscoverCows',
-                                               Code={'ZipFile': zip_bytes},
-                                               Runtime='python2.7',
-                                               Role=role.arn,
-                                               Handler='cowcatcher.main',
-                                               Timeout=300,
-                                               Description="Report, stop, kill cows (instances)",
-                                               MemorySize=128,
-                                               VpcConfig=vpc_config)
-
-            else:
-                raise err
-
-        try:
-            LAMBDA_C.add_permission(FunctionName='DiscoverCows',
-                                    StatementId='DiscoverCowsSchedule-Permission',
-                                    Action='lambda:InvokeFunction',
-                                    Principal='events.amazonaws.com',
-                                    SourceArn=rule['RuleArn'])
-        except ClientError as err:
-            if err.response['Error']['Code'] != 'ResourceConflictException':
-                # ignore conflicts if the rule exists
-                raise err
-
-        EVENTS_C.put_targets(Rule='DiscoverCowsSchedule',
-                             Targets=[{'Id': 'DiscoverCows-schedule',
-                                       'Arn': fcn['FunctionArn'],}])
+
+    deploy_function('DiscoverCows', 'cowcatcher.main', rule, 'DiscoverCows-schedule',
+                    zip_bytes, role, vpc_config)
+
+    if os.environ.get('EVENT_DRIVEN'):
+        with open('{}/event_pattern.json'.format(BASE_DIR)) as pattern:
+            rule = EVENTS_C.put_rule(Name='DiscoverCowsEvents',
+                                     EventPattern=pattern.read(),
+                                     State='ENABLED',
+                                     Description='Update roundups from instance events')
+        rule['Name'] = 'DiscoverCowsEvents'
+        deploy_function('DiscoverCowsEvents', 'cowcatcher.handle_event', rule,
+                        'DiscoverCowsEvents-events', zip_bytes, role, vpc_config)
 
 upload_lambda_function()
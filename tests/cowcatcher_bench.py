@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+   Offline benchmark for cowcatcher.py
+   Called via python tests/cowcatcher_bench.py [--sizes 1000,10000] [options]
+
+   Each fleet size runs in a fresh interpreter against tests/fake_aws.py:
+   a cold run (no roundup yet) then a warm run (roundup and owners
+   cached). For every stage of main it reports wall time, then the API
+   calls of each run and the peak RSS. No AWS credentials are needed.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from threading import Lock
+from time import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT, HERE]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+import fake_aws
+
+# cowcatcher functions timed as the stages of main
+STAGES = ['load_roundup', 'analyze_service_instances', 'handle_cows',
+          'save_roundup', 'publish_report']
+COWDEFS = {'ec2': 'ec2_TeamFoo.json', 'rds': 'rds_TeamFoo.json',
+           'autoscaling': 'as_TeamFoo.json'}
+BUCKET = 'cows-bench'
+
+
+def peak_rss_kb():
+    """
+    Peak resident set size of this process in KB (ru_maxrss is in
+    bytes on macOS)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def write_defs(args, defs_dir):
+    """
+    Write bench copies of the shipped cowdefs into defs_dir
+    """
+    for service in args.services:
+        with open(os.path.join(ROOT, 'cowdefs', COWDEFS[service])) as src:
+            svc_info = json.load(src)
+        svc_info['CowKeyChecklist'] = fake_aws.FLEET_TAG_KEYS
+        svc_info['CowReportARN'] = 'arn:aws:sns:%s:%s:CowReport' % (fake_aws.REGION,
+                                                                   fake_aws.ACCOUNT)
+        svc_info['BulkAttribution'] = args.bulk_attribution
+        # autoscaling has no Resource Groups Tagging API resource type
+        if service in fake_aws.TAGGING_SERVICES:
+            svc_info['TagEngine'] = args.tag_engine
+        svc_info['DiscoverTagsConcurrency'] = args.tag_concurrency
+        with open(os.path.join(defs_dir, COWDEFS[service]), 'w') as dst:
+            json.dump(svc_info, dst)
+    team_info = {'Bucket': BUCKET, 'Team': 'Bench', 'CreateTeamReport': True,
+                 'ServiceWorkers': args.service_workers,
+                 'CowDefs': [COWDEFS[service] for service in args.services]}
+    with open(os.path.join(defs_dir, 'team.json'), 'w') as dst:
+        json.dump(team_info, dst)
+
+
+def time_stages(cowcatcher, timings):
+    """
+    Wrap the STAGES functions of cowcatcher to add their wall time to
+    timings; threads running services in parallel add up. Return a
+    function undoing it.
+    """
+    lock = Lock()
+
+    def timed(name, func):
+        """ func, adding its wall time to timings[name] """
+        def wrapper(*args, **kwargs):
+            """ time one call """
+            start = time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with lock:
+                    timings[name] += time() - start
+        return wrapper
+
+    originals = [(name, getattr(cowcatcher, name)) for name in STAGES]
+    for name, func in originals:
+        setattr(cowcatcher, name, timed(name, func))
+
+    def restore():
+        """ unwrap the STAGES functions """
+        for name, func in originals:
+            setattr(cowcatcher, name, func)
+    return restore
+
+
+def run_size(args, size):
+    """
+    Benchmark size resources per service in this process; return the
+    results of the cold and warm runs
+    """
+    import cowcatcher
+    fleets = {service: fake_aws.make_fleet(service, size, args.untagged, args.seed)
+              for service in args.services}
+    aws = fake_aws.FakeAws(fleets, latency=args.latency, seed=args.seed)
+    aws.install(cowcatcher)
+
+    defs_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    write_defs(args, defs_dir)
+    cowcatcher.DEFS_PATH = defs_dir + '/'
+    cowcatcher.TEAM_FILEPATH = os.path.join(defs_dir, 'team.json')
+    cowcatcher.ROUNDUP_CACHE_DIR = cache_dir
+
+    results = []
+    try:
+        # The warm run reuses the clients and roundup cache of the cold
+        # one, as a second invocation of the same container would
+        for run in ['cold', 'warm']:
+            timings = defaultdict(float)
+            restore = time_stages(cowcatcher, timings)
+            aws.calls.clear()
+            start = time()
+            try:
+                cowcatcher.main({}, None)
+            finally:
+                restore()
+            timings['main'] = time() - start
+            results.append({'run': run, 'size': size, 'stages': dict(timings),
+                            'calls': dict(aws.calls), 'peak_rss_kb': peak_rss_kb()})
+    finally:
+        shutil.rmtree(defs_dir)
+        shutil.rmtree(cache_dir)
+    return results
+
+
+def print_results(results):
+    """
+    Print one line of stage times and one of API calls per run
+    """
+    for result in results:
+        stages = ' '.join('%s=%.3fs' % (name, result['stages'].get(name, 0.0))
+                          for name in STAGES + ['main'])
+        print('%7d %-4s %s rss=%dMB' % (result['size'], result['run'], stages,
+                                        result['peak_rss_kb'] // 1024))
+        calls = ' '.join('%s=%d' % item for item in sorted(result['calls'].items()))
+        print('%12s calls: %s' % ('', calls))
+
+
+def main():
+    """
+    Run every fleet size in its own interpreter, so peak RSS is per size
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated resources per service (1k-200k)')
+    parser.add_argument('--services', default='ec2,rds,autoscaling')
+    parser.add_argument('--untagged', type=float, default=0.1,
+                        help='ratio of resources missing the checked tags')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every API call')
+    parser.add_argument('--service-workers', type=int, default=1)
+    parser.add_argument('--tag-concurrency', type=int, default=1)
+    parser.add_argument('--tag-engine', default='describe', choices=['describe', 'tagging'])
+    parser.add_argument('--bulk-attribution', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print raw JSON results')
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.services = args.services.split(',')
+
+    if args.one is not None:
+        logging.basicConfig()
+        logging.getLogger().handlers[0].setLevel(logging.ERROR)
+        # No request leaves the process, but botocore still wants credentials
+        os.environ['AWS_ACCESS_KEY_ID'] = 'bench'
+        os.environ['AWS_SECRET_ACCESS_KEY'] = 'bench'
+        print(json.dumps(run_size(args, args.one)))
+        return
+
+    results = []
+    argv = [arg for arg in sys.argv[1:] if arg != '--json']
+    for size in [int(size) for size in args.sizes.split(',')]:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       '--one', str(size)] + argv)
+        results.extend(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
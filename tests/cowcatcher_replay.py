@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""
+   Record/replay runner for cowcatcher.py
+   Called via python tests/cowcatcher_replay.py record FIXTURE [--live] [--defs DIR]
+           or python tests/cowcatcher_replay.py replay FIXTURE [--sort KEY] [--limit N]
+
+   record runs main against AWS with the caller's credentials and saves
+   every response, with the team's definitions, to a gzipped JSON
+   fixture. Calls other than reads (Describe/List/Get/Head/Lookup and
+   AssumeRole), i.e. actions, publishes and roundup writes, are answered
+   locally unless --live is given.
+   replay runs main offline against a fixture, under cProfile (and
+   tracemalloc, where the interpreter has it), with every write answered
+   locally, and prints the hot paths. No AWS credentials are needed.
+"""
+
+import argparse
+import base64
+import cProfile
+import datetime
+import gzip
+import json
+import logging
+import os
+import pstats
+import resource
+import shutil
+import sys
+import tempfile
+from calendar import timegm
+from collections import defaultdict, deque
+from io import BytesIO
+from threading import Lock
+from time import time
+
+from botocore.response import StreamingBody
+from dateutil.tz import tzutc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT, HERE]
+
+import fake_aws
+
+FIXTURE_VERSION = 1
+READ_PREFIXES = ('Describe', 'List', 'Get', 'Head', 'Lookup')
+READ_OPERATIONS = ('AssumeRole',)
+# request parameters that change from run to run (time windows, cache
+# validators, written bodies); a call not recorded with the same
+# parameters is matched without these
+VOLATILE_PARAMS = ('StartTime', 'EndTime', 'IfNoneMatch', 'Body', 'Metadata')
+# answer to writes that are not sent
+STUB_RESPONSE = {'ETag': '"stubbed"', 'MessageId': 'stubbed'}
+# recorded in place of assumed-role secrets; replay signs nothing
+REDACTED_CREDENTIALS = {'AccessKeyId': 'replay', 'SecretAccessKey': 'replay',
+                        'SessionToken': 'replay'}
+
+
+def is_read(operation):
+    """
+    Return True for operations that change nothing in the account
+    """
+    return operation.startswith(READ_PREFIXES) or operation in READ_OPERATIONS
+
+
+def redact(response):
+    """
+    Return the jsonable response with any Credentials replaced by
+    placeholders, keeping only their Expiration
+    """
+    if 'Credentials' not in response:
+        return response
+    credentials = dict(REDACTED_CREDENTIALS)
+    if 'Expiration' in response['Credentials']:
+        credentials['Expiration'] = response['Credentials']['Expiration']
+    return dict(response, Credentials=credentials)
+
+
+def jsonable(value):
+    """
+    Return value with datetimes, binary strings and streams replaced by
+    markers json can hold (see from_json)
+    """
+    if isinstance(value, dict):
+        return {key: jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': timegm(value.utctimetuple()) + value.microsecond / 1e6}
+    if hasattr(value, 'read'):
+        value = value.read()
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'$bytes': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def from_json(obj):
+    """
+    json object_hook undoing the markers of jsonable
+    """
+    if '$datetime' in obj:
+        return datetime.datetime.fromtimestamp(obj['$datetime'], tzutc())
+    if '$bytes' in obj:
+        return base64.b64decode(obj['$bytes'])
+    return obj
+
+
+def call_keys(service, region, role_arn, operation, params):
+    """
+    Return the exact and the loose (VOLATILE_PARAMS left out) keys of a call
+    """
+    params = jsonable(params)
+    loose = {key: value for key, value in params.items() if key not in VOLATILE_PARAMS}
+    return tuple(json.dumps([service, region, role_arn, operation, kind], sort_keys=True)
+                 for kind in (params, loose))
+
+
+def written_params(params):
+    """
+    Return a copy of a write's parameters, with a streamed Body (as
+    botocore wraps it) read back into bytes
+    """
+    params = dict(params)
+    body = params.get('Body')
+    if hasattr(body, 'read'):
+        body.seek(0)
+        params['Body'] = body.read()
+    return params
+
+
+def point_at_defs(cowcatcher, defs_dir):
+    """
+    Make cowcatcher read its definitions from defs_dir
+    """
+    cowcatcher.DEFS_PATH = defs_dir.rstrip('/') + '/'
+    cowcatcher.TEAM_FILEPATH = cowcatcher.DEFS_PATH + 'team.json'
+    cowcatcher.DEFINITIONS.clear()
+
+
+def install(cowcatcher, attach):
+    """
+    Pass every client cowcatcher.get_client creates, with its region and
+    role ARN, to attach; return a function undoing it
+    """
+    get_client = cowcatcher.get_client
+    attached = set()
+    lock = Lock()
+
+    def hooked_get_client(service, region=None, role_arn=None, *args, **kwargs):
+        """ get_client, attaching new clients """
+        client = get_client(service, region, role_arn, *args, **kwargs)
+        with lock:
+            if id(client) not in attached:
+                attached.add(id(client))
+                attach(client, region, role_arn)
+        return client
+
+    cowcatcher.get_client = hooked_get_client
+    cowcatcher.CLIENTS.clear()
+
+    def uninstall():
+        """ restore cowcatcher.get_client """
+        cowcatcher.get_client = get_client
+        cowcatcher.CLIENTS.clear()
+    return uninstall
+
+
+def keep_params(params, context, **kwargs):
+    """ Keep the caller's parameters for the later hooks of the call """
+    context['replay_params'] = params
+
+
+def record(cowcatcher, defs_dir, live=False):
+    """
+    Run cowcatcher.main, returning the fixture of its definitions and of
+    every response it got
+    """
+    fixture = {'version': FIXTURE_VERSION, 'recorded': time(), 'calls': [],
+               'region': cowcatcher.get_session().region_name, 'defs': {}}
+    for name in sorted(os.listdir(defs_dir)):
+        if name.endswith('.json'):
+            with open(os.path.join(defs_dir, name)) as deffile:
+                fixture['defs'][name] = deffile.read()
+    lock = Lock()
+
+    def attach(client, region, role_arn):
+        """ record the calls of client """
+        service = client.meta.service_model.service_name
+
+        def stub_write(model, context, **kwargs):
+            """ answer writes locally """
+            if not live and not is_read(model.name):
+                context['replay_stubbed'] = True
+                return fake_aws.FakeAws._ok(dict(STUB_RESPONSE))
+            return None
+
+        def keep_response(http_response, parsed, model, context, **kwargs):
+            """ add the response to the fixture """
+            if context.get('replay_stubbed'):
+                return
+            if hasattr(parsed.get('Body'), 'read'):
+                body = parsed['Body'].read()
+                parsed['Body'] = StreamingBody(BytesIO(body), len(body))
+                response = jsonable(dict(parsed, Body=body))
+            else:
+                response = jsonable(parsed)
+            call = {'service': service, 'region': region, 'role': role_arn,
+                    'operation': model.name,
+                    'params': jsonable(context.get('replay_params', {})),
+                    'status': http_response.status_code, 'response': redact(response)}
+            with lock:
+                fixture['calls'].append(call)
+
+        client.meta.events.register('before-parameter-build', keep_params)
+        client.meta.events.register('before-call', stub_write)
+        client.meta.events.register('after-call', keep_response)
+
+    cache_dir = tempfile.mkdtemp()
+    saved = cowcatcher.ROUNDUP_CACHE_DIR, cowcatcher.DEFS_PATH, cowcatcher.TEAM_FILEPATH
+    # an empty roundup cache, so roundups are recorded in full
+    cowcatcher.ROUNDUP_CACHE_DIR = cache_dir
+    point_at_defs(cowcatcher, defs_dir)
+    uninstall = install(cowcatcher, attach)
+    try:
+        cowcatcher.main({}, None)
+    finally:
+        uninstall()
+        cowcatcher.ROUNDUP_CACHE_DIR, cowcatcher.DEFS_PATH, cowcatcher.TEAM_FILEPATH = saved
+        cowcatcher.DEFINITIONS.clear()
+        shutil.rmtree(cache_dir)
+    return fixture
+
+
+def replay(cowcatcher, fixture, threads=False, profiler=None):
+    """
+    Run cowcatcher.main offline against fixture (under profiler, if
+    given). Return the calls answered from it, the calls it had no
+    answer for and the writes answered locally, counted by operation,
+    and the (operation, parameters) of those writes.
+    """
+    exact, loose = defaultdict(deque), defaultdict(deque)
+    for call in fixture['calls']:
+        keys = call_keys(call['service'], call['region'], call['role'],
+                         call['operation'], call['params'])
+        # decoded afresh for every answer, as callers may change it
+        call = dict(call, response=json.dumps(call['response']))
+        exact[keys[0]].append(call)
+        loose[keys[1]].append(call)
+    counts = {'replayed': defaultdict(int), 'missed': defaultdict(int),
+              'stubbed': defaultdict(int), 'writes': []}
+    lock = Lock()
+
+    def answer(queue):
+        """ the next recorded response of queue; the last one repeats """
+        with lock:
+            counts['replayed'][queue[0]['operation']] += 1
+            return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def attach(client, region, role_arn):
+        """ answer the calls of client from the fixture """
+        service = client.meta.service_model.service_name
+
+        def respond(model, context, **kwargs):
+            """ (http response, parsed response) of one call """
+            if not is_read(model.name):
+                with lock:
+                    counts['stubbed'][model.name] += 1
+                    counts['writes'].append((model.name,
+                                             written_params(context.get('replay_params', {}))))
+                return fake_aws.FakeAws._ok(dict(STUB_RESPONSE))
+            keys = call_keys(service, region, role_arn, model.name,
+                             context.get('replay_params', {}))
+            queue = exact.get(keys[0]) or loose.get(keys[1])
+            if not queue:
+                with lock:
+                    counts['missed'][model.name] += 1
+                return fake_aws.FakeAws._error(400, 'ReplayMiss',
+                                               'No recorded response')
+            call = answer(queue)
+            parsed = json.loads(call['response'], object_hook=from_json)
+            if call['status'] >= 300:
+                return fake_aws.FakeAws._error(call['status'],
+                                               parsed['Error']['Code'],
+                                               parsed['Error'].get('Message', ''))
+            if 'Body' in parsed:
+                body = parsed['Body']
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+                parsed['Body'] = StreamingBody(BytesIO(body), len(body))
+            return fake_aws.FakeAws._ok(parsed)
+
+        client.meta.events.register('before-parameter-build', keep_params)
+        client.meta.events.register('before-call', respond)
+
+    defs_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    for name, text in fixture['defs'].items():
+        if not threads:
+            # cProfile only sees the thread it runs on
+            definition = json.loads(text)
+            if isinstance(definition, dict):
+                for key in ('ServiceWorkers', 'DiscoverTagsConcurrency'):
+                    if key in definition:
+                        definition[key] = 1
+                text = json.dumps(definition)
+        with open(os.path.join(defs_dir, name), 'w') as deffile:
+            deffile.write(text)
+    saved = cowcatcher.ROUNDUP_CACHE_DIR, cowcatcher.DEFS_PATH, cowcatcher.TEAM_FILEPATH
+    cowcatcher.ROUNDUP_CACHE_DIR = cache_dir
+    point_at_defs(cowcatcher, defs_dir)
+    uninstall = install(cowcatcher, attach)
+    try:
+        if profiler is None:
+            cowcatcher.main({}, None)
+        else:
+            profiler.runcall(cowcatcher.main, {}, None)
+    finally:
+        uninstall()
+        cowcatcher.ROUNDUP_CACHE_DIR, cowcatcher.DEFS_PATH, cowcatcher.TEAM_FILEPATH = saved
+        cowcatcher.DEFINITIONS.clear()
+        shutil.rmtree(defs_dir)
+        shutil.rmtree(cache_dir)
+    return counts
+
+
+def save_fixture(fixture, path):
+    """
+    Write fixture to path as gzipped JSON
+    """
+    with gzip.open(path, 'wb') as out:
+        out.write(json.dumps(fixture, sort_keys=True).encode('utf-8'))
+
+
+def load_fixture(path):
+    """
+    Read a fixture written by save_fixture
+    """
+    with gzip.open(path, 'rb') as src:
+        fixture = json.loads(src.read().decode('utf-8'))
+    if fixture.get('version') != FIXTURE_VERSION:
+        raise ValueError('Unsupported fixture version: %s' % fixture.get('version'))
+    return fixture
+
+
+def peak_rss_kb():
+    """
+    Peak resident set size of this process in KB (ru_maxrss is in
+    bytes on macOS)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def print_report(counts, profiler, wall, args, snapshot=None):
+    """
+    Print the replay's call counts, then its hot paths
+    """
+    for kind in ('replayed', 'missed', 'stubbed'):
+        calls = ' '.join('%s=%d' % item for item in sorted(counts[kind].items()))
+        print('%-8s %s' % (kind, calls or '-'))
+    print('wall %.3fs  peak rss %dMB' % (wall, peak_rss_kb() // 1024))
+    print('')
+    stats = pstats.Stats(profiler, stream=sys.stdout)
+    stats.sort_stats(args.sort).print_stats(r'cowcatcher\.py', args.limit)
+    stats.sort_stats(args.sort).print_stats(args.limit)
+    if snapshot is not None:
+        print('Top allocations:')
+        for stat in snapshot.statistics('lineno')[:args.limit]:
+            print('  %s' % stat)
+
+
+def main():
+    """
+    Record a fixture, or replay one under the profilers
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('fixture', help='gzipped JSON fixture file')
+    parser.add_argument('--defs', default=os.path.join(ROOT, 'cowdefs'),
+                        help='definitions directory to record with')
+    parser.add_argument('--live', action='store_true',
+                        help='record: send actions, publishes and roundup writes')
+    parser.add_argument('--threads', action='store_true',
+                        help='replay: keep ServiceWorkers and DiscoverTagsConcurrency')
+    parser.add_argument('--sort', default='cumulative', help='pstats sort key')
+    parser.add_argument('--limit', type=int, default=25, help='lines per listing')
+    parser.add_argument('--profile-out', help='replay: also save the raw cProfile stats')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    import cowcatcher
+    if args.mode == 'record':
+        fixture = record(cowcatcher, args.defs, args.live)
+        save_fixture(fixture, args.fixture)
+        print('Recorded %d calls to %s' % (len(fixture['calls']), args.fixture))
+        return
+
+    logging.getLogger().setLevel(logging.WARNING)
+    fixture = load_fixture(args.fixture)
+    os.environ['AWS_DEFAULT_REGION'] = fixture['region'] or 'us-east-1'
+    # No request leaves the process, but botocore still wants credentials
+    os.environ['AWS_ACCESS_KEY_ID'] = 'replay'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'replay'
+    cowcatcher.SESSIONS.clear()
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    start = time()
+    counts = replay(cowcatcher, fixture, args.threads, profiler)
+    wall = time() - start
+    snapshot = tracemalloc.take_snapshot() if tracemalloc is not None else None
+    if args.profile_out:
+        profiler.dump_stats(args.profile_out)
+    print_report(counts, profiler, wall, args, snapshot)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,23 @@
 """
 
 # Global imports
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from time import strftime
+from calendar import timegm
+from time import localtime, strftime
 import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
 import parsedatetime as pdt
 
 # Local imports
 import cowcatcher
+from tests import cowcatcher_replay, fake_aws
 
 
 class TestCowcatcher(unittest.TestCase):
@@ -25,6 +34,7 @@ class TestCowcatcher(unittest.TestCase):
     Pdtcal = pdt.Calendar(cons)
     Now_tm = Pdtcal.parse("now")
     Now_str = strftime('%c', Now_tm[0])
+    ReportARN = 'arn:aws:sns:us-west-2:123456789012:CowReport'
     @staticmethod
     def cowinfo_helper():
         """
@@ -72,6 +82,43 @@ class TestCowcatcher(unittest.TestCase):
         """
         print ""
 
+    def patch(self, name, value):
+        """
+        Set cowcatcher's name to value until the test ends
+        """
+        self.addCleanup(setattr, cowcatcher, name, getattr(cowcatcher, name))
+        setattr(cowcatcher, name, value)
+
+    def roundup_cache(self):
+        """
+        Point the roundup cache at an empty directory, removed when the
+        test ends
+        """
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.patch('ROUNDUP_CACHE_DIR', cache_dir)
+
+    def install_fake_aws(self, fleets, team_info=None, cowdef=None, **kwargs):
+        """
+        Return a FakeAws of fleets (kwargs go to FakeAws) answering
+        cowcatcher's calls until the test ends, with an empty roundup
+        cache. team.json then loads as team_info, if given, and other
+        definitions with cowdef's keys set.
+        """
+        aws = fake_aws.FakeAws(fleets, **kwargs)
+        self.roundup_cache()
+        if team_info is not None or cowdef:
+            load_definition_file = cowcatcher.load_definition_file
+            def bench_definition(file_name):
+                """ team_info, or the definition with cowdef's keys """
+                if team_info is not None and file_name == cowcatcher.TEAM_FILEPATH:
+                    return team_info
+                definition = load_definition_file(file_name)
+                return dict(definition, **(cowdef or {})) if definition else definition
+            self.patch('load_definition_file', bench_definition)
+        self.addCleanup(aws.install(cowcatcher))
+        return aws
+
 
     def test_load_definition_file(self):
         """
@@ -92,6 +139,75 @@ class TestCowcatcher(unittest.TestCase):
         team_info = cowcatcher.load_definition_file(bad_cowpath)
         self.assertEqual(len(team_info), 0)
 
+    def test_definition_cache(self):
+        """
+        Test definitions are parsed again only when their file changes
+        """
+        tmp_dir = tempfile.mkdtemp()
+        def_path = os.path.join(tmp_dir, 'ec2.json')
+        svc_info = cowcatcher.load_definition_file(cowcatcher.DEFS_PATH + 'ec2_TeamFoo.json')
+        parse_definition = cowcatcher.parse_definition
+        parsed = []
+        cowcatcher.parse_definition = lambda body: parsed.append(body) or parse_definition(body)
+        try:
+            with open(def_path, 'w') as deffile:
+                json.dump(svc_info, deffile)
+            first = cowcatcher.load_definition_file(def_path)
+            first['Service'] = 'changed'
+            self.assertEqual(cowcatcher.load_definition_file(def_path), svc_info)
+            self.assertEqual(len(parsed), 1)
+            # touched but unchanged: hashed, not parsed
+            os.utime(def_path, (0, 0))
+            cowcatcher.load_definition_file(def_path)
+            self.assertEqual(len(parsed), 1)
+            with open(def_path, 'w') as deffile:
+                json.dump(dict(svc_info, S3Suffix='TeamBar'), deffile)
+            self.assertEqual(cowcatcher.load_definition_file(def_path)['S3Suffix'], 'TeamBar')
+            self.assertEqual(len(parsed), 2)
+            with open(def_path, 'w') as deffile:
+                json.dump(dict(svc_info, CreateServiceReport='no', TagEngine='magic'), deffile)
+            self.assertEqual(cowcatcher.load_definition_file(def_path), '')
+        finally:
+            cowcatcher.parse_definition = parse_definition
+            shutil.rmtree(tmp_dir)
+
+    def test_validate_cowdef(self):
+        """
+        Test the shipped cowdefs follow the schema, and breaking it is caught
+        """
+        for name in ['ec2_TeamFoo.json', 'rds_TeamFoo.json', 'as_TeamFoo.json']:
+            svc_info = cowcatcher.load_definition_file(cowcatcher.DEFS_PATH + name)
+            self.assertEqual(cowcatcher.validate_cowdef(svc_info), [])
+        del svc_info['InstanceId']
+        svc_info['InstStateParent'] = None
+        svc_info['DiscoverTagsConcurrency'] = True
+        self.assertEqual(cowcatcher.validate_cowdef(svc_info),
+                         ['DiscoverTagsConcurrency has the wrong type: True',
+                          'InstStateParent may not be null', 'missing InstanceId'])
+        # autoscaling has no default Resource Groups Tagging API type
+        svc_info = cowcatcher.load_definition_file(cowcatcher.DEFS_PATH + 'as_TeamFoo.json')
+        self.assertEqual(cowcatcher.validate_cowdef(dict(svc_info, TagEngine='tagging')),
+                         ['TagEngine tagging needs a TaggingResourceType for autoscaling'])
+        self.assertEqual(cowcatcher.validate_cowdef(dict(
+            svc_info, TagEngine='tagging',
+            TaggingResourceType='autoscaling:autoScalingGroup')), [])
+
+    def test_extractor_states(self):
+        """
+        Test compiled extractors read states under a dict or a list
+        """
+        svc_info = cowcatcher.load_definition_file(cowcatcher.DEFS_PATH + 'as_TeamFoo.json')
+        groups = [{'AutoScalingGroupName': 'asg1', 'Tags': [{'Key': 'Owner', 'Value': 'me'}],
+                   'Instances': [{'LifecycleState': 'InService'}]},
+                  {'AutoScalingGroupName': 'asg2', 'Instances': []}]
+        stats = cowcatcher.discover_instance_tags(groups, None, svc_info)
+        self.assertEqual(stats, [{'id': 'asg1', 'state': 'InService', 'tags': {'Owner': 'me'}},
+                                 {'id': 'asg2', 'state': 'NoInstances', 'tags': {}}])
+        ec2_info = self.cowinfo_helper()
+        inst = {'InstanceId': 'i-1', 'InstanceType': 't2.micro', 'State': {'Name': 'stopped'}}
+        self.assertEqual(cowcatcher.instance_stats(inst, None, ec2_info),
+                         {'id': 'i-1', 'type': 't2.micro', 'state': 'stopped', 'tags': {}})
+
     def test_get_tag_keys(self):
         """
         Test the method that returns a list of keys
@@ -168,3 +284,1040 @@ class TestCowcatcher(unittest.TestCase):
         username = cowcatcher.get_cloudtrail_username(tags[0]['id'])
         self.assertGreaterEqual(len(username), 3)
 
+
+    def test_lookup_owner_cache(self):
+        """
+        Test that cached owners skip cloudtrail, and empty owners expire
+        """
+        lookups = []
+        def fake_username(rsc_name, ct_client=None):
+            lookups.append(rsc_name)
+            return 'someone'
+        saved = cowcatcher.get_cloudtrail_username
+        cowcatcher.get_cloudtrail_username = fake_username
+        try:
+            roundup = {'cows': [{'id': 'i-known', 'username': 'olduser'}]}
+            cache = cowcatcher.load_owner_cache(roundup, 1000)
+            cache['i-empty'] = {'username': '', 'checked': 1000}
+            stats = {'hits': 0, 'misses': 0}
+            self.assertEqual(cowcatcher.lookup_owner('i-known', cache, 2000, stats),
+                             'olduser')
+            self.assertEqual(cowcatcher.lookup_owner('i-empty', cache, 2000, stats), '')
+            self.assertEqual(cowcatcher.lookup_owner('i-new', cache, 2000, stats),
+                             'someone')
+            expired = 1000 + cowcatcher.OWNER_NEGATIVE_TTL
+            self.assertEqual(cowcatcher.lookup_owner('i-empty', cache, expired, stats),
+                             'someone')
+        finally:
+            cowcatcher.get_cloudtrail_username = saved
+        self.assertEqual(lookups, ['i-new', 'i-empty'])
+        self.assertEqual(stats, {'hits': 2, 'misses': 2})
+
+    def test_build_cloudtrail_owner_index(self):
+        """
+        Test the bulk owner index, keeping each resource's oldest creator
+        """
+        lookup = [{'AttributeKey': 'EventName', 'AttributeValue': 'RunInstances'}]
+        stubber = Stubber(cowcatcher.get_client('cloudtrail'))
+        stubber.add_response('lookup_events', {'Events': [
+            {'Username': 'newer', 'Resources': [{'ResourceName': 'i-0001'}]},
+            {'Username': '', 'Resources': [{'ResourceName': 'i-0002'}]},
+            {'Username': 'older', 'Resources': [
+                {'ResourceName': 'arn:aws:rds:us-west-2:1:db:mydb'},
+                {'ResourceName': 'i-0001'}]}]},
+                             {'LookupAttributes': lookup, 'StartTime': 1500000000})
+        with stubber:
+            index = cowcatcher.build_cloudtrail_owner_index('RunInstances', 1500000000)
+        self.assertEqual(index['i-0001'], 'older')
+        self.assertEqual(index['mydb'], 'older')
+        self.assertNotIn('i-0002', index)
+
+    def test_discover_instance_tags_concurrent(self):
+        """
+        Test concurrent tag discovery keeps order and retries throttling
+        """
+        class FakeRds(object):
+            """
+            Minimal rds client, throttling its first call
+            """
+            def __init__(self):
+                self.calls = 0
+
+            def list_tags_for_resource(self, ResourceName):
+                self.calls += 1
+                if self.calls == 1:
+                    raise cowcatcher.ClientError(
+                        {'Error': {'Code': 'Throttling', 'Message': 'slow down'}},
+                        'ListTagsForResource')
+                return {'TagList': [{'Key': 'Name', 'Value': ResourceName}]}
+
+        test_info = {'InstanceId': 'DBInstanceIdentifier', 'InstType': None,
+                     'InstStateParent': 'DBInstanceStatus', 'InstStateChild': None,
+                     'DiscoverTags': 'list_tags_for_resource(ResourceName=',
+                     'DiscoverTagsInstParm': 'DBInstanceArn', 'TagsKey': 'TagList',
+                     'DiscoverTagsConcurrency': 4}
+        insts = [{'DBInstanceIdentifier': 'db%d' % i, 'DBInstanceStatus': 'available',
+                  'DBInstanceArn': 'arn:db%d' % i} for i in range(20)]
+        client = FakeRds()
+        stats = cowcatcher.discover_instance_tags(insts, client, test_info)
+        self.assertEqual([s['id'] for s in stats], ['db%d' % i for i in range(20)])
+        self.assertEqual([s['tags']['Name'] for s in stats],
+                         ['arn:db%d' % i for i in range(20)])
+        self.assertEqual(client.calls, 21)
+
+    def test_tagging_engine_matches_describe(self):
+        """
+        Test both tag engines produce the same discovery records
+        """
+        test_info = self.cowinfo_helper()
+        tag_client = boto3.client('resourcegroupstaggingapi', region_name='us-west-2')
+        stubber = Stubber(tag_client)
+        stubber.add_response('get_resources', {'ResourceTagMappingList': [
+            {'ResourceARN': 'arn:aws:ec2:us-west-2:1:instance/i-0001',
+             'Tags': [{'Key': 'REPLACE_KEY1', 'Value': 'foo'},
+                      {'Key': 'Empty', 'Value': ''}]}]},
+                             {'ResourceTypeFilters': ['ec2:instance']})
+        insts = [{'InstanceId': 'i-0001', 'InstanceType': 't2.micro',
+                  'State': {'Name': 'running'},
+                  'Tags': [{'Key': 'REPLACE_KEY1', 'Value': 'foo'},
+                           {'Key': 'Empty', 'Value': ''}]},
+                 {'InstanceId': 'i-0002', 'InstanceType': 't2.micro',
+                  'State': {'Name': 'stopped'}}]
+        described = cowcatcher.discover_instance_tags(insts, None, test_info)
+        with stubber:
+            tag_index = cowcatcher.get_tagging_index(tag_client, 'ec2:instance')
+        joined = cowcatcher.discover_instance_tags(insts, None, test_info, tag_index)
+        self.assertEqual(described, joined)
+        self.assertEqual(joined[1]['tags'], {})
+
+    def test_main_parallel_services_keep_order(self):
+        """
+        Test parallel services are joined into the team report in CowDefs order
+        """
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': True,
+                     'ServiceWorkers': 3, 'CowDefs': ['a.json', 'b.json', 'c.json']}
+        delays = {'a.json': 0.3, 'b.json': 0.2, 'c.json': 0.1}
+        sent = []
+        def fake_process(svc, team, now_tm, now_str, *scope):
+            time.sleep(delays[svc])
+            svc_info = {'Service': svc, 'InstType': None}
+            roundup = {'last_run': now_str, 'action_summary': {}, 'cows': [
+                {'id': svc, 'state': None, 'tags': {}, 'action_history': [],
+                 'initial_discovery_str': now_str}]}
+            return svc_info, (roundup, svc_info, '')
+        saved = (cowcatcher.load_definition_file, cowcatcher.process_service,
+                 cowcatcher.send_report, cowcatcher.load_checkpoint)
+        cowcatcher.load_definition_file = lambda file_name: team_info
+        cowcatcher.process_service = fake_process
+        cowcatcher.send_report = lambda text, svc_info, now_str, *args: sent.append(''.join(text))
+        cowcatcher.load_checkpoint = lambda bucket, key: None
+        try:
+            cowcatcher.main('foo', 'bar')
+        finally:
+            (cowcatcher.load_definition_file, cowcatcher.process_service,
+             cowcatcher.send_report, cowcatcher.load_checkpoint) = saved
+        self.assertEqual(len(sent), 1)
+        self.assertEqual([line for line in sent[0].split('\n') if 'ID:' in line],
+                         ['    ID:      a.json', '    ID:      b.json',
+                          '    ID:      c.json'])
+
+    def test_main_fake_aws(self):
+        """
+        Test a cold then warm team run end to end against the in-memory AWS
+        """
+        fleets = {svc: fake_aws.make_fleet(svc, 120, 0.25)
+                  for svc in ['ec2', 'rds', 'autoscaling']}
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': True,
+                     'CowDefs': ['ec2_TeamFoo.json', 'rds_TeamFoo.json', 'as_TeamFoo.json']}
+        aws = self.install_fake_aws(fleets, team_info,
+                                    {'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS,
+                                     'CowReportARN': self.ReportARN})
+        cowcatcher.main('foo', 'bar')
+        cold_calls = dict(aws.calls)
+        aws.calls.clear()
+        cowcatcher.main('foo', 'bar')
+        self.assertEqual(len(aws.published), 2)
+        roundup = cowcatcher.decode_roundup(
+            aws.objects[(self.Bucket, 'ec2_TeamFoo.json')]['Body'])
+        untagged = [rsc for rsc in fleets['ec2'] if len(rsc['tags']) == 1]
+        self.assertEqual(len(roundup['cows']), len(untagged))
+        self.assertEqual(cold_calls['ListTagsForResource'], 120)
+        self.assertEqual(cold_calls['DescribeAutoScalingGroups'], 3)
+        # owners are cached with the roundup after the cold run
+        self.assertNotIn('LookupEvents', aws.calls)
+
+    def test_main_invalid_cowdef(self):
+        """
+        Test a cowdef failing validation is skipped and the team's other
+        services still run and report
+        """
+        fleets = {svc: fake_aws.make_fleet(svc, 20, 0.5) for svc in ['ec2', 'rds']}
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': True,
+                     'ServiceWorkers': 2,
+                     'CowDefs': ['ec2_TeamFoo.json', 'as_Bad.json', 'rds_TeamFoo.json']}
+        defs_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, defs_dir)
+        bad_path = os.path.join(defs_dir, 'as_Bad.json')
+        load_definition_file = cowcatcher.load_definition_file
+        with open(bad_path, 'w') as deffile:
+            json.dump(dict(load_definition_file(cowcatcher.DEFS_PATH + 'as_TeamFoo.json'),
+                           TagEngine='tagging'), deffile)
+        self.assertEqual(load_definition_file(bad_path), '')
+        aws = self.install_fake_aws(fleets, team_info,
+                                    {'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS,
+                                     'CowReportARN': self.ReportARN})
+        bench_definition = cowcatcher.load_definition_file
+        self.patch('load_definition_file', lambda file_name: bench_definition(
+            bad_path if file_name.endswith('as_Bad.json') else file_name))
+        cowcatcher.main('foo', 'bar')
+        self.assertIn((self.Bucket, 'ec2_TeamFoo.json'), aws.objects)
+        self.assertIn((self.Bucket, 'rds_TeamFoo.json'), aws.objects)
+        self.assertNotIn('DescribeAutoScalingGroups', aws.calls)
+        self.assertEqual(len(aws.published), 1)
+        self.assertIn('Service: rds', aws.published[0]['Message'])
+
+    def test_process_service_metrics(self):
+        """
+        Test a service run emits one EMF line with phases and API counts
+        """
+        aws = self.install_fake_aws({'rds': fake_aws.make_fleet('rds', 30, 0.5)},
+                                    cowdef={'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS},
+                                    throttle_ratio={'ListTagsForResource': 0.3})
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo'}
+        lines = []
+        self.patch('emit_metrics', lambda *args: lines.append(cowcatcher.emf_line(*args)))
+        self.patch('BACKOFF_BASE', 0.0001)
+        cowcatcher.process_service('rds_TeamFoo.json', team_info, self.Now_tm, self.Now_str)
+        self.assertEqual(len(lines), 1)
+        line = json.loads(lines[0])
+        directive = line['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Dimensions'], [['Service', 'Team']])
+        self.assertEqual((line['Service'], line['Team']), ('rds', 'TeamFoo'))
+        names = set(metric['Name'] for metric in directive['Metrics'])
+        self.assertTrue(set(phase + 'Time' for phase in cowcatcher.METRIC_PHASES) <= names)
+        self.assertTrue(all(name in line for name in names))
+        throttles = line['ListTagsForResourceThrottles']
+        self.assertTrue(throttles > 0)
+        self.assertEqual(line['ListTagsForResourceCalls'], 30 + throttles)
+        self.assertEqual(line['ListTagsForResourceRetries'], throttles)
+        self.assertEqual(line['ApiCalls'], sum(aws.calls.values()))
+        self.assertEqual(line['Cows'], len([rsc for rsc in aws.tags.values()
+                                            if len(rsc) == 1]))
+        self.assertTrue(line['PaginationTime'] > 0)
+        self.assertTrue(line['ApiCallRate'] > 0)
+        self.assertIsNone(cowcatcher.current_metrics())
+        # the throttles were learned by the operation's bucket
+        self.assertTrue(cowcatcher.GOVERNOR['buckets'].pop(
+            ('rds', None, None, 'ListTagsForResource'))['rate'] > 0)
+
+    def test_checkpoint_resume(self):
+        """
+        Test a run stopped by its deadline checkpoints, and the next resumes it
+        """
+        fleet = fake_aws.make_fleet('ec2', 2500, 0.3)
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': True,
+                     'CowDefs': ['ec2_TeamFoo.json']}
+        class Context(object):
+            @staticmethod
+            def get_remaining_time_in_millis():
+                return 900000
+        aws = self.install_fake_aws({'ec2': fleet}, team_info,
+                                    {'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS,
+                                     'CowReportARN': self.ReportARN})
+        out_of_time = cowcatcher.out_of_time
+        # the deadline passes once two pages have been described
+        self.patch('out_of_time', lambda deadline: aws.calls['DescribeInstances'] >= 2)
+        checkpoint_key = (self.Bucket, 'checkpoints/TeamFoo.json')
+        roundup_key = (self.Bucket, 'ec2_TeamFoo.json')
+        cowcatcher.main('foo', Context())
+        self.assertIn(checkpoint_key, aws.objects)
+        self.assertNotIn(roundup_key, aws.objects)
+        self.assertEqual(aws.published, [])
+        checkpoint = json.loads(aws.objects[checkpoint_key]['Body'].decode('utf-8'))
+        task = checkpoint['tasks']['ec2_TeamFoo.json||']
+        self.assertFalse(task['paged'])
+        self.assertEqual(len(task['cows']), len([rsc for rsc in fleet[:2000]
+                                                 if len(rsc['tags']) == 1]))
+        cowcatcher.out_of_time = out_of_time
+        cowcatcher.main('foo', Context())
+        self.assertEqual(aws.calls['DescribeInstances'], 3)
+        self.assertNotIn(checkpoint_key, aws.objects)
+        self.assertEqual(len(aws.published), 1)
+        roundup = cowcatcher.decode_roundup(aws.objects[roundup_key]['Body'])
+        self.assertEqual(len(roundup['cows']),
+                         len([rsc for rsc in fleet if len(rsc['tags']) == 1]))
+        self.assertEqual(roundup['last_run_epoch'], checkpoint['run_epoch'])
+
+    def test_record_pending_actions(self):
+        """
+        Test actions written ahead are recorded once, as unconfirmed
+        """
+        roundup = cowcatcher.migrate_roundup(self.roundup_helper())
+        ids = [cow['id'] for cow in roundup['cows']]
+        pending = {'at': self.Now_str, 'actions': {'stop': ids[:2]}}
+        roundup['cows'][1]['action_history'].append('stop at ' + self.Now_str)
+        lengths = [len(cow['action_history']) for cow in roundup['cows']]
+        roundup = cowcatcher.record_pending_actions(roundup, pending)
+        self.assertEqual(roundup['cows'][0]['action_history'][-1],
+                         'stop at ' + self.Now_str + ' (unconfirmed)')
+        self.assertEqual([len(cow['action_history']) for cow in roundup['cows']],
+                         [lengths[0] + 1] + lengths[1:])
+        self.assertEqual([cow.get('last_action') for cow in roundup['cows'][:2]],
+                         ['stop', 'stop'])
+
+        written = []
+        test_info = self.cowinfo_helper()
+        test_info['CowActions'] = [{'action': 'stop', 'time_delta': '+1 day',
+                                    'api': 'stop_instances', 'id_param': 'InstanceIds',
+                                    'id_list': True}]
+        new_cows = [{'id': cow_id, 'tags': {}, 'state': 'running', 'type': 't2.micro'}
+                    for cow_id in ids]
+        client = boto3.client('ec2', region_name='us-west-2')
+        with Stubber(client) as stubber:
+            stubber.add_response('stop_instances', {}, {'InstanceIds': ids})
+            cowcatcher.handle_cows(new_cows, roundup, client, test_info, self.Pdtcal,
+                                   self.Now_tm, self.Now_str, written.append, enforce=True)
+        self.assertEqual(written, [{'stop': ids}])
+
+    def test_rate_governor(self):
+        """
+        Test token buckets pace calls, learn from throttles and count the budget
+        """
+        waits = []
+        clock = [1000.0]
+        saved = cowcatcher.sleep, dict(cowcatcher.GOVERNOR), cowcatcher.time
+        cowcatcher.sleep = waits.append
+        cowcatcher.time = lambda: clock[0]
+        try:
+            cowcatcher.GOVERNOR['buckets'] = {}
+            cowcatcher.start_governor({'ApiRates': {'ec2': 10}, 'ApiBudget': 12})
+            capped = ('ec2', None, None, 'DescribeInstances')
+            free = ('rds', None, None, 'ListTagsForResource')
+            for _ in range(11):
+                cowcatcher.acquire_token(capped)
+            # a burst of one second's calls, then a wait for the next token
+            self.assertEqual(len(waits), 1)
+            self.assertAlmostEqual(waits[0], 0.1, places=2)
+            self.assertFalse(cowcatcher.budget_spent())
+            self.assertFalse(cowcatcher.out_of_time(float('inf')))
+            cowcatcher.acquire_token(free)
+            self.assertTrue(cowcatcher.budget_spent())
+            self.assertTrue(cowcatcher.out_of_time(float('inf')))
+            self.assertFalse(cowcatcher.out_of_time(None))
+
+            cowcatcher.adjust_rate(capped, True)
+            cowcatcher.adjust_rate(capped, True)
+            buckets = cowcatcher.GOVERNOR['buckets']
+            self.assertEqual(buckets[capped]['rate'], 5.0)
+            for _ in range(200):
+                cowcatcher.adjust_rate(capped, False)
+            self.assertEqual(buckets[capped]['rate'], 10.0)
+            # unlimited until throttled, then half the rate it was called at:
+            # 20 calls/s for 3s, a throttle just after a new second starts
+            for _ in range(60):
+                clock[0] += 0.05
+                cowcatcher.acquire_token(free)
+            self.assertIsNone(buckets[free]['rate'])
+            cowcatcher.adjust_rate(free, True)
+            self.assertTrue(9.0 <= buckets[free]['rate'] <= 10.5, buckets[free]['rate'])
+            # a lone call counts as about a call a second
+            lone = ('cloudtrail', None, None, 'LookupEvents')
+            cowcatcher.acquire_token(lone)
+            cowcatcher.adjust_rate(lone, True)
+            self.assertTrue(buckets[lone]['rate'] > 0.5, buckets[lone]['rate'])
+
+            summary = cowcatcher.governor_summary()
+            self.assertEqual((summary['calls'], summary['throttles'], summary['budget']),
+                             (73, 4, 12))
+            self.assertEqual(summary['rates']['ec2.DescribeInstances'], 10.0)
+            self.assertEqual(summary['rates']['rds.ListTagsForResource'],
+                             round(buckets[free]['rate'], 2))
+            self.assertAlmostEqual(summary['rate_wait_seconds'], waits[0], places=3)
+        finally:
+            cowcatcher.sleep, cowcatcher.time = saved[0], saved[2]
+            cowcatcher.GOVERNOR.clear()
+            cowcatcher.GOVERNOR.update(saved[1])
+
+    def test_history_store(self):
+        """
+        Test runs write history files the trend helpers read back by range,
+        while the roundup keeps a bounded action history
+        """
+        aws = self.install_fake_aws({'ec2': fake_aws.make_fleet('ec2', 40, 0.5)},
+                                    cowdef={'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS})
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': False,
+                     'EmitMetrics': False, 'KeepHistory': True, 'ActionHistoryLimit': 2,
+                     'EnforceActions': True}
+        # a Monday noon, then 2, 9 and 10 days later
+        start = timegm((2026, 1, 5, 12, 0, 0))
+        day = 60 * 60 * 24
+        cows = [rsc for rsc in aws.resources['ec2'] if len(rsc['Tags']) == 1]
+        for run, offset in enumerate([0, 2, 9, 10]):
+            now_tm = (localtime(start + offset * day), 2)
+            cowcatcher.process_service('ec2_TeamFoo.json', team_info, now_tm,
+                                       strftime('%c', now_tm[0]))
+            if run == 0:
+                cows[0]['Tags'].extend({'Key': key, 'Value': 'x'}
+                                       for key in fake_aws.FLEET_TAG_KEYS)
+                # deleted, so it leaves the herd untagged
+                aws.resources['ec2'].remove(cows[1])
+        roundup = cowcatcher.decode_roundup(
+            aws.objects[(self.Bucket, 'ec2_TeamFoo.json')]['Body'])
+        weekly = cowcatcher.cows_per_week(self.Bucket, ['ec2_TeamFoo.json'])
+        later = cowcatcher.cows_per_week(self.Bucket, ['ec2_TeamFoo.json'],
+                                         since=start + day)
+        # header and columns beyond the first bytes are fetched by range
+        self.patch('HISTORY_HEAD_BYTES', 16)
+        tagged = cowcatcher.time_to_tag(self.Bucket, 'ec2_TeamFoo.json')
+        left = [(record.id, record.reason) for _, run_records in
+                cowcatcher.iter_history(self.Bucket, 'ec2_TeamFoo.json',
+                                        ('id', 'gone', 'reason'))
+                for record in run_records if record.gone]
+        history_key = min(key for bucket, key in aws.objects
+                          if key.startswith('history/ec2_TeamFoo/'))
+        aws.ranged_bytes = 0
+        cowcatcher.read_history(self.Bucket, history_key, ['gone'])
+        ranged_bytes = aws.ranged_bytes
+        header, records = next(cowcatcher.iter_history(self.Bucket, 'ec2_TeamFoo.json',
+                                                       since=start + 9 * day))
+        self.assertEqual(len([key for bucket, key in aws.objects
+                              if key.startswith('history/ec2_TeamFoo/')]), 4)
+        self.assertEqual(weekly, {'ec2': {'2026-01-05': len(cows),
+                                          '2026-01-12': len(cows) - 2}})
+        self.assertEqual(later, {'ec2': {'2026-01-05': len(cows) - 2,
+                                         '2026-01-12': len(cows) - 2}})
+        self.assertEqual(tagged, {cows[0]['InstanceId']: 2 * day})
+        self.assertEqual(sorted(left), sorted([(cows[0]['InstanceId'], 'tagged'),
+                                               (cows[1]['InstanceId'], 'removed')]))
+        # only the header and the gone column were downloaded
+        self.assertTrue(0 < ranged_bytes <
+                        len(aws.objects[(self.Bucket, history_key)]['Body']))
+        self.assertEqual(header['run_epoch'], start + 9 * day)
+        self.assertEqual(sorted(record.id for record in records),
+                         sorted(rsc['InstanceId'] for rsc in cows[2:]))
+        self.assertEqual(set((record.action, record.gone) for record in records),
+                         set([('report', 0)]))
+        self.assertEqual(set(len(cow['action_history']) for cow in roundup['cows']),
+                         set([2]))
+        self.assertEqual(roundup['cows'][0]['action_history'][-1],
+                         'report at ' + strftime('%c', localtime(start + 10 * day)))
+
+    def test_record_replay(self):
+        """
+        Test a run recorded against AWS replays offline to the same roundups
+        """
+        fleets = {svc: fake_aws.make_fleet(svc, 60, 0.3) for svc in ['ec2', 'rds']}
+        aws = fake_aws.FakeAws(fleets)
+        defs_dir = tempfile.mkdtemp()
+        for name in ['ec2_TeamFoo.json', 'rds_TeamFoo.json']:
+            svc_info = cowcatcher.load_definition_file(cowcatcher.DEFS_PATH + name)
+            svc_info['CowKeyChecklist'] = fake_aws.FLEET_TAG_KEYS
+            svc_info['CowReportARN'] = 'arn:aws:sns:us-west-2:123456789012:CowReport'
+            with open(os.path.join(defs_dir, name), 'w') as deffile:
+                json.dump(svc_info, deffile)
+        with open(os.path.join(defs_dir, 'team.json'), 'w') as deffile:
+            json.dump({'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': True,
+                       'EmitMetrics': False, 'ServiceWorkers': 2,
+                       'CowDefs': ['ec2_TeamFoo.json', 'rds_TeamFoo.json']}, deffile)
+        fixture_path = os.path.join(defs_dir, 'run.json.gz')
+        uninstall = aws.install(cowcatcher)
+        try:
+            fixture = cowcatcher_replay.record(cowcatcher, defs_dir)
+        finally:
+            uninstall()
+        cowcatcher_replay.save_fixture(fixture, fixture_path)
+        fixture = cowcatcher_replay.load_fixture(fixture_path)
+        shutil.rmtree(defs_dir)
+
+        counts = cowcatcher_replay.replay(cowcatcher, fixture)
+        self.assertEqual(dict(counts['missed']), {})
+        self.assertEqual(counts['replayed']['ListTagsForResource'], 60)
+        self.assertEqual(counts['replayed']['DescribeInstances'], aws.calls['DescribeInstances'])
+        self.assertEqual(counts['stubbed']['Publish'], 1)
+        written = dict((params['Key'], cowcatcher.decode_roundup(params['Body']))
+                       for operation, params in counts['writes']
+                       if operation == 'PutObject' and params['Key'].endswith('.json'))
+        for key in ['ec2_TeamFoo.json', 'rds_TeamFoo.json']:
+            recorded = cowcatcher.decode_roundup(aws.objects[(self.Bucket, key)]['Body'])
+            self.assertEqual(sorted((cow['id'], cow.get('username')) for cow in recorded['cows']),
+                             sorted((cow['id'], cow.get('username'))
+                                    for cow in written[key]['cows']))
+        # assumed-role secrets never reach a fixture
+        assumed = {'Credentials': {'AccessKeyId': 'ASIAEXAMPLE', 'SecretAccessKey': 'secret',
+                                   'SessionToken': 'token', 'Expiration': {'$datetime': 1.0}},
+                   'AssumedRoleUser': {'Arn': 'arn:aws:sts::123456789012:assumed-role/x/y'}}
+        redacted = cowcatcher_replay.redact(assumed)
+        self.assertEqual(redacted['Credentials'],
+                         dict(cowcatcher_replay.REDACTED_CREDENTIALS,
+                              Expiration={'$datetime': 1.0}))
+        self.assertEqual(redacted['AssumedRoleUser'], assumed['AssumedRoleUser'])
+        self.assertEqual(assumed['Credentials']['SecretAccessKey'], 'secret')
+
+    def test_handle_event(self):
+        """
+        Test CloudTrail events update only their ids in the roundup
+        """
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': True,
+                     'CowDefs': ['ec2_TeamFoo.json']}
+        aws = self.install_fake_aws({'ec2': fake_aws.make_fleet('ec2', 10, 0.5)}, team_info,
+                                    {'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS,
+                                     'CowReportARN': self.ReportARN})
+        def event(name, request=None, response=None, identity=None):
+            return {'detail-type': 'AWS API Call via CloudTrail', 'source': 'aws.ec2',
+                    'account': '123456789012', 'region': 'us-west-2',
+                    'detail': {'eventSource': 'ec2.amazonaws.com', 'eventName': name,
+                               'requestParameters': request, 'responseElements': response,
+                               'userIdentity': identity or {}}}
+        def items(key, ids):
+            return {key: {'items': [{'instanceId': rsc_id} for rsc_id in ids]}}
+        roundup_key = (self.Bucket, 'ec2_TeamFoo.json')
+        cowcatcher.main('foo', 'bar')
+        cows = [cow['id'] for cow in cowcatcher.decode_roundup(
+            aws.objects[roundup_key]['Body'])['cows']]
+        launched = fake_aws.ec2_instance({'num': 99, 'state': 'running',
+                                          'tags': [{'Key': 'Name', 'Value': 'x'}]})
+        aws.resources['ec2'].append(launched)
+        aws.calls.clear()
+        cowcatcher.handle_event(event(
+            'RunInstances', response=items('instancesSet', [launched['InstanceId']]),
+            identity={'type': 'AssumedRole',
+                      'arn': 'arn:aws:sts::123456789012:assumed-role/dev/alice'}),
+            None)
+        self.assertEqual(aws.calls['DescribeInstances'], 1)
+        self.assertNotIn('LookupEvents', aws.calls)
+        self.assertEqual(len(aws.published), 2)
+        roundup = cowcatcher.decode_roundup(aws.objects[roundup_key]['Body'])
+        self.assertEqual([cow['id'] for cow in roundup['cows']],
+                         cows + [launched['InstanceId']])
+        self.assertEqual(roundup['cows'][-1]['username'], 'alice')
+        self.assertEqual(roundup['delta']['new'], [launched['InstanceId']])
+
+        # the first cow gets tagged, the second is terminated
+        tagged = [rsc for rsc in aws.resources['ec2'] if rsc['InstanceId'] == cows[0]][0]
+        tagged['Tags'] = tagged['Tags'] + [{'Key': key, 'Value': 'v'}
+                                           for key in fake_aws.FLEET_TAG_KEYS]
+        cowcatcher.handle_event(event('CreateTags', request={'resourcesSet': {
+            'items': [{'resourceId': cows[0]}, {'resourceId': 'sg-1'}]}}), None)
+        cowcatcher.handle_event(event('TerminateInstances',
+                                      request=items('instancesSet', [cows[1]])), None)
+        cowcatcher.handle_event(event('CreateTags'), None)
+        roundup = cowcatcher.decode_roundup(aws.objects[roundup_key]['Body'])
+        event_calls = dict(aws.calls)
+        # once the ApiBudget is spent, the tasks left are skipped
+        team_info.update(ApiBudget=1, CowDefs=['ec2_TeamFoo.json'] * 2)
+        aws.calls.clear()
+        cowcatcher.handle_event(event('CreateTags', request={'resourcesSet': {
+            'items': [{'resourceId': cows[2]}]}}), None)
+        self.assertEqual([cow['id'] for cow in roundup['cows']],
+                         cows[2:] + [launched['InstanceId']])
+        self.assertEqual([cow['id'] for cow in roundup['delta']['gone']], [cows[1]])
+        self.assertEqual(event_calls['DescribeInstances'], 2)
+        self.assertEqual(aws.calls['DescribeInstances'], 1)
+        self.assertEqual(len(aws.published), 2)
+
+    def test_handle_event_filters_missing(self):
+        """
+        Test an event's ids are described within the cowdef's filters, and
+        only ids confirmed missing leave the roundup
+        """
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'CreateTeamReport': False,
+                     'CowDefs': ['ec2_TeamFoo.json']}
+        aws = self.install_fake_aws(
+            {'ec2': fake_aws.make_fleet('ec2', 10, 0.5)}, team_info,
+            {'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS,
+             'InstanceFilters': [{'Name': 'tag:Name', 'Values': ['ec2-*']}]})
+        launched = [fake_aws.ec2_instance({'num': num, 'state': 'running',
+                                           'tags': [{'Key': 'Name', 'Value': name}]})
+                    for num, name in [(97, 'ec2-97'), (98, 'other'), (99, 'ec2-99')]]
+        roundup_key = (self.Bucket, 'ec2_TeamFoo.json')
+        cowcatcher.main('foo', 'bar')
+        cows = [cow['id'] for cow in cowcatcher.decode_roundup(
+            aws.objects[roundup_key]['Body'])['cows']]
+        # 98 is outside the filters; 99 and the first cow are already gone
+        aws.resources['ec2'].extend(launched[:2])
+        aws.resources['ec2'] = [rsc for rsc in aws.resources['ec2']
+                                if rsc['InstanceId'] != cows[0]]
+        aws.calls.clear()
+        ids = [rsc['InstanceId'] for rsc in launched] + [cows[0]]
+        cowcatcher.handle_event({
+            'detail-type': 'AWS API Call via CloudTrail', 'source': 'aws.ec2',
+            'account': '123456789012', 'region': 'us-west-2',
+            'detail': {'eventSource': 'ec2.amazonaws.com', 'eventName': 'RunInstances',
+                       'responseElements': {'instancesSet': {'items': [
+                           {'instanceId': rsc_id} for rsc_id in ids]}},
+                       'userIdentity': {}}}, None)
+        roundup = cowcatcher.decode_roundup(aws.objects[roundup_key]['Body'])
+        self.assertEqual(aws.calls['DescribeInstances'], 1)
+        self.assertEqual([cow['id'] for cow in roundup['cows']],
+                         cows[1:] + [launched[0]['InstanceId']])
+        self.assertEqual(roundup['delta']['new'], [launched[0]['InstanceId']])
+        self.assertEqual([cow['id'] for cow in roundup['delta']['gone']], cows[:1])
+
+    def test_main_teams_share_discovery(self):
+        """
+        Test teams share one scan, each with its own filters, rules and roundups
+        """
+        fleet = fake_aws.make_fleet('ec2', 1500, 0.3)
+        teams = {'team_a.json': {'Bucket': 'cows-a', 'Team': 'TeamA', 'KeepHistory': True,
+                                 'CreateTeamReport': True, 'CowDefs': ['ec2_a.json']},
+                 'team_b.json': {'Bucket': 'cows-b', 'Team': 'TeamB',
+                                 'CreateTeamReport': False, 'CowDefs': ['ec2_b.json']}}
+        ec2_info = cowcatcher.load_definition_file(cowcatcher.DEFS_PATH + 'ec2_TeamFoo.json')
+        cowdefs = {'ec2_a.json': dict(ec2_info, CowKeyChecklist=['Owner'],
+                                      CowReportARN='arn:aws:sns:us-west-2:1:CowReport'),
+                   'ec2_b.json': dict(ec2_info, CowKeyChecklist=['CostCenter'],
+                                      InstanceFilters=[{'Name': 'tag:Name',
+                                                        'Values': ['ec2-1?']}])}
+        definitions = dict(teams, **cowdefs)
+        definitions['team.json'] = {'Teams': ['team_a.json', 'team_b.json']}
+        aws = self.install_fake_aws({'ec2': fleet})
+        self.patch('load_definition_file',
+                   lambda name: dict(definitions[name.split('/')[-1]]))
+        untagged = [rsc for rsc in fleet if len(rsc['tags']) == 1]
+        cowcatcher.main('foo', 'bar')
+        self.assertEqual(aws.calls['DescribeInstances'], 2)
+        # tagged for team A between two shared scans
+        tagged = untagged.pop(0)
+        tagged['tags'].append({'Key': 'Owner', 'Value': 'x'})
+        cowcatcher.main('foo', 'bar')
+        left = [(record.id, record.reason) for _, records in
+                cowcatcher.iter_history('cows-a', 'ec2_TeamFoo.json', ('id', 'reason'))
+                for record in records if record.reason]
+        time_to_tag = cowcatcher.time_to_tag('cows-a', 'ec2_TeamFoo.json')
+        # a scan of its own for team B, skipped once the ApiBudget is spent
+        definitions['team.json']['ApiBudget'] = 1
+        definitions['team_b.json']['Regions'] = ['us-west-2']
+        aws.calls.clear()
+        roundup_b = aws.objects[('cows-b', 'ec2_TeamFoo.json')]
+        cowcatcher.main('foo', 'bar')
+        budget_calls = dict(aws.calls)
+        self.assertEqual(left, [('i-%017x' % tagged['num'], 'tagged')])
+        self.assertEqual(list(time_to_tag), ['i-%017x' % tagged['num']])
+        self.assertEqual(budget_calls['DescribeInstances'], 2)
+        self.assertIs(aws.objects[('cows-b', 'ec2_TeamFoo.json')], roundup_b)
+        roundup_a = cowcatcher.decode_roundup(aws.objects[('cows-a', 'ec2_TeamFoo.json')]['Body'])
+        self.assertEqual(len(roundup_a['cows']), len(untagged))
+        roundup_b = cowcatcher.decode_roundup(aws.objects[('cows-b', 'ec2_TeamFoo.json')]['Body'])
+        self.assertEqual(sorted(cow['id'] for cow in roundup_b['cows']),
+                         sorted('i-%017x' % rsc['num'] for rsc in untagged
+                                if 10 <= rsc['num'] < 20))
+        self.assertEqual(len(aws.published), 3)
+        self.assertFalse(cowcatcher.filters_match(
+            {'tags': {}, 'state': 'running'},
+            [{'Name': 'instance-state-name', 'Values': ['stopped']}]))
+        self.assertNotEqual(cowcatcher.discovery_key(cowdefs['ec2_a.json']),
+                            cowcatcher.discovery_key(dict(cowdefs['ec2_a.json'],
+                                                          InstanceFilters=[{
+                                                              'Name': 'vpc-id',
+                                                              'Values': ['vpc-1']}])))
+
+    def test_sharded_scan(self):
+        """
+        Test a service scanned in shards, on a local process pool then on
+        Lambda invocations with one failing, merges into one roundup
+        """
+        team_info = {'Bucket': self.Bucket, 'Team': 'TeamFoo', 'EmitMetrics': False}
+        aws = self.install_fake_aws({'rds': fake_aws.make_fleet('rds', 60, 0.5)}, team_info,
+                                    {'ShardCount': 3,
+                                     'CowKeyChecklist': fake_aws.FLEET_TAG_KEYS})
+        def worker(event, context):
+            if event['Shard'][0] == 1:
+                raise RuntimeError('shard lost')
+            return cowcatcher.main(event, context)
+        aws.functions['DiscoverCows'] = worker
+        untagged = sorted(arn.split(':')[-1] for arn, tags in aws.tags.items()
+                          if len(tags) == 1)
+        shards = dict((rsc_id, cowcatcher.shard_of(rsc_id, 3)) for rsc_id in untagged)
+        # one cow of shard 0 and one of the failing shard 1 get tagged
+        fixed = [[rsc_id for rsc_id in untagged if shards[rsc_id] == idx][0]
+                 for idx in (0, 1)]
+        cowcatcher.process_service('rds_TeamFoo.json', team_info, self.Now_tm,
+                                   self.Now_str)
+        pooled = cowcatcher.decode_roundup(
+            aws.objects[(self.Bucket, 'rds_TeamFoo.json')]['Body'])
+        for rsc_id in fixed:
+            aws.tags['arn:aws:rds:%s:%s:db:%s' % (fake_aws.REGION, fake_aws.ACCOUNT,
+                                                  rsc_id)].extend(
+                {'Key': key, 'Value': 'x'} for key in fake_aws.FLEET_TAG_KEYS)
+        aws.calls.clear()
+        team_info['ShardFunction'] = 'DiscoverCows'
+        cowcatcher.process_service('rds_TeamFoo.json', team_info, self.Now_tm,
+                                   self.Now_str)
+        invoked = cowcatcher.decode_roundup(
+            aws.objects[(self.Bucket, 'rds_TeamFoo.json')]['Body'])
+        invoke_calls = dict(aws.calls)
+        # paging stopped by the deadline sends nothing, keeping its records
+        aws.calls.clear()
+        svc_info = cowcatcher.load_definition_file(cowcatcher.DEFS_PATH + 'rds_TeamFoo.json')
+        stopped = cowcatcher.scan_shards('rds_TeamFoo.json', svc_info, team_info,
+                                         cowcatcher.get_client('rds'), {'deadline': 0},
+                                         [{'DBInstanceIdentifier': 'db-left'}])
+        self.assertEqual([cow['id'] for cow in pooled['cows']], untagged)
+        self.assertEqual(stopped, ([], [], [{'DBInstanceIdentifier': 'db-left'}]))
+        self.assertEqual(invoke_calls['Invoke'], 3)
+        # the coordinator paged once; shards 0 and 2 tagged their own instances
+        self.assertEqual(invoke_calls['DescribeDBInstances'], 1)
+        self.assertEqual(invoke_calls['ListTagsForResource'],
+                         len([rsc for rsc in aws.resources['rds'] if cowcatcher.shard_of(
+                             rsc['DBInstanceIdentifier'], 3) <> 1]))
+        held = [cow for cow in pooled['cows'] if shards[cow['id']] == 1]
+        self.assertEqual([cow['id'] for cow in invoked['cows']],
+                         [rsc_id for rsc_id in untagged
+                          if shards[rsc_id] <> 1 and rsc_id <> fixed[0]] +
+                         [cow['id'] for cow in held])
+        self.assertEqual(invoked['cows'][-len(held):], held)
+        self.assertEqual([cow['id'] for cow in invoked['delta']['gone']], fixed[:1])
+        # results merge the same in any order
+        results = [{'Shard': 2, 'Cows': [{'id': 'c'}]}, {'Shard': 0, 'Cows': [{'id': 'b'}]},
+                   {'Shard': 1, 'Error': 'lost'}, {'Shard': 3, 'Cows': [{'id': 'a'}]}]
+        self.assertEqual(cowcatcher.merge_shards(results, 4),
+                         cowcatcher.merge_shards(results[::-1], 4))
+        self.assertEqual(cowcatcher.merge_shards(results, 4),
+                         ([{'id': 'a'}, {'id': 'b'}, {'id': 'c'}], [1]))
+        # tags from the describe response leave nothing to shard
+        ec2_info = dict(cowcatcher.load_definition_file('cowdefs/ec2_TeamFoo.json'),
+                        ShardCount=3)
+        self.assertEqual(cowcatcher.validate_cowdef(ec2_info),
+                         ['ShardCount needs tags from per-instance DiscoverTags calls'])
+
+    def test_team_tasks_roundup_keys(self):
+        """
+        Test account/region fan-out tasks and their roundup keys
+        """
+        test_info = self.cowinfo_helper()
+        role = 'arn:aws:iam::123456789012:role/cowcatcher'
+        team_info = {'CowDefs': ['ec2_TeamFoo.json', 'rds_TeamFoo.json'],
+                     'Regions': ['us-west-2', 'us-east-1'],
+                     'AssumeRoleArns': [role]}
+        tasks = cowcatcher.team_tasks(team_info)
+        self.assertEqual(tasks[:3], [('ec2_TeamFoo.json', role, 'us-west-2'),
+                                     ('rds_TeamFoo.json', role, 'us-west-2'),
+                                     ('ec2_TeamFoo.json', role, 'us-east-1')])
+        self.assertEqual(len(tasks), 4)
+        self.assertEqual(cowcatcher.team_tasks({'CowDefs': ['ec2_TeamFoo.json']}),
+                         [('ec2_TeamFoo.json', None, None)])
+        self.assertEqual(cowcatcher.roundup_key(test_info, role, 'us-east-1', True),
+                         '123456789012/us-east-1/ec2_TeamFoo.json')
+        self.assertEqual(cowcatcher.roundup_key(test_info, None, 'us-east-1'),
+                         'ec2_TeamFoo.json')
+
+    def test_get_client_cached(self):
+        """
+        Test clients are created once per service and region
+        """
+        west = cowcatcher.get_client('ec2', 'us-west-2')
+        self.assertIs(cowcatcher.get_client('ec2', 'us-west-2'), west)
+        east = cowcatcher.get_client('ec2', 'us-east-1')
+        self.assertIsNot(east, west)
+        self.assertEqual(east.meta.region_name, 'us-east-1')
+
+    def test_compile_action(self):
+        """
+        Test legacy api_pre/api_post actions compile to structured specs
+        """
+        legacy = cowcatcher.compile_action(self.cowinfo_helper()['CowActions'][0])
+        self.assertEqual(legacy['api'], 'terminate_instances')
+        self.assertEqual(legacy['id_param'], 'InstanceIds')
+        self.assertTrue(legacy['id_list'])
+        self.assertEqual(legacy['batch_size'], cowcatcher.DEFAULT_ACTION_BATCH)
+        rds = cowcatcher.compile_action(
+            {'action': 'terminate', 'time_delta': '+5 weeks',
+             'api_pre': "delete_db_instance(DBInstanceIdentifier='",
+             'api_post': "',SkipFinalSnapshot=True)"})
+        self.assertEqual(rds['id_param'], 'DBInstanceIdentifier')
+        self.assertFalse(rds['id_list'])
+        self.assertEqual(rds['batch_size'], 1)
+        self.assertEqual(rds['api_args'], {'SkipFinalSnapshot': True})
+        report = cowcatcher.compile_action(self.cowinfo_helper()['CowActions'][2])
+        self.assertEqual(report['api'], None)
+
+    def test_run_action_batch(self):
+        """
+        Test actions are batched and failed ids are found individually
+        """
+        class FakeEc2(object):
+            """
+            Minimal ec2 client, failing any call including a bad id
+            """
+            def __init__(self):
+                self.calls = []
+
+            def terminate_instances(self, InstanceIds):
+                self.calls.append(list(InstanceIds))
+                if 'i-bad' in InstanceIds:
+                    raise cowcatcher.ClientError(
+                        {'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': ''}},
+                        'TerminateInstances')
+
+        spec = {'action': 'terminate', 'api': 'terminate_instances',
+                'id_param': 'InstanceIds', 'id_list': True, 'batch_size': 3,
+                'api_args': {}}
+        client = FakeEc2()
+        ids = ['i-1', 'i-2', 'i-bad', 'i-4']
+        failures = cowcatcher.run_action_batch(client, spec, ids)
+        self.assertEqual(failures, {'i-bad': 'InvalidInstanceID.NotFound'})
+        self.assertEqual(client.calls, [['i-1', 'i-2', 'i-bad'], ['i-1'], ['i-2'],
+                                        ['i-bad'], ['i-4']])
+
+    @staticmethod
+    def roundup_helper():
+        """
+        provide the old-format test roundup from the tests directory
+        """
+        test_file = os.path.join(os.path.dirname(__file__), 'ec2_TeamFoo_test.json')
+        with open(test_file) as roundup_file:
+            return json.load(roundup_file)
+
+    def test_migrate_roundup(self):
+        """
+        Test old-format roundups get epoch discovery times
+        """
+        roundup = cowcatcher.migrate_roundup(self.roundup_helper())
+        cow = roundup['cows'][0]
+        self.assertEqual(cow['initial_discovery_str'], 'Fri Jul 21 08:35:34 2017')
+        self.assertEqual(time.localtime(cow['initial_discovery'])[:6],
+                         (2017, 7, 21, 8, 35, 34))
+        self.assertEqual(cowcatcher.roundup_last_run(roundup),
+                         cowcatcher.parse_run_time('Mon Aug 21 12:25:47 2017'))
+        # Migrating twice changes nothing
+        self.assertEqual(cowcatcher.migrate_roundup(roundup)['cows'][0], cow)
+
+    def test_handle_cows_thresholds(self):
+        """
+        Test actions trigger once a cow is older than their time_delta
+        """
+        test_info = self.cowinfo_helper()
+        test_info['CowActions'] = [test_info['CowActions'][2]]
+        old_roundup = cowcatcher.migrate_roundup(self.roundup_helper())
+        now_sec = cowcatcher.mktime(self.Now_tm[0])
+        old_roundup['cows'][2]['initial_discovery'] = now_sec - 60 * 60
+        new_cows = [{'id': c['id'], 'tags': {}, 'state': 'running', 'type': 't2.micro'}
+                    for c in old_roundup['cows']]
+        new_cows.append({'id': 'i-new', 'tags': {}, 'state': 'running',
+                         'type': 't2.micro'})
+        # actions are only logged until EnforceActions is set
+        dry_run = cowcatcher.handle_cows([dict(c) for c in new_cows], old_roundup, None,
+                                         test_info, self.Pdtcal, self.Now_tm, self.Now_str)
+        self.assertEqual(dry_run['action_summary'], {})
+        self.assertEqual(dry_run['delta']['actioned'], [])
+        roundup = cowcatcher.handle_cows(new_cows, old_roundup, None, test_info,
+                                         self.Pdtcal, self.Now_tm, self.Now_str,
+                                         enforce=True)
+        self.assertEqual(roundup['action_summary'], {'report': 3})
+        self.assertEqual([len(c['action_history']) for c in roundup['cows']],
+                         [2, 2, 0, 2, 0])
+        self.assertEqual(roundup['cows'][4]['initial_discovery'], int(now_sec))
+
+    def test_add_time_delta(self):
+        """
+        Test the direct time_delta parse agrees with parsedatetime
+        """
+        for delta in ['+10 seconds', '+30 minutes', '+1 hour', '+2 days', '+5 weeks',
+                      '+1 month', '+2 years', '3 Days']:
+            self.assertEqual(cowcatcher.add_time_delta(delta, self.Now_tm[0]),
+                             cowcatcher.mktime(self.Pdtcal.parse(delta, self.Now_tm[0])[0]))
+        self.assertEqual(cowcatcher.add_time_delta('tomorrow', self.Now_tm[0], self.Pdtcal),
+                         cowcatcher.mktime(self.Pdtcal.parse('tomorrow', self.Now_tm[0])[0]))
+        # month ends clamp to the end of the target month
+        for when, delta, expected in [((2026, 1, 31), '+1 month', (2026, 2, 28)),
+                                      ((2025, 12, 31), '+2 months', (2026, 2, 28)),
+                                      ((2026, 1, 31), '+13 months', (2027, 2, 28)),
+                                      ((2024, 2, 29), '+1 year', (2025, 2, 28)),
+                                      ((2026, 3, 31), '+1 month', (2026, 4, 30))]:
+            now_tm = cowcatcher.localtime(cowcatcher.mktime(when + (12, 0, 0, 0, 0, -1)))
+            self.assertEqual(cowcatcher.localtime(
+                cowcatcher.add_time_delta(delta, now_tm))[:6], expected + (12, 0, 0))
+            self.assertEqual(cowcatcher.add_time_delta(delta, now_tm),
+                             cowcatcher.mktime(self.Pdtcal.parse(delta, now_tm)[0]))
+
+    def test_iter_service_instance_tags(self):
+        """
+        Test discovery streams page by page into analysis
+        """
+        test_info = self.cowinfo_helper()
+        test_client = boto3.client('ec2', region_name='us-west-2')
+        stubber = Stubber(test_client)
+        def page(ids, token=None):
+            """ one describe_instances page of tagged/untagged instances """
+            resp = {'Reservations': [{'Instances': [
+                {'InstanceId': i, 'InstanceType': 't2.micro', 'State': {'Name': 'running'},
+                 'Tags': [{'Key': 'REPLACE_KEY1', 'Value': 'x'},
+                          {'Key': 'REPLACE_KEY2', 'Value': 'y' if i.endswith('ok') else ''}]}
+                for i in ids]}]}
+            if token:
+                resp['NextToken'] = token
+            return resp
+        stubber.add_response('describe_instances', page(['i-1ok', 'i-2'], 'tok'), {})
+        stubber.add_response('describe_instances', page(['i-3ok', 'i-4']),
+                             {'NextToken': 'tok'})
+        with stubber:
+            records = cowcatcher.iter_service_instance_tags(test_client, test_info)
+            self.assertEqual(next(records)['id'], 'i-1ok')
+            cows = cowcatcher.analyze_service_instances(
+                records, test_info, {'i-2': {'username': 'bob', 'checked': 0},
+                                     'i-4': {'username': 'amy', 'checked': 0}})
+        self.assertEqual([(c['id'], c['username']) for c in cows],
+                         [('i-2', 'bob'), ('i-4', 'amy')])
+
+    def test_cow_violations(self):
+        """
+        Test required keys, allowed values, regexes and state exemptions
+        """
+        test_info = self.cowinfo_helper()
+        test_info['CowRules'] = [{'key': 'Env', 'allowed': ['prod', 'dev']},
+                                 {'key': 'Owner', 'regex': '^team-',
+                                  'exempt_states': ['stopped']}]
+        test_info['CowExemptStates'] = ['terminated']
+        rules = cowcatcher.compile_rules(test_info)
+        tags = {'REPLACE_KEY1': 'a', 'REPLACE_KEY2': 'b', 'Env': 'prod',
+                'Owner': 'team-foo'}
+        inst = {'id': 'i-1', 'state': 'running', 'tags': tags}
+        self.assertEqual(cowcatcher.cow_violations(rules, inst), [])
+        inst['tags'] = {'REPLACE_KEY2': 'b', 'Env': 'test', 'Owner': 'bob'}
+        self.assertEqual(cowcatcher.cow_violations(rules, inst),
+                         ['missing REPLACE_KEY1', 'Env=test not allowed',
+                          'Owner=bob does not match ^team-'])
+        inst['state'] = 'stopped'
+        self.assertEqual(cowcatcher.cow_violations(rules, inst),
+                         ['missing REPLACE_KEY1', 'Env=test not allowed'])
+        inst['state'] = 'terminated'
+        self.assertEqual(cowcatcher.cow_violations(rules, inst), [])
+
+    def test_render_report_formats(self):
+        """
+        Test text rendering is unchanged and json/html render every cow
+        """
+        test_info = self.cowinfo_helper()
+        roundup = cowcatcher.migrate_roundup(self.roundup_helper())
+        sections = [(roundup, test_info, ''), (roundup, test_info, 'us-east-1')]
+        text = cowcatcher.format_report(roundup, test_info)
+        chunks = list(cowcatcher.iter_text_report(sections[:1]))
+        self.assertEqual(''.join(chunks), text)
+        # a header, one chunk per cow, in order, then the footer
+        self.assertTrue(chunks[0].startswith('Service: ec2\n  CowCatcher run: ' +
+                                             roundup['last_run']))
+        self.assertIn('\n    report:   3\n  Untagged instances: ', chunks[0])
+        self.assertEqual(len(chunks), len(roundup['cows']) + 2)
+        for chunk, cow in zip(chunks[1:-1], roundup['cows']):
+            self.assertTrue(chunk.startswith('\n    ID:      ' + cow['id'] + '\n'))
+            self.assertIn('\n      State:   ' + cow['state'], chunk)
+        self.assertEqual(text.count('\n    ID:      '), len(roundup['cows']))
+        lines = []
+        class Out(object):
+            """ file-like collector """
+            write = lines.append
+        cowcatcher.render_report(sections, Out(), 'text')
+        self.assertEqual(''.join(lines), text + text.replace('ec2', 'ec2 (us-east-1)', 1))
+        doc = json.loads(cowcatcher.report_string(sections, 'json'))
+        self.assertEqual([len(svc['cows']) for svc in doc['services']], [4, 4])
+        html = cowcatcher.report_string(sections, 'html')
+        self.assertEqual(html.count('<tr><td>'), 8)
+
+    def test_delta_sections(self):
+        """
+        Test delta reports list only new, actioned and departed cows
+        """
+        test_info = self.cowinfo_helper()
+        test_info['CowActions'] = [test_info['CowActions'][2]]
+        old_roundup = cowcatcher.migrate_roundup(self.roundup_helper())
+        new_cows = [{'id': c['id'], 'tags': {}, 'state': 'running', 'type': 't2.micro'}
+                    for c in old_roundup['cows'][1:]]
+        new_cows.append({'id': 'i-new', 'tags': {}, 'state': 'running',
+                         'type': 't2.micro'})
+        roundup = cowcatcher.handle_cows(new_cows, old_roundup, None, test_info,
+                                         self.Pdtcal, self.Now_tm, self.Now_str,
+                                         enforce=True)
+        # i-0000000000000dead is reported for the first time
+        self.assertEqual(roundup['delta']['new'], ['i-new'])
+        self.assertEqual(roundup['delta']['actioned'], ['i-0000000000000dead'])
+        self.assertEqual([c['id'] for c in roundup['delta']['gone']],
+                         ['i-0deaddeaddeaddead'])
+        changed = cowcatcher.delta_sections([(roundup, test_info, '')])
+        self.assertEqual([c['id'] for c in changed[0][0]['cows']],
+                         ['i-0000000000000dead', 'i-new'])
+        text = cowcatcher.report_string(changed, 'text', 's3://bucket/full')
+        self.assertIn('Left the herd: \n    ID:      i-0deaddeaddeaddead', text)
+        self.assertTrue(text.endswith('Full report: s3://bucket/full\n'))
+        # A second identical run has nothing to report
+        again = cowcatcher.handle_cows(
+            [dict(c) for c in roundup['cows']], roundup, None, test_info,
+            self.Pdtcal, self.Now_tm, self.Now_str, enforce=True)
+        self.assertEqual(cowcatcher.delta_sections([(again, test_info, '')]), [])
+
+    def test_split_report(self):
+        """
+        Test reports split between chunks by encoded size
+        """
+        chunks = [u'header\n', u'\xe9' * 10, u'abc', u'x' * 25]
+        parts = cowcatcher.split_report(chunks, 20)
+        self.assertEqual(parts, [u'header\n', u'\xe9' * 10, u'abc', u'x' * 20, u'x' * 5])
+        for part in parts:
+            self.assertLessEqual(len(part.encode('utf-8')), 20)
+        # multi-byte characters are never cut in half
+        self.assertEqual(cowcatcher.split_report([u'\xe9' * 11], 5),
+                         [u'\xe9' * 2] * 5 + [u'\xe9'])
+        self.assertEqual(''.join(cowcatcher.split_report(chunks, 1000)), ''.join(chunks))
+
+    def test_send_report_parts(self):
+        """
+        Test large reports are published in numbered parts
+        """
+        test_info = self.cowinfo_helper()
+        test_info['CowReportARN'] = 'arn:aws:sns:us-west-2:123456789012:CowReport'
+        chunks = ['a' * 150000, 'b' * 150000]
+        stubber = Stubber(cowcatcher.get_client('sns', 'us-west-2'))
+        for idx, chunk in enumerate(chunks):
+            stubber.add_response('publish', {'MessageId': str(idx)},
+                                 {'TopicArn': test_info['CowReportARN'], 'Message': chunk,
+                                  'Subject': 'CowCatcher Report for %s (%d/2)' %
+                                             (self.Now_str, idx + 1)})
+        with stubber:
+            resp = cowcatcher.send_report(chunks, test_info, self.Now_str)
+        stubber.assert_no_pending_responses()
+        self.assertEqual(resp['MessageId'], '1')
+        # an empty report is not published; the stubber has no response left
+        with stubber:
+            self.assertIsNone(cowcatcher.send_report([], test_info, self.Now_str))
+            self.assertIsNone(cowcatcher.send_report('', test_info, self.Now_str))
+
+    def test_roundup_persistence(self):
+        """
+        Test gzipped roundups are revalidated from the local cache and
+        not rewritten when unchanged
+        """
+        roundup = cowcatcher.migrate_roundup(self.roundup_helper())
+        body = cowcatcher.encode_roundup(roundup)
+        self.assertEqual(cowcatcher.decode_roundup(body), roundup)
+        self.roundup_cache()
+        stubber = Stubber(cowcatcher.get_client('s3'))
+        key = 'ec2_TeamFoo_cached.json'
+        params = {'Bucket': self.Bucket, 'Key': key}
+        stubber.add_response('get_object',
+                             {'Body': StreamingBody(cowcatcher.BytesIO(body), len(body)),
+                              'ETag': '"v1"',
+                              'Metadata': {'content-sha256':
+                                               cowcatcher.roundup_digest(roundup)}},
+                             params)
+        stubber.add_client_error('get_object', '304', 'Not Modified', 304,
+                                 expected_params=dict(params, IfNoneMatch='"v1"'))
+        with stubber:
+            self.assertEqual(cowcatcher.load_roundup(self.Bucket, key), roundup)
+            cached = cowcatcher.load_roundup(self.Bucket, key)
+            self.assertEqual(cached, roundup)
+            # only volatile fields changed, so nothing is written
+            cached['last_run_epoch'] += 60
+            self.assertEqual(cowcatcher.save_roundup(cached, self.Bucket, key), 200)
+        stubber.assert_no_pending_responses()
+
+    def test_merge_roundups(self):
+        """
+        Test overlapping runs keep each other's action history
+        """
+        ours = {'cows': [{'id': 'i-1', 'action_history': ['report at 1', 'stop at 2']}],
+                'owners': {'i-1': {'username': 'bob', 'checked': 2}}}
+        theirs = {'cows': [{'id': 'i-1', 'action_history': ['report at 1', 'stop at 3']}],
+                  'owners': {'i-2': {'username': 'amy', 'checked': 3}}}
+        merged = cowcatcher.merge_roundups(ours, theirs)
+        self.assertEqual(merged['cows'][0]['action_history'],
+                         ['report at 1', 'stop at 2', 'stop at 3'])
+        self.assertEqual(sorted(merged['owners']), ['i-1', 'i-2'])
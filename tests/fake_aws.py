@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""
+   In-memory AWS stand-in for cowcatcher.py benchmarks and tests.
+
+   FakeAws answers the calls cowcatcher makes from a synthetic fleet.
+   It hooks real botocore clients on their before-call event, the way
+   botocore's Stubber does, so paginators, parameter validation and
+   cowcatcher's client cache all run as they would against AWS; only
+   the HTTP request is replaced.
+"""
+
+from collections import defaultdict
+from fnmatch import fnmatchcase
+from hashlib import md5
+from io import BytesIO
+from random import Random
+from threading import Lock
+from time import sleep, time
+import datetime
+import json
+
+from botocore.response import StreamingBody
+from botocore.vendored.requests.models import Response
+
+# Tags every tagged resource carries; point CowKeyChecklist at these
+FLEET_TAG_KEYS = ['Owner', 'CostCenter']
+# Results per page, as the real services default to
+PAGE_SIZES = {'DescribeInstances': 1000,
+              'DescribeDBInstances': 100,
+              'DescribeAutoScalingGroups': 50,
+              'GetResources': 100,
+              'LookupEvents': 50,
+              'ListObjectsV2': 1000}
+CREATE_EVENTS = {'ec2': 'RunInstances',
+                 'rds': 'CreateDBInstance',
+                 'autoscaling': 'CreateAutoScalingGroup'}
+# Services get_resources serves
+TAGGING_SERVICES = ['ec2', 'rds']
+ACCOUNT = '123456789012'
+REGION = 'us-west-2'
+
+
+def make_fleet(service, count, untagged_ratio=0.1, seed=0):
+    """
+    Return count synthetic resources of service (ec2, rds or
+    autoscaling), untagged_ratio of them missing the FLEET_TAG_KEYS
+    """
+    rand = Random('%s-%d' % (service, seed))
+    users = ['user%02d' % i for i in range(20)]
+    fleet = []
+    for num in range(count):
+        tags = [{'Key': 'Name', 'Value': '%s-%d' % (service, num)}]
+        if rand.random() >= untagged_ratio:
+            tags.extend({'Key': key, 'Value': 'v%d' % (num % 7)} for key in FLEET_TAG_KEYS)
+        fleet.append({'num': num, 'tags': tags, 'owner': rand.choice(users),
+                      'state': rand.choice(['running', 'running', 'stopped'])})
+    return fleet
+
+
+def ec2_instance(rsc):
+    """ describe_instances shape of a fleet resource """
+    return {'InstanceId': 'i-%017x' % rsc['num'], 'InstanceType': 't2.micro',
+            'State': {'Code': 16, 'Name': rsc['state']}, 'Tags': rsc['tags']}
+
+
+def rds_instance(rsc):
+    """ describe_db_instances shape of a fleet resource; tags come separately """
+    name = 'db-%06d' % rsc['num']
+    return {'DBInstanceIdentifier': name, 'DBInstanceClass': 'db.t2.micro',
+            'DBInstanceStatus': 'available',
+            'DBInstanceArn': 'arn:aws:rds:%s:%s:db:%s' % (REGION, ACCOUNT, name)}
+
+
+def asg_group(rsc):
+    """ describe_auto_scaling_groups shape of a fleet resource """
+    name = 'asg-%06d' % rsc['num']
+    return {'AutoScalingGroupName': name, 'MinSize': 0, 'MaxSize': 1,
+            'DesiredCapacity': 1, 'DefaultCooldown': 300,
+            'AvailabilityZones': [REGION + 'a'], 'HealthCheckType': 'EC2',
+            'CreatedTime': datetime.datetime(2017, 7, 17),
+            'Instances': [{'InstanceId': 'i-%017x' % rsc['num'],
+                           'AvailabilityZone': REGION + 'a',
+                           'LifecycleState': 'InService', 'HealthStatus': 'Healthy',
+                           'LaunchConfigurationName': 'lc', 'ProtectedFromScaleIn': False}],
+            'Tags': [dict(tag, ResourceId=name, ResourceType='auto-scaling-group',
+                          PropagateAtLaunch=False) for tag in rsc['tags']]}
+
+
+SHAPES = {'ec2': ec2_instance, 'rds': rds_instance, 'autoscaling': asg_group}
+RESOURCE_IDS = {'ec2': 'InstanceId', 'rds': 'DBInstanceIdentifier',
+                'autoscaling': 'AutoScalingGroupName'}
+
+
+class FakeAws(object):
+    """
+    Serve fleets, S3 objects and SNS publishes from memory.
+    latency seconds are slept on every call; throttle_ratio of calls
+    fail with ThrottlingException (a dict gives the ratio per operation).
+    """
+
+    def __init__(self, fleets=None, latency=0.0, throttle_ratio=0.0, seed=0):
+        self.latency = latency
+        self.throttle_ratio = throttle_ratio
+        self.rand = Random(seed)
+        self.lock = Lock()
+        self.calls = defaultdict(int)
+        self.objects = {}
+        self.published = []
+        # bytes served by ranged GETs
+        self.ranged_bytes = 0
+        self.resources = {}
+        self.tags = {}
+        self.mappings = {}
+        self.events = defaultdict(list)
+        self.resource_events = {}
+        # Lambda function name -> handler(event, context) lambda invoke runs
+        self.functions = {}
+        for service, fleet in (fleets or {}).items():
+            self.add_fleet(service, fleet)
+
+    def add_fleet(self, service, fleet):
+        """
+        Serve fleet (from make_fleet) as the resources of service
+        """
+        shape = SHAPES[service]
+        resources = [shape(rsc) for rsc in fleet]
+        self.resources[service] = resources
+        mappings = self.mappings[service] = []
+        for rsc, raw in zip(resources, fleet):
+            rsc_id = rsc[RESOURCE_IDS[service]]
+            event = {'EventId': rsc_id, 'EventName': CREATE_EVENTS[service],
+                     'Username': raw['owner'], 'Resources': [{'ResourceName': rsc_id}]}
+            self.events[CREATE_EVENTS[service]].append(event)
+            self.resource_events[rsc_id] = [event]
+            if service == 'rds':
+                self.tags[rsc['DBInstanceArn']] = raw['tags']
+                mappings.append({'ResourceARN': rsc['DBInstanceArn'], 'Tags': raw['tags']})
+            elif service == 'ec2':
+                mappings.append({'ResourceARN': 'arn:aws:ec2:%s:%s:instance/%s' % (
+                    REGION, ACCOUNT, rsc_id), 'Tags': raw['tags']})
+
+    def attach(self, client):
+        """
+        Answer every call of botocore client from memory
+        """
+        client.meta.events.register('before-parameter-build', self._keep_params)
+        client.meta.events.register('before-call', self._respond)
+        return client
+
+    def install(self, module):
+        """
+        Attach every client module.get_client creates; return a function
+        undoing it
+        """
+        get_client = module.get_client
+        attached = set()
+
+        def fake_get_client(*args, **kwargs):
+            """ module.get_client, attaching new clients to this stand-in """
+            client = get_client(*args, **kwargs)
+            with self.lock:
+                if id(client) not in attached:
+                    attached.add(id(client))
+                    self.attach(client)
+            return client
+
+        module.get_client = fake_get_client
+        module.CLIENTS.clear()
+
+        def uninstall():
+            """ restore module.get_client """
+            module.get_client = get_client
+            module.CLIENTS.clear()
+        return uninstall
+
+    @staticmethod
+    def _keep_params(params, context, **kwargs):
+        """ Keep the caller's parameters for _respond """
+        context['fake_params'] = params
+
+    def _respond(self, model, context, **kwargs):
+        """ Return (http response, parsed response) of one call """
+        operation = model.name
+        with self.lock:
+            self.calls[operation] += 1
+            ratio = self.throttle_ratio
+            if isinstance(ratio, dict):
+                ratio = ratio.get(operation, 0.0)
+            throttled = self.rand.random() < ratio
+        if self.latency:
+            sleep(self.latency)
+        if throttled:
+            return self._error(400, 'ThrottlingException', 'Rate exceeded')
+        handler = getattr(self, 'op_' + operation, None)
+        if handler is None:
+            return self._ok({})
+        return handler(context.get('fake_params', {}))
+
+    @staticmethod
+    def _ok(parsed):
+        """ A successful response """
+        http = Response()
+        http.status_code = 200
+        parsed.setdefault('ResponseMetadata', {'HTTPStatusCode': 200,
+                                               'RetryAttempts': 0})
+        return http, parsed
+
+    @staticmethod
+    def _error(status, code, message=''):
+        """ An error response, raised by botocore as a ClientError """
+        http = Response()
+        http.status_code = status
+        return http, {'Error': {'Code': code, 'Message': message},
+                      'ResponseMetadata': {'HTTPStatusCode': status}}
+
+    @staticmethod
+    def _page(items, params, operation, token_in, token_out, limit_param):
+        """ Slice one page of items, with its continuation token """
+        size = params.get(limit_param) or PAGE_SIZES[operation]
+        start = int(params.get(token_in) or 0)
+        page = {}
+        if start + size < len(items):
+            page[token_out] = str(start + size)
+        return items[start:start + size], page
+
+    def _select(self, service, ids):
+        """ The resources of service, or only those with the given ids """
+        resources = self.resources.get(service, [])
+        if ids is None:
+            return resources
+        return [rsc for rsc in resources if rsc[RESOURCE_IDS[service]] in ids]
+
+    @staticmethod
+    def _ec2_match(inst, flt):
+        """ True if ec2 instance inst matches describe_instances filter flt """
+        tags = dict((tag['Key'], tag['Value']) for tag in inst.get('Tags', []))
+        name = flt['Name']
+        if name.startswith('tag:'):
+            found = [tags[name[4:]]] if name[4:] in tags else []
+        else:
+            found = {'instance-id': [inst['InstanceId']], 'tag-key': list(tags),
+                     'instance-state-name': [inst['State']['Name']],
+                     'instance-type': [inst['InstanceType']]}[name]
+        return any(fnmatchcase(value, pattern) for value in found
+                   for pattern in flt['Values'])
+
+    def op_DescribeInstances(self, params):
+        """ ec2 describe_instances, one reservation per instance """
+        instances = self._select('ec2', params.get('InstanceIds'))
+        if params.get('InstanceIds') and len(instances) < len(params['InstanceIds']):
+            return self._error(400, 'InvalidInstanceID.NotFound', 'No such instance')
+        for flt in params.get('Filters') or []:
+            instances = [inst for inst in instances if self._ec2_match(inst, flt)]
+        items, page = self._page(instances, params,
+                                 'DescribeInstances', 'NextToken', 'NextToken',
+                                 'MaxResults')
+        page['Reservations'] = [{'ReservationId': 'r-%s' % inst['InstanceId'][2:],
+                                 'Instances': [inst]} for inst in items]
+        return self._ok(page)
+
+    def op_DescribeDBInstances(self, params):
+        """ rds describe_db_instances """
+        ids = [params['DBInstanceIdentifier']] if params.get('DBInstanceIdentifier') else None
+        instances = self._select('rds', ids)
+        if ids and not instances:
+            return self._error(404, 'DBInstanceNotFound', 'No such DB instance')
+        items, page = self._page(instances, params,
+                                 'DescribeDBInstances', 'Marker', 'Marker',
+                                 'MaxRecords')
+        page['DBInstances'] = items
+        return self._ok(page)
+
+    def op_DescribeAutoScalingGroups(self, params):
+        """ autoscaling describe_auto_scaling_groups """
+        items, page = self._page(self._select('autoscaling',
+                                              params.get('AutoScalingGroupNames')), params,
+                                 'DescribeAutoScalingGroups', 'NextToken', 'NextToken',
+                                 'MaxRecords')
+        page['AutoScalingGroups'] = items
+        return self._ok(page)
+
+    def op_ListTagsForResource(self, params):
+        """ rds list_tags_for_resource """
+        return self._ok({'TagList': self.tags.get(params['ResourceName'], [])})
+
+    def op_GetResources(self, params):
+        """ resourcegroupstaggingapi get_resources """
+        service = params['ResourceTypeFilters'][0].split(':')[0]
+        items, page = self._page(self.mappings.get(service, []), params, 'GetResources',
+                                 'PaginationToken', 'PaginationToken', 'ResourcesPerPage')
+        page['ResourceTagMappingList'] = items
+        return self._ok(page)
+
+    def op_LookupEvents(self, params):
+        """ cloudtrail lookup_events, by ResourceName or EventName """
+        attr = params['LookupAttributes'][0]
+        if attr['AttributeKey'] == 'ResourceName':
+            events = self.resource_events.get(attr['AttributeValue'], [])
+        else:
+            events = self.events.get(attr['AttributeValue'], [])
+        items, page = self._page(events, params, 'LookupEvents', 'NextToken',
+                                 'NextToken', 'MaxResults')
+        page['Events'] = items
+        return self._ok(page)
+
+    def op_GetObject(self, params):
+        """ s3 get_object, honouring IfNoneMatch and Range """
+        key = (params['Bucket'], params['Key'])
+        if key not in self.objects:
+            return self._error(404, 'NoSuchKey', 'The specified key does not exist.')
+        obj = self.objects[key]
+        if params.get('IfNoneMatch') == obj['ETag']:
+            return self._error(304, '304', 'Not Modified')
+        body = obj['Body']
+        if params.get('Range'):
+            first, last = params['Range'][len('bytes='):].split('-')
+            body = body[int(first):int(last) + 1]
+            self.ranged_bytes += len(body)
+        return self._ok({'Body': StreamingBody(BytesIO(body), len(body)),
+                         'ETag': obj['ETag'], 'Metadata': dict(obj['Metadata']),
+                         'ContentLength': len(body)})
+
+    def op_ListObjectsV2(self, params):
+        """ s3 list_objects_v2, honouring Prefix and StartAfter """
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects
+                          if bucket == params['Bucket'] and
+                          key.startswith(params.get('Prefix', '')) and
+                          key > params.get('StartAfter', ''))
+        items, page = self._page(keys, params, 'ListObjectsV2', 'ContinuationToken',
+                                 'NextContinuationToken', 'MaxKeys')
+        page['IsTruncated'] = 'NextContinuationToken' in page
+        page['Contents'] = [{'Key': key} for key in items]
+        return self._ok(page)
+
+    def op_HeadObject(self, params):
+        """ s3 head_object """
+        key = (params['Bucket'], params['Key'])
+        if key not in self.objects:
+            return self._error(404, '404', 'Not Found')
+        obj = self.objects[key]
+        return self._ok({'ETag': obj['ETag'], 'Metadata': dict(obj['Metadata']),
+                         'ContentLength': len(obj['Body'])})
+
+    def op_PutObject(self, params):
+        """ s3 put_object """
+        body = params.get('Body', b'')
+        if hasattr(body, 'read'):
+            body = body.read()
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        etag = '"%s"' % md5(body).hexdigest()
+        with self.lock:
+            self.objects[(params['Bucket'], params['Key'])] = {
+                'Body': body, 'ETag': etag, 'Metadata': params.get('Metadata', {}),
+                'LastModified': time()}
+        return self._ok({'ETag': etag})
+
+    def op_DeleteObject(self, params):
+        """ s3 delete_object """
+        with self.lock:
+            self.objects.pop((params['Bucket'], params['Key']), None)
+        return self._ok({})
+
+    def op_Invoke(self, params):
+        """ lambda invoke, running the function's handler in this process """
+        handler = self.functions.get(params['FunctionName'])
+        if handler is None:
+            return self._error(404, 'ResourceNotFoundException', 'Function not found')
+        payload = params.get('Payload') or b'{}'
+        if hasattr(payload, 'read'):
+            payload = payload.read()
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        parsed = {'StatusCode': 200}
+        try:
+            body = json.dumps(handler(json.loads(payload), None))
+        except Exception as err:
+            body = json.dumps({'errorMessage': str(err), 'errorType': type(err).__name__})
+            parsed['FunctionError'] = 'Unhandled'
+        body = body.encode('utf-8')
+        parsed['Payload'] = StreamingBody(BytesIO(body), len(body))
+        return self._ok(parsed)
+
+    def op_Publish(self, params):
+        """ sns publish """
+        with self.lock:
+            self.published.append(params)
+            message_id = 'msg-%d' % len(self.published)
+        return self._ok({'MessageId': message_id})
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+   Cold start benchmark for cowcatcher.py
+   Called via python tests/startup_bench.py [--compare OLD_DIR] [--runs N]
+
+   Each run imports cowcatcher in a fresh interpreter, as a new Lambda
+   container would, and times the import and the first and second
+   creation of an S3 client.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PROBE = """
+import json, sys
+from time import time
+sys.path.insert(0, %r)
+start = time()
+import cowcatcher
+imported = time()
+get_client = getattr(cowcatcher, 'get_client', None)
+if get_client is None:
+    first = second = imported
+else:
+    get_client('s3')
+    first = time()
+    get_client('s3')
+    second = time()
+print(json.dumps({'import': imported - start, 'first_client': first - imported,
+                  'second_client': second - first,
+                  'modules': len(sys.modules)}))
+"""
+
+
+def probe(src_dir):
+    """
+    Return the timings of one cold import of cowcatcher from src_dir
+    """
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+    out = subprocess.check_output([sys.executable, '-c', PROBE % src_dir], env=env)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def summarize(label, src_dir, runs):
+    """
+    Print the median of each timing over runs cold starts
+    """
+    results = [probe(src_dir) for _ in range(runs)]
+    line = [label.ljust(10)]
+    for field in ['import', 'first_client', 'second_client']:
+        values = sorted(result[field] for result in results)
+        line.append('%s %7.1f ms' % (field, values[len(values) // 2] * 1000))
+    line.append('modules %d' % results[0]['modules'])
+    print('  '.join(line))
+
+
+def main():
+    """
+    Benchmark this checkout, and optionally an older one to compare with
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--runs', type=int, default=11)
+    parser.add_argument('--compare', help='directory holding an older cowcatcher.py')
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if args.compare:
+        summarize('baseline', os.path.abspath(args.compare), args.runs)
+    summarize('current', here, args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
 export DISCOVERY_SCHEDULE="rate(1 day)"
 export SUBNET_ID=
 export SECURITY_GROUP_ID=
+# set to also update roundups from CloudTrail events between scheduled runs
+export EVENT_DRIVEN=